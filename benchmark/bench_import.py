@@ -0,0 +1,116 @@
+"""
+Benchmark the import stages on a synthetic grid.
+
+Collect, clean and split always run. With --db the tables are also saved
+and indexed into the bench schema of that database, which should be a
+disposable one (see run.sh). The snapshot written at the end is the
+input of bench_match.py.
+
+The importer prints its progress, it goes to stderr so stdout only
+carries the results.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'import'))
+
+importer = importlib.import_module('import')
+import csr
+import psycopg2
+
+from report import Report
+from synthetic import Grid
+
+SCHEMA = 'bench'
+
+def collect(nodes, ways):
+    c = importer.Collector()
+    c.collect_coords(nodes)
+    c.collect_highways(ways)
+    return c
+
+def clean(c):
+    c.clean()
+    return c
+
+def split(c):
+    c.split()
+    return c
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute('DROP SCHEMA IF EXISTS %s CASCADE' % SCHEMA)
+    cur.execute('CREATE SCHEMA %s' % SCHEMA)
+    conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=int, default=Grid.SIZE,
+                        help='nodes per side of the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=Report.REPEAT)
+    parser.add_argument('--db', metavar='DSN',
+                        help='also benchmark DB.save on this database, '
+                             'the %s schema is replaced' % SCHEMA)
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='where to write the snapshot of the grid')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON lines output file, appended to')
+    args = parser.parse_args()
+
+    report = Report(args.output, args.repeat, bench='import',
+                    grid=args.grid, seed=args.seed, db=bool(args.db))
+    sys.stdout = sys.stderr
+
+    grid = Grid(args.grid, seed=args.seed)
+    nodes = grid.nodes()
+    ways = grid.ways()
+    elements = len(nodes) + len(ways)
+
+    report.measure('import.collect', lambda: collect(nodes, ways), elements,
+                   'elements')
+    c = report.measure('import.clean', clean, elements, 'elements',
+                       setup=lambda: collect(nodes, ways))
+    refs = len(c.highway_refs.refs)
+    c = report.measure('import.split', split, refs, 'refs',
+                       setup=lambda: clean(collect(nodes, ways)))
+
+    if args.db:
+        config = dict(dsn=args.db,
+                      options='-c search_path=%s,public' % SCHEMA)
+        importer.DB_CONFIG.clear()
+        importer.DB_CONFIG.update(config)
+
+        sizes = importer.load_sizes(c)
+        rows = (sizes['mm_coord'] + sizes['mm_highway'] + refs
+                + sizes['mm_segment']
+                + int((c.segment_end - c.segment_start + 1).sum()))
+
+        db = importer.DB()
+        db.connect()
+
+        def setup():
+            reset(db.conn)
+            db.init()
+            return c
+        report.measure('db.save', db.save, rows, 'rows', setup=setup)
+        db.conn.commit()
+        report.measure('db.index', db.index, rows, 'rows', repeat=1)
+        db.close()
+
+    road = report.measure('graph.build', lambda: csr.build(c),
+                          len(c.segment_way), 'segments')
+    path = args.snapshot or os.path.join(tempfile.gettempdir(),
+                                         'mm-bench.snapshot')
+    report.measure('snapshot.write',
+                   lambda: importer.write_snapshot(c, road, path),
+                   len(c.segment_way), 'segments', path=path)
+    report.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark the matching stages on synthetic traces.
+
+The road network comes from the snapshot written by bench_import.py, so
+the matcher runs offline. With --db the candidate lookup is also timed
+against the bench schema loaded by bench_import.py --db.
+
+Use the same --grid and --seed as bench_import.py, the traces are driven
+along the same grid.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'mapmatching'))
+
+import candidates
+from downsample import DownSampler
+from hmm import HMM
+from snapshot import Snapshot
+
+from report import Report
+from synthetic import Grid
+
+SCHEMA = 'bench'
+
+def downsample(traces):
+    kept = []
+    for lng, lat, times in traces:
+        idx = DownSampler().sample(lng, lat, times)
+        kept.append((lng[idx], lat[idx]))
+    return kept
+
+def is_next(traces):
+    for lng, lat, times in traces:
+        ds = DownSampler()
+        for point in zip(lng.tolist(), lat.tolist(), times.tolist()):
+            ds.is_next(*point)
+
+def lookup(find, traces, k):
+    return [find(lng, lat, k) for lng, lat in traces]
+
+def hmm_match(hmm, traces, cands):
+    return [hmm.match(cand, lng, lat)
+            for (lng, lat), cand in zip(traces, cands)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=int, default=Grid.SIZE,
+                        help='nodes per side of the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--traces', type=int, default=20)
+    parser.add_argument('--points', type=int, default=2000,
+                        help='points per trace')
+    parser.add_argument('--noise', type=float, default=10.0,
+                        help='GPS error in meters')
+    parser.add_argument('-k', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=Report.REPEAT)
+    parser.add_argument('--db', metavar='DSN',
+                        help='also benchmark the KNN lookup on this '
+                             'database')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'mm-bench.snapshot'),
+                        help='snapshot written by bench_import.py')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON lines output file, appended to')
+    args = parser.parse_args()
+
+    report = Report(args.output, args.repeat, bench='match', grid=args.grid,
+                    seed=args.seed, traces=args.traces, points=args.points,
+                    noise=args.noise, k=args.k, db=bool(args.db))
+
+    grid = Grid(args.grid, seed=args.seed)
+    traces = grid.traces(args.traces, args.points, noise=args.noise,
+                         seed=args.seed)
+    points = args.traces * args.points
+
+    start = time.time()
+    snapshot = Snapshot(args.snapshot)
+    report.write(dict(type='stage', stage='snapshot.open', items=1,
+                      unit='files', seconds=time.time() - start))
+
+    report.measure('downsample.is_next', lambda: is_next(traces), points,
+                   'points')
+    kept = report.measure('downsample.sample', lambda: downsample(traces),
+                          points, 'points')
+    count = sum(len(lng) for lng, _ in kept)
+
+    index = snapshot.index
+    report.measure('lookup.index.k1',
+                   lambda: lookup(index.candidates, kept, 1), count,
+                   'points')
+    cands = report.measure('lookup.index',
+                           lambda: lookup(index.candidates, kept, args.k),
+                           count, 'points', k=args.k)
+
+    if args.db:
+        import psycopg2
+        conn = psycopg2.connect(args.db,
+                                options='-c search_path=%s,public' % SCHEMA)
+        c = conn.cursor()
+        find = lambda lngs, lats, k: candidates.fetch(c, lngs, lats, k)
+        report.measure('lookup.db', lambda: lookup(find, kept, args.k),
+                       count, 'points', k=args.k)
+        conn.close()
+
+    report.measure('match.hmm.straight',
+                   lambda: hmm_match(HMM(), kept, cands), count, 'points',
+                   k=args.k)
+    report.measure('match.hmm',
+                   lambda: hmm_match(HMM(graph=snapshot.graph), kept, cands),
+                   count, 'points', k=args.k)
+    report.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Compare two benchmark result files stage by stage.
+
+Exit with status 1 when a stage is slower than --threshold, so this can
+gate a change in a script.
+"""
+
+import argparse
+import sys
+
+import report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old', help='JSON lines results of the baseline')
+    parser.add_argument('new', help='JSON lines results of the change')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    old = report.load(args.old)
+    new = report.load(args.new)
+
+    regressions = 0
+    sys.stdout.write('%-24s %12s %12s %8s\n'
+                     % ('stage', 'old/s', 'new/s', 'change'))
+    for stage in sorted(set(old) & set(new)):
+        before = old[stage].get('per_sec')
+        after = new[stage].get('per_sec')
+        if not before or not after:
+            continue
+        change = after / before - 1.0
+        flag = ''
+        if change < -args.threshold:
+            flag = ' <-- slower'
+            regressions += 1
+        sys.stdout.write('%-24s %12.1f %12.1f %+7.1f%%%s\n'
+                         % (stage, before, after, change * 100, flag))
+
+    for stage in sorted(set(old) ^ set(new)):
+        sys.stdout.write('%-24s only in %s\n'
+                         % (stage, 'old' if stage in old else 'new'))
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
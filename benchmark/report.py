@@ -0,0 +1,96 @@
+"""
+Benchmark results as JSON lines.
+
+The first line describes the run (commit, versions, parameters), every
+other line is one stage:
+
+    {"type": "stage", "stage": "lookup.index", "items": 50000,
+     "unit": "points", "seconds": 0.91, "median": 0.93,
+     "per_sec": 54945.0, ...}
+
+seconds is the fastest of the repeats, per_sec is computed from it.
+"""
+
+from datetime import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+def commit():
+    try:
+        with open(os.devnull, 'w') as null:
+            out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                          cwd=ROOT, stderr=null)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Report(object):
+    REPEAT = 3
+
+    def __init__(self, path='-', repeat=REPEAT, **params):
+        self.f = sys.stdout if path == '-' else open(path, 'a')
+        self.repeat = repeat
+        self.write(dict(type='run',
+                        date=datetime.utcnow().isoformat(),
+                        commit=commit(),
+                        python=platform.python_version(),
+                        numpy=np.__version__,
+                        machine=platform.machine(),
+                        params=params))
+
+    def write(self, record):
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def measure(self, stage, func, items, unit='items', setup=None,
+                repeat=None, **extra):
+        """
+        Time func() repeat times and write the stage record.
+
+        setup() runs before every repeat, outside of the timing, and its
+        result is passed to func. Return the result of the last call.
+        """
+        seconds = []
+        for _ in range(repeat or self.repeat):
+            args = (setup(),) if setup else ()
+            start = time.time()
+            result = func(*args)
+            seconds.append(time.time() - start)
+
+        best = min(seconds)
+        record = dict(type='stage', stage=stage, items=items, unit=unit,
+                      seconds=best, median=float(np.median(seconds)),
+                      per_sec=items / best if best else None,
+                      repeat=len(seconds))
+        record.update(extra)
+        self.write(record)
+        sys.stderr.write('%-24s %10d %-8s %9.3fs %12.1f/s\n'
+                         % (stage, items, unit, best,
+                            record['per_sec'] or 0))
+        return result
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+def load(path):
+    """
+    Stage records of a result file, by stage name. The last run wins.
+    """
+    stages = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['type'] == 'run':
+                stages = {}
+            else:
+                stages[record['stage']] = record
+    return stages
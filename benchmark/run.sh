@@ -0,0 +1,65 @@
+#!/bin/bash
+#
+# Run the whole benchmark suite and append the results to OUTPUT.
+#
+#   ./run.sh OUTPUT            offline: import stages and matching
+#   ./run.sh OUTPUT --db       also DB.save and the KNN lookup, on a
+#                              disposable PostGIS started with docker
+#
+# Extra arguments (--grid, --seed, --repeat) go to both benchmarks.
+#
+# First checks that the modules shared with the Python 3 service compile
+# and import with $PYTHON3 (python3 by default).
+
+OUTPUT=$1
+shift
+
+DB=
+if [ "$1" == "--db" ]; then
+    DB=1
+    shift
+fi
+
+PYTHON=${PYTHON:-python}
+PYTHON3=${PYTHON3:-python3}
+SHARED="candidates downsample geometry graph hmm index instrument snapshot
+        traces"
+SNAPSHOT=$(mktemp -t mm-bench.XXXXXX)
+CONTAINER=mm-bench-$$
+PORT=${PORT:-55432}
+
+cleanup() {
+    rm -f $SNAPSHOT
+    if [ -n "$DB" ]; then
+        docker rm -f $CONTAINER > /dev/null
+    fi
+}
+trap cleanup EXIT
+
+set -e
+cd "$(dirname "$0")"
+
+# The matcher modules are shared with the Python 3 service (server.py)
+MODULES=$(echo $SHARED server)
+(cd ../mapmatching
+ $PYTHON3 -m py_compile ${MODULES// /.py }.py
+ $PYTHON3 -c "import ${MODULES// /, }")
+
+DB_ARGS=
+if [ -n "$DB" ]; then
+    DSN="host=localhost port=$PORT user=postgres password=bench dbname=postgres"
+    docker run -d --rm --name $CONTAINER -p $PORT:5432 \
+        -e POSTGRES_PASSWORD=bench postgis/postgis > /dev/null
+    until docker exec $CONTAINER pg_isready -U postgres > /dev/null 2>&1; do
+        sleep 1
+    done
+    sleep 2
+    docker exec $CONTAINER psql -U postgres -q \
+        -c 'CREATE EXTENSION IF NOT EXISTS postgis'
+    DB_ARGS="--db=$DSN"
+fi
+
+set -x
+
+$PYTHON bench_import.py -o $OUTPUT --snapshot $SNAPSHOT ${DB_ARGS:+"$DB_ARGS"} "$@"
+$PYTHON bench_match.py -o $OUTPUT --snapshot $SNAPSHOT ${DB_ARGS:+"$DB_ARGS"} "$@"
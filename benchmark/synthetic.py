@@ -0,0 +1,170 @@
+"""
+Synthetic road network and GPS traces.
+
+The network is a jittered grid of streets placed in the middle of the
+extract bounding box (extract/bbox-jabodetabek.txt). Rows are primary
+roads, some of them oneway, columns are residential streets. Every
+street is cut into several OSM ways that share their end nodes, and a
+few unused nodes and broken ways are added so the importer has
+something to clean.
+
+Traces are random drives along the grid, sampled at a fixed interval
+with Gaussian noise. Everything is generated from a seed, so two runs
+with the same parameters produce the same data.
+"""
+
+import os
+
+import numpy as np
+
+R = 6371000.0 # M
+
+BBOX = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, 'extract', 'bbox-jabodetabek.txt')
+
+def read_bbox(path=BBOX):
+    """
+    (min lng, min lat, max lng, max lat) of an osmconvert -b file.
+    """
+    with open(path) as f:
+        return tuple(float(v) for v in f.read().strip().split(','))
+
+class Grid(object):
+    """
+    A size x size grid of nodes spacing meters apart.
+
+    Node (i, j) is on row i and column j and has the OSM id
+    i * size + j + 1.
+    """
+
+    SIZE = 100
+    SPACING = 100 # M
+    WAY_LENGTH = 10 # Nodes
+    ONEWAY = 3 # Every 3rd row
+
+    def __init__(self, size=SIZE, spacing=SPACING, seed=0, bbox=None):
+        self.size = size
+        self.spacing = spacing
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+
+        min_lng, min_lat, max_lng, max_lat = bbox or read_bbox()
+        lat0 = (min_lat + max_lat) / 2.0
+        self.dlat = np.degrees(spacing / R)
+        self.dlng = self.dlat / np.cos(np.radians(lat0))
+        lng0 = (min_lng + max_lng) / 2.0 - self.dlng * (size - 1) / 2.0
+        lat0 = lat0 - self.dlat * (size - 1) / 2.0
+        assert lng0 > min_lng and lat0 > min_lat, 'Grid larger than bbox'
+
+        i, j = np.mgrid[0:size, 0:size]
+        jitter = rng.uniform(-0.1, 0.1, (2, size, size))
+        self.lng = lng0 + (j + jitter[0]) * self.dlng
+        self.lat = lat0 + (i + jitter[1]) * self.dlat
+
+    def node_id(self, i, j):
+        return i * self.size + j + 1
+
+    def nodes(self, unused=0.05):
+        """
+        (osm_id, lng, lat) of every node, plus some unused ones.
+        """
+        ids = np.arange(1, self.size * self.size + 1)
+        nodes = list(zip(ids.tolist(), self.lng.ravel().tolist(),
+                         self.lat.ravel().tolist()))
+
+        rng = np.random.RandomState(self.seed + 1)
+        count = int(len(nodes) * unused)
+        base = self.size * self.size + 1
+        lng = rng.uniform(self.lng.min(), self.lng.max(), count)
+        lat = rng.uniform(self.lat.min(), self.lat.max(), count)
+        nodes.extend(zip(range(base, base + count), lng.tolist(),
+                         lat.tolist()))
+        return nodes
+
+    def ways(self, broken=0.01):
+        """
+        (osm_id, tags, refs) of every street piece, plus some ways using
+        unknown nodes and some that are not highways.
+        """
+        ways = []
+        step = self.WAY_LENGTH - 1
+        for i in range(self.size):
+            tags = {'highway': 'primary', 'name': 'Jalan %d' % i}
+            if i % self.ONEWAY == 0:
+                tags['oneway'] = 'yes'
+            for j in range(0, self.size - 1, step):
+                end = min(j + step, self.size - 1)
+                refs = [self.node_id(i, k) for k in range(j, end + 1)]
+                ways.append((len(ways) + 1, tags, refs))
+        for j in range(self.size):
+            tags = {'highway': 'residential', 'name': 'Gang %d' % j}
+            for i in range(0, self.size - 1, step):
+                end = min(i + step, self.size - 1)
+                refs = [self.node_id(k, j) for k in range(i, end + 1)]
+                ways.append((len(ways) + 1, tags, refs))
+
+        rng = np.random.RandomState(self.seed + 2)
+        missing = self.size * self.size * 2
+        for _ in range(int(len(ways) * broken)):
+            i = rng.randint(self.size)
+            ways.append((len(ways) + 1, {'highway': 'service'},
+                         [self.node_id(i, 0), missing + len(ways)]))
+            ways.append((len(ways) + 1, {'building': 'yes'},
+                         [self.node_id(i, 0), self.node_id(i, 1)]))
+        return ways
+
+    def drive(self, steps, rng):
+        """
+        Random walk of steps grid edges, never turning back.
+
+        Return the lng, lat of the visited nodes.
+        """
+        moves = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+        i, j = rng.randint(self.size, size=2)
+        path = [(i, j)]
+        last = None
+        while len(path) <= steps:
+            options = [(di, dj) for di, dj in moves
+                       if 0 <= i + di < self.size and 0 <= j + dj < self.size
+                       and (di, dj) != last]
+            # Keep going straight most of the time
+            if last is not None and (-last[0], -last[1]) in options \
+                    and rng.rand() < 0.7:
+                di, dj = -last[0], -last[1]
+            else:
+                di, dj = options[rng.randint(len(options))]
+            i += di
+            j += dj
+            last = (-di, -dj)
+            path.append((i, j))
+
+        i, j = np.array(path).T
+        return self.lng[i, j], self.lat[i, j]
+
+    def traces(self, count, points, interval=5.0, speed=10.0, noise=10.0,
+               seed=0):
+        """
+        count traces of points (lng, lat, time) each, at speed m/s,
+        sampled every interval seconds with noise meters of error.
+        """
+        rng = np.random.RandomState(seed)
+        length = points * interval * speed
+        steps = int(np.ceil(length / self.spacing)) + 1
+
+        traces = []
+        for _ in range(count):
+            lng, lat = self.drive(steps, rng)
+            x = np.radians(lng) * R * np.cos(np.radians(lat[0]))
+            y = np.radians(lat) * R
+            along = np.zeros(len(x))
+            np.cumsum(np.hypot(np.diff(x), np.diff(y)), out=along[1:])
+
+            time = np.arange(points) * interval
+            d = np.minimum(time * speed, along[-1])
+            tlng = np.interp(d, along, lng)
+            tlat = np.interp(d, along, lat)
+            tlng += np.degrees(rng.normal(0, noise, points) / R
+                               / np.cos(np.radians(tlat)))
+            tlat += np.degrees(rng.normal(0, noise, points) / R)
+            traces.append((tlng, tlat, time))
+        return traces
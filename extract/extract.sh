@@ -1,8 +1,13 @@
 #!/bin/bash
+#
+#   ./extract.sh INPUT OUTPUT BBOX [OSMCONVERT OPTIONS]
+#
+# Pass --keep-highways to extract only the highways and their nodes.
 
 INPUT=$1
 OUTPUT=$2
 BBOX="$(cat $3)"
+shift 3
 
 set -x
 
@@ -10,5 +15,5 @@ set -x
     -o=$OUTPUT \
     -b=$BBOX \
     --complete-ways \
-    --drop-author
-
+    --drop-author \
+    "$@"
@@ -30,6 +30,7 @@ const char* shorthelptext=
 "-B=<border_polygon>       apply a border polygon\n"
 "--complete-ways           do not clip ways at the borders\n"
 "--complex-ways            do not clip multipolygons at the borders\n"
+"--keep-highways           keep only highways and their nodes\n"
 "--all-to-nodes            convert ways and relations to nodes\n"
 "--add-bbox-tags           adds bbox tags to ways and relations\n"
 "--add-bboxarea-tags       adds tags for estimated bbox areas\n"
@@ -120,6 +121,13 @@ const char* helptext=
 "        Same as before, but multipolygons will not be cut at the\n"
 "        borders too.\n"
 "\n"
+"--keep-highways\n"
+"        Write only the ways which have a highway tag and the nodes\n"
+"        they refer to, without the nodes' tags. Relations and all\n"
+"        other nodes and ways are dropped. Ways are kept complete as\n"
+"        with --complete-ways, which is implied; the same restrictions\n"
+"        apply. Can be used without borders.\n"
+"\n"
 "--all-to-nodes\n"
 "        Some applications do not have the ability to process ways or\n"
 "        relations, they just accept nodes as input. However, more and\n"
@@ -519,6 +527,9 @@ static bool global_completeways= false;  // when applying borders,
 static bool global_complexways= false;  // same as global_completeways,
   // but multipolygons are included completely (with all ways and their
   // nodes), even when only a single nodes lies inside the borders;
+static bool global_keephighways= false;  // same as global_completeways,
+  // but only ways with a highway tag are written, and only the nodes
+  // they refer to; node tags and relations are dropped;
 static int global_calccoords= 0;
   // calculate coordinates for all objects;
   // 0: no coordinates to calculate; 1: calculate coordinates;
@@ -1250,6 +1261,13 @@ static inline bool hash_geti(int o,int64_t idi) {
   return flag;
   }  // end   hash_geti();
 
+static void hash_clear(int o) {
+  // clear all flags for a specific object type;
+  // o: object type; 0: node; 1: way; 2: relation;
+  if(!hash__initialized) return;  // error prevention
+  memset(hash__mem[o],0,hash__max[o]);
+  }  // end   hash_clear()
+
 static int hash_queryerror() {
   // determine if an error has occurred;
   return hash__error_number;
@@ -9133,6 +9151,17 @@ int dependencystage;
   //    now: 32->33;
   // 4: write only relations, use tempfile as input;
   //    now: 33;
+static bool oo__highway(char** keyp,char** keye) {
+  // determine if the key list of an object contains a highway tag;
+  // keyp: start of the key list; keye: end of the key list;
+  while(keyp<keye) {
+    if(strcmp(*keyp,"highway")==0)
+return true;
+    keyp++;
+    }
+  return false;
+  }  // end   oo__highway()
+
 static void oo__dependencystage(int ds) {
   // change the dependencystage;
   if(loglevel>=2)
@@ -9215,7 +9244,8 @@ static int oo_main() {
   atexit(oo__end);
   memset(&statistics,0,sizeof(statistics));
   oo__bbvalid= false;
-  hashactive= border_active || global_dropbrokenrefs;
+  hashactive= border_active || global_dropbrokenrefs ||
+    global_keephighways;
   dependencystage= 0;  // 0: no recursive processing at all;
   maxrewind= maxrewind_posr= oo__maxrewindINI;
   writeheader= true;
@@ -9238,7 +9268,7 @@ static int oo_main() {
   // get input file format and care about tempfile name
   if(oo__getformat())
 return 5;
-  if((hashactive && !global_droprelations) ||
+  if((hashactive && (!global_droprelations || global_keephighways)) ||
       global_calccoords!=0) {
       // (borders to apply AND relations are required) OR
       // user wants ways and relations to be converted to nodes
@@ -9394,6 +9424,8 @@ return 28;
           //         set flags for nodes, use cwn_processing();
           if(oo__rewindall())
 return 28;
+          if(global_keephighways)
+            hash_clear(0);  // write only the nodes the ways refer to
           cwn_processing();
           oo__dependencystage(22);
             // 22:     write each node which has a flag in ht to output;
@@ -10122,6 +10154,9 @@ continue;  // do not write this object
           }  // node
         else if(otype==1) {  // way
           refidp= refid;
+          if(global_keephighways && !oo__highway(key,keye))
+              // not a highway
+            refidp= refide;  // treat as lying outside
           while(refidp<refide) {  // for every referenced node
             if(hash_geti(0,*refidp))
           break;
@@ -10149,6 +10184,12 @@ continue;  // do not write this object
 continue;  // do not write this object
       }  // dependencystage 21
     else if(otype==2) {  // relation
+      if(global_keephighways) {
+          // relations are not to be written at all
+        oo__ifp->endoffile= true;  // suppress warnings
+        oo__close();  // no need to read the rest of this file
+  continue;  // do not write this object
+        }
       if(!global_droprelations &&
           (dependencystage==31 || dependencystage==22)) {
           // not relations to drop AND
@@ -10283,12 +10324,12 @@ return 26;
     if(otype==0) {  // write node
       bool inside;  // node lies inside borders, if appl.
 
-      if(!border_active)  // no borders shall be applied
-        inside= true;
-      else if(dependencystage==22)
+      if(dependencystage==22)
           // 22:     write each node which has a flag in ht to output;
           //         write each way which has a flag in ht to output;
         inside= hash_geti(0,id);
+      else if(!border_active)  // no borders shall be applied
+        inside= true;
       else {
         inside= border_queryinside(lon,lat);  // node lies inside
         if(inside)
@@ -10306,6 +10347,8 @@ return 26;
           wo_node(id,
             hisver,histime,hiscset,hisuid,hisuser,lon,lat);
           keyp= key; valp= val;
+          if(global_keephighways)  // node tags are not to be written
+            keyp= keye;
           while(keyp<keye)  // for all key/val pairs of this object
             wo_node_keyval(*keyp++,*valp++);
           wo_node_close();
@@ -11638,6 +11681,12 @@ return 0;
     if(strcmp(a,"--complete-ways")==0) {
         // do not clip ways when applying borders
       global_completeways= true;
+  continue;  // take next parameter
+      }
+    if(strcmp(a,"--keep-highways")==0) {
+        // write only highways and the nodes they refer to
+      global_keephighways= true;
+      global_completeways= true;
   continue;  // take next parameter
       }
     if(strcmp(a,"--complex-ways")==0) {
@@ -11793,6 +11842,10 @@ return 2;
     }
   if(usesstdin && global_complexways) {
     PERR("cannot apply --complex-ways when reading standard input.")
+return 2;
+    }
+  if(global_keephighways && global_complexways) {
+    PERR("cannot apply --keep-highways with --complex-ways.")
 return 2;
     }
   if(global_completeways || global_complexways) {
@@ -11826,12 +11879,14 @@ return 0;  // end the program, because without having input files
     }
   if(write_open(outputfilename[0]!=0? outputfilename: NULL)!=0)
 return 3;
-  if(border_active || global_dropbrokenrefs) {  // user wants borders
+  if(border_active || global_dropbrokenrefs || global_keephighways) {
+      // user wants borders or a selection of objects
     int r;
 
     if(global_diff) {
       PERR(
-        "-b=, -B=, --drop-brokenrefs must not be combined with --diff");
+        "-b=, -B=, --drop-brokenrefs, --keep-highways must not be "
+        "combined with --diff");
 return 6;
       }
     if(h_n==0) h_n= 600;  // use standard value if not set otherwise
@@ -0,0 +1,117 @@
+"""
+Extract a region as overlapping tiles, in parallel.
+
+The bounding box (an osmconvert -b file, like bbox-jabodetabek.txt) is
+cut in a grid of tiles, every tile grown by a margin on each side, and
+osmconvert extracts all of them at the same time. The paths of the
+tiles are printed, one per line, ready for the importer:
+
+    python tiles.py INPUT OUTPUT_DIR bbox-jabodetabek.txt -n 8 > tiles
+    python ../import/import.py $(cat tiles)
+
+The ways are extracted with --complete-ways, so a way crossing a tile
+border is complete in every tile it appears in. The importer keeps one
+of them.
+"""
+
+import argparse
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def read_bbox(path):
+    """
+    (min lng, min lat, max lng, max lat) of an osmconvert -b file.
+    """
+    with open(path) as f:
+        return tuple(float(v) for v in f.read().strip().split(','))
+
+def grid(count):
+    """
+    (columns, rows) of count tiles, as close to a square as possible.
+    """
+    rows = int(count ** 0.5)
+    while count % rows:
+        rows -= 1
+    return count // rows, rows
+
+def split(bbox, count, margin):
+    """
+    Cut bbox in count tiles, each grown by margin degrees on every side
+    but kept within bbox.
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    columns, rows = grid(count)
+    width = (max_lng - min_lng) / columns
+    height = (max_lat - min_lat) / rows
+
+    tiles = []
+    for row in range(rows):
+        for column in range(columns):
+            left = min_lng + column * width
+            bottom = min_lat + row * height
+            tiles.append((max(min_lng, left - margin),
+                          max(min_lat, bottom - margin),
+                          min(max_lng, left + width + margin),
+                          min(max_lat, bottom + height + margin)))
+    return tiles
+
+def extract(task):
+    osmconvert, source, output, tile, options = task
+    subprocess.check_call([osmconvert, source,
+                           '-o=%s' % output,
+                           '-b=%s' % ','.join('%.7f' % v for v in tile),
+                           '--complete-ways',
+                           '--drop-author'] + options)
+    return output
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', help='OSM data file')
+    parser.add_argument('output', help='directory of the tiles')
+    parser.add_argument('bbox', help='osmconvert -b file of the region')
+    parser.add_argument('-n', '--tiles', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='osmconvert processes at a time')
+    parser.add_argument('--margin', type=float, default=0.01,
+                        help='overlap of the tiles in degrees')
+    parser.add_argument('--format', default='pbf',
+                        help='extension of the tiles, picks the osmconvert '
+                             'output format')
+    parser.add_argument('--keep-highways', action='store_true',
+                        help='extract only the highways and their nodes')
+    parser.add_argument('--osmconvert', default=os.path.join(HERE,
+                                                             'osmconvert'))
+    args = parser.parse_args()
+
+    options = ['--keep-highways'] if args.keep_highways else []
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    tiles = split(read_bbox(args.bbox), args.tiles, args.margin)
+    tasks = [(args.osmconvert, args.input,
+              os.path.join(args.output, 'tile-%d.%s' % (idx, args.format)),
+              tile, options)
+             for idx, tile in enumerate(tiles)]
+
+    # The work happens in the osmconvert processes, threads are enough
+    # to drive them
+    pool = ThreadPool(args.jobs)
+    try:
+        for output in pool.imap(extract, tasks):
+            print output
+            sys.stdout.flush()
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Compact routing graph of the road segments.
+
+The nodes are the end points of the segments produced by
+Collector.split() and the edges are the segments themselves. Everything
+is remapped to dense integers and stored as flat NumPy arrays in CSR
+form, one .npy file per array, so the matcher can memory-map them.
+
+Arrays:
+
+- node_osm_id: OSM id of every node
+- segment_id: mm_segment id of every segment
+- segment_osm_id, segment_index: OSM way id and index of every segment
+- segment_source, segment_target: first and last node of every segment
+- segment_length: length of every segment in meters, measured in UTM
+  48S by Collector.measure()
+- segment_oneway: 1 forward only, -1 backward only, 0 both ways
+- offsets: edges of node n are offsets[n]..offsets[n+1]
+- targets: node reached by every edge
+- edge_segment: segment travelled by every edge
+- edge_forward: whether the segment is travelled from source to target
+"""
+
+import os
+
+import numpy as np
+
+# Tag value of every oneway() value, to read the tables back into tags
+ONEWAY_TAGS = {1: 'yes', -1: '-1', 0: 'no'}
+
+def oneway(tags):
+    """
+    Direction of a highway: 1 forward only, -1 backward only, 0 both
+    ways. Stored as is in mm_highway.oneway and mm_segment.oneway too.
+    """
+    value = tags.get('oneway', '')
+    if value in ('yes', 'true', '1'):
+        return 1
+    if value == '-1':
+        return -1
+    return 0
+
+def build(c):
+    """
+    Build the graph arrays from a split Collector.
+    """
+    segment_id = []
+    segment_osm_id = []
+    segment_index = []
+    source = []
+    target = []
+    oneways = []
+
+    for sid, _, osm_id, index, size, refs in c.iter_segments():
+        segment_id.append(sid)
+        segment_osm_id.append(osm_id)
+        segment_index.append(index)
+        source.append(refs[0])
+        target.append(refs[-1])
+        oneways.append(oneway(c.highway_tags[osm_id]))
+
+    node_osm_id, nodes = np.unique(np.array(source + target, dtype=np.int64),
+                                   return_inverse=True)
+    nodes = nodes.astype(np.int32)
+    segment_source = nodes[:len(source)]
+    segment_target = nodes[len(source):]
+    segment_oneway = np.array(oneways, dtype=np.int8)
+
+    # Directed edges, one per allowed direction of every segment
+    segments = np.arange(len(segment_id), dtype=np.int32)
+    forward = segment_oneway >= 0
+    backward = segment_oneway <= 0
+    edge_source = np.concatenate([segment_source[forward],
+                                  segment_target[backward]])
+    edge_target = np.concatenate([segment_target[forward],
+                                  segment_source[backward]])
+    edge_segment = np.concatenate([segments[forward], segments[backward]])
+    edge_forward = np.concatenate([np.ones(forward.sum(), dtype=bool),
+                                   np.zeros(backward.sum(), dtype=bool)])
+
+    order = np.argsort(edge_source, kind='mergesort')
+    offsets = np.zeros(len(node_osm_id) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_source, minlength=len(node_osm_id)),
+              out=offsets[1:])
+
+    return dict(node_osm_id=node_osm_id,
+                segment_id=np.array(segment_id, dtype=np.int64),
+                segment_osm_id=np.array(segment_osm_id, dtype=np.int64),
+                segment_index=np.array(segment_index, dtype=np.int32),
+                segment_source=segment_source,
+                segment_target=segment_target,
+                segment_length=c.segment_length.astype(np.float32),
+                segment_oneway=segment_oneway,
+                offsets=offsets,
+                targets=edge_target[order],
+                edge_segment=edge_segment[order],
+                edge_forward=edge_forward[order])
+
+def save(graph, path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name, array in graph.iteritems():
+        np.save(os.path.join(path, '%s.npy' % name), array)
@@ -1,44 +1,92 @@
 from collections import defaultdict
-from datetime import datetime
+import argparse
+import multiprocessing
+import cPickle as pickle
+import os
+import shutil
 import sys
+import tempfile
+import time
+
+# The matcher, for the shared instrument module and the snapshot
+MAPMATCHING = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'mapmatching')
+sys.path.append(MAPMATCHING)
 
 from imposm.parser import OSMParser
+import numpy as np
 import psycopg2
 
+import csr
+import geometry
+import instrument
+import loader
+from nodestore import NodeStore
+import osc
+import raw
+import waystore
+from waystore import WayStore
+
 DB_CONFIG = dict(host='localhost',
                  user='angkot',
                  password='angkot',
                  dbname='mm')
 
-class TimeIt(object):
-    def __init__(self, name):
-        self.name = name
-
-    def __enter__(self):
-        self.start = datetime.now()
-        print '[T] %s :: begin' % self.name
-
-    def __exit__(self, *args):
-        end = datetime.now()
-        print '[T] %s :: end -> %s' % (self.name, end - self.start)
+# The tags stored for every highway
+TAGS = ('name', 'highway', 'oneway')
 
 class Collector(object):
-    coords = {}
-    highway_refs = {}
-    highway_tags = {}
-    segments = []
-    segment_highway = defaultdict(list)
+    def __init__(self, spill=None, highways=None):
+        self.coords = NodeStore(spill)
+        self.highway_refs = WayStore()
+        self.highway_tags = {}
+        # Highway classes to keep, all of them when None
+        self.highways = set(highways) if highways else None
+
+    def is_highway(self, tags):
+        highway = tags.get('highway')
+        if highway is None:
+            return False
+        return self.highways is None or highway in self.highways
+
+    def filter_tags(self, tags):
+        """
+        Strip the tags of a way down to TAGS, or to nothing when it is
+        not a kept highway.
+
+        This is the ways_tag_filter of the parser, it runs in the parser
+        processes so the other tags are never sent to the collector.
+        """
+        if not self.is_highway(tags):
+            tags.clear()
+            return
+        for key in list(tags):
+            if key not in TAGS:
+                del tags[key]
 
     def collect_coords(self, coords):
-        for osm_id, lng, lat in coords:
-            self.coords[osm_id] = (lng, lat)
+        self.coords.add(coords)
 
     def collect_highways(self, ways):
+        highways = []
         for osm_id, tags, refs in ways:
-            if 'highway' not in tags:
+            if not self.is_highway(tags):
                 continue
-            self.highway_refs[osm_id] = refs
-            self.highway_tags[osm_id] = tags
+            highways.append((osm_id, refs))
+            self.highway_tags[osm_id] = dict((key, tags[key]) for key in TAGS
+                                             if key in tags)
+        self.highway_refs.add(highways)
+
+    def restrict_coords(self):
+        """
+        Only collect the coords used by the highways collected so far.
+
+        This is the step between the two passes of parse(): the first
+        one collects the highways, the second one the coords they use.
+        """
+        self.highway_refs.finalize()
+        self.coords.restrict(self.highway_refs.refs)
+        print 'Referenced coords:', len(self.coords.members)
 
     def clean(self):
         """
@@ -48,48 +96,33 @@ class Collector(object):
         used for highways.
         """
 
+        self.coords.finalize()
+        self.highway_refs.finalize()
+
         print 'Before:'
         print '- coords:', len(self.coords)
         print '- highways:', len(self.highway_refs)
 
-        ref_coords = []
-        for osm_id, refs in self.highway_refs.iteritems():
-            ref_coords += refs
-        ref_coords = set(ref_coords)
-
-        available_coords = set(self.coords.keys())
-        invalid_coords = ref_coords - available_coords
-        valid_coords = ref_coords - invalid_coords
-        unused_coords = available_coords - ref_coords
-
-        for osm_id in unused_coords:
-            del self.coords[osm_id]
+        stats, incomplete_highways = waystore.clean(self.coords,
+                                                    self.highway_refs)
 
-        incomplete_highways = []
-        highway_coords_count = 0
-        for osm_id, refs in self.highway_refs.iteritems():
-            if any((ref in invalid_coords for ref in refs)) or len(refs) <= 1:
-                incomplete_highways.append(osm_id)
-            highway_coords_count += len(refs)
-
-        for osm_id in incomplete_highways:
-            del self.highway_refs[osm_id]
+        for osm_id in incomplete_highways.tolist():
             del self.highway_tags[osm_id]
 
         print 'Cleaning up:'
-        print '- available coords:', len(available_coords)
-        print '- referenced coords:', len(ref_coords)
-        print '- invalid coords:', len(invalid_coords)
-        print '- valid coords:', len(valid_coords)
-        print '- unused coords:', len(unused_coords)
-        print '- incomplete highways:', len(incomplete_highways)
-        print '- highway coords count:', highway_coords_count
+        print '- available coords:', stats['available']
+        print '- referenced coords:', stats['referenced']
+        print '- invalid coords:', stats['invalid']
+        print '- valid coords:', stats['valid']
+        print '- unused coords:', stats['unused']
+        print '- incomplete highways:', stats['incomplete']
+        print '- highway coords count:', stats['refs']
 
         print 'After:'
         print '- coords:', len(self.coords)
         print '- highways:', len(self.highway_refs)
 
-    def split(self):
+    def split(self, shared=None):
         """
         Split highways at their intersections.
 
@@ -108,384 +141,856 @@ class Collector(object):
                     b
                    [o]
 
-        """
-
-        coord_count = defaultdict(int)
-        for _, refs in self.highway_refs.iteritems():
-            for coord_id in refs:
-                coord_count[coord_id] += 1
-
-        shared_coord = set([coord_id
-                            for coord_id, count in coord_count.iteritems()
-                            if count > 1])
-
-        highway_points = defaultdict(list)
-        for way_id, refs in self.highway_refs.iteritems():
-            last_index = len(refs) - 1
-            for index, coord_id in enumerate(refs):
-                if index == 0 or index == last_index:
-                    continue
-                if coord_id in shared_coord:
-                    highway_points[way_id].append((coord_id, index))
-
-        print 'Shared coords:', len(shared_coord)
-        print 'Shared highways:', len(highway_points)
-
-        segments = []
-        segment_highway = defaultdict(list)
-        idx = 0
-        for way_id, points in highway_points.iteritems():
-            refs = self.highway_refs[way_id]
-            last = 0
-
-            index = 0
-            for _, pos in points:
-                segment = refs[last:pos+1]
-                last = pos
-                assert len(segment) > 1
-
-                segments.append((way_id, index, segment))
-                index += 1
-
-                segment_highway[way_id].append(idx)
-                idx += 1
+        Segments are kept as ranges of the flat refs array: segment s
+        is refs[segment_start[s]:segment_end[s] + 1] of the highway
+        segment_way[s], and is the segment_index[s]-th segment of that
+        highway.
 
+        shared lists the coords that are also used by highways that are
+        not in the collector, the highways are split there too.
+        """
 
-            segment = refs[last:]
-            assert len(segment) > 1
+        ways = self.highway_refs
+        refs = ways.refs
+
+        # Usage count of every coord, over dense coord ids
+        _, dense = np.unique(refs, return_inverse=True)
+        coord_count = np.bincount(dense)
+        if shared is None:
+            shared = coord_count[dense] > 1
+        else:
+            shared = (coord_count[dense] > 1) | np.in1d(refs, shared)
+
+        # Cut at the shared coords, except at both ends of a highway
+        interior = np.ones(len(refs), dtype=bool)
+        interior[ways.offsets[:-1]] = False
+        interior[ways.offsets[1:] - 1] = False
+        cuts = np.flatnonzero(shared & interior)
+
+        way_index = ways.way_index()
+        highway_cuts = np.bincount(way_index[cuts], minlength=len(ways))
+
+        print 'Shared coords:', int((coord_count > 1).sum())
+        print 'Shared highways:', int((highway_cuts > 0).sum())
+
+        # Way ranges are disjoint and ordered, so the sorted starts and
+        # ends of all segments pair up
+        starts = np.sort(np.concatenate([ways.offsets[:-1], cuts]))
+        ends = np.sort(np.concatenate([cuts, ways.offsets[1:] - 1]))
+        assert (ends > starts).all()
+
+        self.segment_count = highway_cuts + 1
+        self.segment_offsets = np.zeros(len(ways) + 1, dtype=np.int64)
+        np.cumsum(self.segment_count, out=self.segment_offsets[1:])
+
+        self.segment_way = way_index[starts]
+        self.segment_start = starts
+        self.segment_end = ends
+        self.segment_index = (np.arange(len(starts))
+                              - self.segment_offsets[:-1][self.segment_way])
+
+        self.assign_ids()
+        self.measure()
+
+    def measure(self):
+        """
+        Project the coords to UTM 48S and measure the segments there:
+        their lengths, bounding boxes and the distance of every vertex
+        from the start of its segment.
 
-            segments.append((way_id, index, segment))
-            index += 1
+        The vertex distances of segment s are
+        segment_distance[segment_vertex_offsets[s]:
+                         segment_vertex_offsets[s + 1]].
+        """
+        self.coord_x, self.coord_y = geometry.utm(self.coords.lng,
+                                                  self.coords.lat)
+
+        # Distance of every ref from the start of the flat refs array
+        pos = self.coords.index(self.highway_refs.refs)
+        x = self.coord_x[pos]
+        y = self.coord_y[pos]
+        along = np.zeros(len(pos))
+        np.cumsum(np.hypot(np.diff(x), np.diff(y)), out=along[1:])
+
+        sizes = self.segment_end - self.segment_start + 1
+        self.segment_vertex_offsets = np.zeros(len(sizes) + 1,
+                                               dtype=np.int64)
+        np.cumsum(sizes, out=self.segment_vertex_offsets[1:])
+        vertices = waystore.ranges(self.segment_start, sizes)
+        self.segment_distance = (along[vertices]
+                                 - np.repeat(along[self.segment_start], sizes))
+        self.segment_length = (along[self.segment_end]
+                               - along[self.segment_start])
+
+        first = self.segment_vertex_offsets[:-1]
+        x = x[vertices]
+        y = y[vertices]
+        self.segment_bbox = np.column_stack((np.minimum.reduceat(x, first),
+                                             np.minimum.reduceat(y, first),
+                                             np.maximum.reduceat(x, first),
+                                             np.maximum.reduceat(y, first)))
+
+    def assign_ids(self):
+        """
+        The database IDs of the coords, highways and segments are their
+        positions plus one.
+        """
+        self.coord_ids = np.arange(1, len(self.coords) + 1)
+        self.highway_ids = np.arange(1, len(self.highway_refs) + 1)
+        self.segment_ids = np.arange(1, len(self.segment_way) + 1)
 
-            segment_highway[way_id].append(idx)
-            idx += 1
+    def iter_segments(self, start=0, end=None):
+        """
+        Iterate over (segment_id, highway_id, osm_id, index, size, refs)
+        of the segments start..end.
 
-        self.segments = segments
-        self.segment_highway = segment_highway
+        Highways that are not split are a single segment.
+        """
+        ids = self.highway_refs.ids.tolist()
+        highway_ids = self.highway_ids.tolist()
+        refs = self.highway_refs.refs
+        counts = self.segment_count.tolist()
+        for segment_id, way, index, first, last in zip(
+                self.segment_ids[start:end].tolist(),
+                self.segment_way[start:end].tolist(),
+                self.segment_index[start:end].tolist(),
+                self.segment_start[start:end].tolist(),
+                self.segment_end[start:end].tolist()):
+            yield (segment_id, highway_ids[way], ids[way], index,
+                   counts[way], refs[first:last + 1])
+
+TABLES = ['mm_coord', 'mm_highway', 'mm_highway_coord', 'mm_segment',
+          'mm_segment_coord']
+
+CHUNK = 100000
+
+# (table, column, method) of the indexes built after the load. The
+# first one is the one mm_segment is clustered by.
+INDEXES = [
+    ('mm_segment', 'geometry', 'gist'),
+    ('mm_segment', 'geometry_utm', 'gist'),
+    ('mm_segment', 'id', 'btree'),
+    ('mm_segment', 'osm_id', 'btree'),
+    ('mm_segment', 'highway_id', 'btree'),
+    ('mm_segment_coord', 'segment_id', 'btree'),
+    ('mm_segment_coord', 'coord_id', 'btree'),
+    ('mm_highway', 'id', 'btree'),
+    ('mm_highway', 'geometry', 'gist'),
+    ('mm_highway_coord', 'highway_id', 'btree'),
+    ('mm_highway_coord', 'coord_id', 'btree'),
+    ('mm_coord', 'id', 'btree'),
+]
+
+def index_name(table, column):
+    return '%s_%s_idx' % (table, column)
+
+def coord_rows(c, start, end):
+    ids = c.coord_ids[start:end].tolist()
+    osm_ids = c.coords.ids[start:end].tolist()
+    lngs = c.coords.lng[start:end].tolist()
+    lats = c.coords.lat[start:end].tolist()
+    for idx, osm_id in enumerate(osm_ids):
+        yield (ids[idx], osm_id, loader.ewkb_point(lngs[idx], lats[idx]))
+
+def iter_highways(c, start, end):
+    """
+    Iterate over (highway_id, osm_id, segments, refs) of the highways
+    start..end.
+    """
+    ways = c.highway_refs
+    offsets = ways.offsets[start:end + 1].tolist()
+    for idx, (highway_id, osm_id, segments) in enumerate(zip(
+            c.highway_ids[start:end].tolist(),
+            ways.ids[start:end].tolist(),
+            c.segment_count[start:end].tolist())):
+        yield (highway_id, osm_id, segments,
+               ways.refs[offsets[idx]:offsets[idx + 1]])
+
+def highway_rows(c, start, end):
+    for highway_id, osm_id, segments, refs in iter_highways(c, start, end):
+        tags = c.highway_tags[osm_id]
+        name = tags.get('name', None)
+        highway = tags.get('highway', None)
+        oneway = csr.oneway(tags)
+
+        geometry = loader.ewkb_linestring(c.coords.lookup(refs))
+
+        yield (highway_id, osm_id, highway, name, oneway, geometry, segments)
+
+def highway_coord_rows(c, start, end):
+    for highway_id, _, _, refs in iter_highways(c, start, end):
+        size = len(refs)
+        coord_ids = c.coord_ids[c.coords.index(refs)].tolist()
+        for index, coord_id in enumerate(coord_ids):
+            yield highway_id, coord_id, index, size
+
+def segment_rows(c, start, end):
+    offsets = c.segment_vertex_offsets.tolist()
+    lengths = c.segment_length.tolist()
+    bboxes = c.segment_bbox.tolist()
+    for idx, (segment_id, highway_id, osm_id, index, size, refs) in \
+            enumerate(c.iter_segments(start, end), start):
+        tags = c.highway_tags[osm_id]
+        name = tags.get('name', None)
+        highway = tags.get('highway', None)
+        oneway = csr.oneway(tags)
+
+        pos = c.coords.index(refs)
+        wkb = loader.ewkb_linestring(
+            np.column_stack((c.coords.lng[pos], c.coords.lat[pos])))
+        wkb_utm = loader.ewkb_linestring(
+            np.column_stack((c.coord_x[pos], c.coord_y[pos])),
+            geometry.UTM_SRID)
+        distances = loader.float_array(
+            c.segment_distance[offsets[idx]:offsets[idx + 1]])
+
+        yield (segment_id, osm_id, highway_id, highway, name, oneway, wkb,
+               index, size, wkb_utm, lengths[idx],
+               loader.box2d(*bboxes[idx]), distances)
+
+def segment_coord_rows(c, start, end):
+    for segment_id, _, _, _, _, refs in c.iter_segments(start, end):
+        size = len(refs)
+        coord_ids = c.coord_ids[c.coords.index(refs)].tolist()
+        for ref_idx, coord_id in enumerate(coord_ids):
+            yield segment_id, coord_id, ref_idx, size
+
+# (table, columns, rows) of every table, in load order
+LOADS = [
+    ('mm_coord', ('id', 'osm_id', 'geometry'), coord_rows),
+    ('mm_highway', ('id', 'osm_id', 'highway', 'name', 'oneway', 'geometry',
+                    'segments'), highway_rows),
+    ('mm_highway_coord', ('highway_id', 'coord_id', 'index', 'size'),
+     highway_coord_rows),
+    ('mm_segment', ('id', 'osm_id', 'highway_id', 'highway', 'name',
+                    'oneway', 'geometry', 'index', 'size', 'geometry_utm',
+                    'length', 'bbox', 'distances'), segment_rows),
+    ('mm_segment_coord', ('segment_id', 'coord_id', 'index', 'size'),
+     segment_coord_rows),
+]
+
+def load_sizes(c):
+    return dict(mm_coord=len(c.coords),
+                mm_highway=len(c.highway_refs),
+                mm_highway_coord=len(c.highway_refs),
+                mm_segment=len(c.segment_way),
+                mm_segment_coord=len(c.segment_way))
+
+# Collector of the parallel load, inherited by the forked workers
+_collector = None
+
+def load_chunk(task):
+    """
+    Load one chunk of a table on its own connection. Run in a worker.
+    """
+    table, suffix, start, end = task
+    columns, rows = [(columns, rows) for name, columns, rows in LOADS
+                     if name == table][0]
+
+    conn = instrument.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    begin = time.time()
+    with instrument.span('Save %s%s' % (table, suffix), start=start, end=end):
+        count = loader.copy(cur, table + suffix, columns,
+                            rows(_collector, start, end))
+    conn.commit()
+    conn.close()
+    return os.getpid(), count, time.time() - begin, instrument.collect()
 
 class DB(object):
+    SUFFIX = '_new'
+
     def connect(self):
-        self.conn = psycopg2.connect(**DB_CONFIG)
+        self.conn = instrument.connect(**DB_CONFIG)
 
     def close(self):
         self.conn.commit()
 
-    def init(self):
+    def init(self, suffix=''):
+        """
+        Create the tables, named with suffix appended.
+        """
         cur = self.conn.cursor()
 
         # Coord
 
         cur.execute('''
-            CREATE TABLE mm_coord (
+            CREATE TABLE mm_coord%(suffix)s (
                 id     BIGSERIAL,
                 osm_id BIGINT PRIMARY KEY
             );
-        ''')
+        ''' % dict(suffix=suffix))
 
         cur.execute('''
-            SELECT AddGeometryColumn('mm_coord', 'geometry', 4326, 'POINT', 2);
-        ''')
+            SELECT AddGeometryColumn('mm_coord%(suffix)s', 'geometry', 4326, 'POINT', 2);
+        ''' % dict(suffix=suffix))
 
         # Highway
 
         cur.execute('''
-            CREATE TABLE mm_highway (
+            CREATE TABLE mm_highway%(suffix)s (
                 id       BIGSERIAL,
                 osm_id   BIGINT PRIMARY KEY,
                 highway  VARCHAR(128),
                 name     VARCHAR(1024),
-                oneway   BOOLEAN,
+                oneway   SMALLINT, -- csr.oneway()
                 segments INT
             );
-        ''')
+        ''' % dict(suffix=suffix))
 
         cur.execute('''
-            SELECT AddGeometryColumn('mm_highway', 'geometry', 4326, 'LINESTRING', 2);
-        ''')
+            SELECT AddGeometryColumn('mm_highway%(suffix)s', 'geometry', 4326, 'LINESTRING', 2);
+        ''' % dict(suffix=suffix))
 
         # Highway coords
 
         cur.execute('''
-            CREATE TABLE mm_highway_coord (
+            CREATE TABLE mm_highway_coord%(suffix)s (
                 id         BIGSERIAL,
                 highway_id BIGINT,
                 coord_id   BIGINT,
                 index      INT,
                 size       INT
             );
-        ''')
+        ''' % dict(suffix=suffix))
 
         # Segmented highway
 
         cur.execute('''
-            CREATE TABLE mm_segment (
+            CREATE TABLE mm_segment%(suffix)s (
                 id         BIGSERIAL,
                 highway_id BIGINT,
                 osm_id     BIGINT,
                 highway    VARCHAR(128),
                 name       VARCHAR(1024),
-                oneway     BOOLEAN,
+                oneway     SMALLINT, -- csr.oneway()
                 index      INT,
-                size       INT
+                size       INT,
+
+                -- Measured in UTM 48S (geometry_utm), in meters
+                length     DOUBLE PRECISION,
+                bbox       BOX2D,
+                distances  DOUBLE PRECISION[]
             );
-        ''')
+        ''' % dict(suffix=suffix))
 
         cur.execute('''
-            SELECT AddGeometryColumn('mm_segment', 'geometry', 4326, 'LINESTRING', 2);
-        ''')
+            SELECT AddGeometryColumn('mm_segment%(suffix)s', 'geometry', 4326, 'LINESTRING', 2);
+        ''' % dict(suffix=suffix))
+
+        cur.execute('''
+            SELECT AddGeometryColumn('mm_segment%(suffix)s', 'geometry_utm', %(srid)d, 'LINESTRING', 2);
+        ''' % dict(suffix=suffix, srid=geometry.UTM_SRID))
 
         # Segmented highway coords
 
         cur.execute('''
-            CREATE TABLE mm_segment_coord (
+            CREATE TABLE mm_segment_coord%(suffix)s (
                 id         BIGSERIAL,
                 segment_id BIGINT,
                 coord_id   BIGINT,
                 index      INT,
                 size       INT
             );
-        ''')
-
-        # TODO add index to osm_id
+        ''' % dict(suffix=suffix))
 
     def save(self, c):
-        from psycopg2.extensions import adapt
-        BATCH = 10000
+        """
+        Bulk load the collected data with COPY, in one transaction.
 
-        coord_id_map = {}
-        highway_id_map = {}
-        segment_id_map = {}
+        IDs are assigned here, from the positions of the rows, so the
+        rows linking the tables never wait for the server.
+        """
+        cur = self.conn.cursor()
+        sizes = load_sizes(c)
+
+        for table, columns, rows in LOADS:
+            with instrument.span('Save %s' % table):
+                loader.copy(cur, table, columns, rows(c, 0, sizes[table]))
+
+        for table in ('mm_coord', 'mm_highway', 'mm_segment'):
+            loader.sync_sequence(cur, table)
+
+    def save_parallel(self, c, workers, chunk=CHUNK):
+        """
+        Bulk load the collected data with several worker connections.
+
+        The tables are created with SUFFIX, every table is cut in chunks
+        and the chunks are loaded by a pool of worker processes, each
+        on its own connection. Once everything is loaded the tables
+        replace the current ones in a single transaction (swap()).
+        """
+        global _collector
 
         cur = self.conn.cursor()
+        for table in TABLES:
+            cur.execute('DROP TABLE IF EXISTS %s%s' % (table, self.SUFFIX))
+        self.init(self.SUFFIX)
+        self.conn.commit()
+
+        sizes = load_sizes(c)
+        tasks = [(table, self.SUFFIX, start, min(start + chunk, sizes[table]))
+                 for table, _, _ in LOADS
+                 for start in range(0, sizes[table], chunk)]
+
+        _collector = c
+        pool = multiprocessing.Pool(workers, instrument.reset)
+        try:
+            results = pool.map(load_chunk, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            _collector = None
+
+        stats = defaultdict(lambda: [0, 0, 0.0])
+        for pid, rows, elapsed, totals in results:
+            instrument.merge(totals)
+            stats[pid][0] += 1
+            stats[pid][1] += rows
+            stats[pid][2] += elapsed
+        print 'Workers:'
+        for idx, (pid, (chunks, rows, elapsed)) in \
+                enumerate(sorted(stats.iteritems())):
+            print '- worker %d: %d chunks, %d rows in %.1fs (%.0f rows/s)' \
+                % (idx, chunks, rows, elapsed, rows / elapsed if elapsed else 0)
+
+        for table in ('mm_coord', 'mm_highway', 'mm_segment'):
+            loader.sync_sequence(cur, table + self.SUFFIX)
+
+    def index(self, suffix='', workers=4):
+        """
+        Build the indexes, cluster mm_segment by its spatial index and
+        refresh the statistics.
 
-        # Save coords
+        This runs after the load, building the indexes once is much
+        cheaper than updating them on every row.
+        """
+        cur = self.conn.cursor()
+        cur.execute('SET max_parallel_maintenance_workers = %s', (workers,))
+
+        for idx, (table, column, method) in enumerate(INDEXES):
+            name = index_name(table + suffix, column)
+            with instrument.span('Index %s' % name):
+                cur.execute('CREATE INDEX %s ON %s%s USING %s (%s)'
+                            % (name, table, suffix, method, column))
+
+            # CLUSTER rebuilds the indexes of the table, so do it before
+            # the others are built
+            if idx == 0:
+                with instrument.span('Cluster %s%s' % (table, suffix)):
+                    cur.execute('CLUSTER %s%s USING %s'
+                                % (table, suffix, name))
+
+        for table in TABLES:
+            with instrument.span('Analyze %s%s' % (table, suffix)):
+                cur.execute('ANALYZE %s%s' % (table, suffix))
+
+    def swap(self, suffix=SUFFIX):
+        """
+        Replace the tables with the ones named with suffix.
+        """
+        cur = self.conn.cursor()
+        for table in TABLES:
+            cur.execute('DROP TABLE IF EXISTS %s' % table)
+            cur.execute('ALTER TABLE %s%s RENAME TO %s'
+                        % (table, suffix, table))
+        for table, column, _ in INDEXES:
+            cur.execute('ALTER INDEX %s RENAME TO %s'
+                        % (index_name(table + suffix, column),
+                           index_name(table, column)))
+        self.conn.commit()
 
-        with TimeIt('Save coords'):
-            sql = '''
-                INSERT INTO mm_coord (osm_id, geometry)
-                VALUES %s
-                RETURNING id
-            '''
-
-            def flush(osm_ids, data):
-                if len(data) == 0:
-                    return [], []
+    def apply(self, change):
+        """
+        Apply an osc.Change to the tables.
 
-                params = ['(%s, ST_GeomFromText(%s, 4326))' % tuple([adapt(v).getquoted() for v in values])
-                          for values in data]
-                cur.execute(sql % ', '.join(params))
-
-                coord_ids = []
-                for row in cur:
-                    coord_ids.append(row[0])
-                coord_id_map.update(dict(zip(osm_ids, coord_ids)))
-
-                return [], []
-
-            data = []
-            osm_ids = []
-            for osm_id, coord in c.coords.iteritems():
-                data.append((osm_id, 'POINT(%f %f)' % coord))
-                osm_ids.append(osm_id)
-
-                if len(data) > BATCH:
-                    osm_ids, data = flush(osm_ids, data)
-            flush(osm_ids, data)
+        Only the highways touched by the change are rebuilt: the changed
+        ones, the ones using a moved or deleted coord and the ones
+        sharing a coord with a changed highway, since their
+        intersections may have changed. Their rows are deleted and
+        written again, the coords and highways keep their IDs, the
+        segments get new ones.
 
-        # Save highways
-
-        with TimeIt('Save highways'):
-            sql = '''
-                INSERT INTO mm_highway (osm_id, highway, name, oneway, geometry, segments)
-                VALUES %s
-                RETURNING id
-            '''
-
-            def flush(osm_ids, data):
-                if len(data) == 0:
-                    return [], []
-
-                params = ['(%s, %s, %s, %s, ST_GeomFromText(%s, 4326), %s)' % tuple([adapt(v).getquoted() for v in values])
-                          for values in data]
-                cur.execute(sql % ', '.join(params))
-
-                highway_ids = []
-                for row in cur:
-                    highway_ids.append(row[0])
-                highway_id_map.update(dict(zip(osm_ids, highway_ids)))
-
-                return [], []
-
-            data = []
-            osm_ids = []
-            for osm_id, refs in c.highway_refs.iteritems():
-                tags = c.highway_tags[osm_id]
-                name = tags.get('name', None)
-                highway = tags.get('highway', None)
-                oneway = tags.get('oneway', '') == 'yes'
-
-                coords = ['%f %f' % c.coords[ref] for ref in refs]
-                geometry = 'LINESTRING(%s)' % ', '.join(coords)
-
-                segments = 1
-                if osm_id in c.segment_highway:
-                    segments = len(c.segment_highway[osm_id])
-
-                data.append((osm_id, highway, name, oneway, geometry, segments))
-                osm_ids.append(osm_id)
-
-                if len(data) > BATCH:
-                    osm_ids, data = flush(osm_ids, data)
-            flush(osm_ids, data)
-
-        # Save highway coords
-
-        with TimeIt('Save highway coords'):
-            sql = '''
-                INSERT INTO mm_highway_coord (highway_id, coord_id, index, size)
-                VALUES %s
-            '''
-
-            def flush(data):
-                if len(data) == 0:
-                    return []
-
-                params = ['(%s, %s, %s, %s)' % values
-                          for values in data]
-                cur.execute(sql % ', '.join(params))
-
-                return []
-
-            data = []
-            for osm_id, refs in c.highway_refs.iteritems():
-                highway_id = highway_id_map[osm_id]
-                size = len(refs)
-                for index, ref in enumerate(refs):
-                    coord_id = coord_id_map[ref]
-                    data.append((highway_id, coord_id, index, size))
-
-                if len(data) > BATCH:
-                    data = flush(data)
-            flush(data)
-
-        # Save segments
-
-        with TimeIt('Save segments'):
-            sql = '''
-                INSERT INTO mm_segment (osm_id, highway_id, highway, name, oneway, geometry, index, size)
-                VALUES %s
-                RETURNING id
-            '''
-
-            def flush(osm_ids, data):
-                if len(data) == 0:
-                    return [], []
-
-                params = ['(%s, %s, %s, %s, %s, ST_GeomFromText(%s, 4326), %s, %s)' % tuple([adapt(v).getquoted() for v in values])
-                          for values in data]
-                cur.execute(sql % ', '.join(params))
-
-                segment_ids = []
-                for row in cur:
-                    segment_ids.append(row[0])
-                segment_id_map.update(dict(zip(osm_ids, segment_ids)))
-
-                return [], []
-
-            data = []
-            osm_ids = []
-            for osm_id, refs in c.highway_refs.iteritems():
-                tags = c.highway_tags[osm_id]
-                name = tags.get('name', None)
-                highway = tags.get('highway', None)
-                oneway = tags.get('oneway', '') == 'yes'
-                highway_id = highway_id_map[osm_id]
-
-                if osm_id in c.segment_highway:
-                    size = len(c.segment_highway[osm_id])
-                    for segment_idx in c.segment_highway[osm_id]:
-                        _, index, segment = c.segments[segment_idx]
-
-                        coords = ['%f %f' % c.coords[ref] for ref in segment]
-                        geometry = 'LINESTRING(%s)' % ', '.join(coords)
-
-                        data.append((osm_id, highway_id, highway, name, oneway, geometry, index, size))
-                        osm_ids.append((osm_id, index))
-
-                else:
-                    coords = ['%f %f' % c.coords[ref] for ref in refs]
-                    geometry = 'LINESTRING(%s)' % ', '.join(coords)
-
-                    data.append((osm_id, highway_id, highway, name, oneway, geometry, 0, 1))
-                    osm_ids.append((osm_id, 0))
-
-                if len(data) > BATCH:
-                    osm_ids, data = flush(osm_ids, data)
-            flush(osm_ids, data)
-
-        # Save segment coords
-
-        with TimeIt('Save segment coords'):
-            sql = '''
-                INSERT INTO mm_segment_coord (segment_id, coord_id, index, size)
-                VALUES %s
-            '''
-
-            def flush(data):
-                if len(data) == 0:
-                    return []
-
-                params = ['(%s, %s, %s, %s)' % values
-                          for values in data]
-                cur.execute(sql % ', '.join(params))
-
-                return []
-
-            data = []
-            for osm_id, refs in c.highway_refs.iteritems():
-                if osm_id in c.segment_highway:
-                    size = len(c.segment_highway[osm_id])
-                    for segment_idx in c.segment_highway[osm_id]:
-                        _, index, segment = c.segments[segment_idx]
-                        segment_id = segment_id_map[(osm_id, index)]
-                        size = len(segment)
-                        for ref_idx, ref in enumerate(segment):
-                            coord_id = coord_id_map[ref]
-                            data.append((segment_id, coord_id, ref_idx, size))
-
-                else:
-                    segment_id = segment_id_map[(osm_id, 0)]
-                    size = len(refs)
-                    for index, ref in enumerate(refs):
-                        coord_id = coord_id_map[ref]
-                        data.append((segment_id, coord_id, index, size))
-
-                if len(data) > BATCH:
-                    data = flush(data)
-            flush(data)
-
-def main():
-    c = Collector()
-    p = OSMParser(concurrency=4,
-                  coords_callback=c.collect_coords,
-                  ways_callback=c.collect_highways)
-
-    with TimeIt('Parsing data'):
-        p.parse(sys.argv[1])
-
-    with TimeIt('Cleaning data'):
-        c.clean()
+        Coords used by new highways must be in the change or already in
+        mm_coord, otherwise the highway is incomplete and dropped.
+        """
+        cur = self.conn.cursor()
 
-    with TimeIt('Split segment'):
-        c.split()
+        changed = set(change.ways) | change.deleted_ways
+        new_refs = set()
+        for tags, refs in change.ways.itervalues():
+            if 'highway' in tags:
+                new_refs.update(refs)
 
-    with TimeIt('Store to database'):
+        cur.execute('''
+            SELECT c.osm_id
+            FROM mm_highway h
+            JOIN mm_highway_coord hc ON hc.highway_id = h.id
+            JOIN mm_coord c ON c.id = hc.coord_id
+            WHERE h.osm_id = ANY(%s)
+        ''', (list(changed),))
+        old_refs = set(row[0] for row in cur)
+
+        touched = (old_refs | new_refs | set(change.nodes)
+                   | change.deleted_nodes)
+
+        cur.execute('''
+            SELECT DISTINCT h.osm_id
+            FROM mm_coord c
+            JOIN mm_highway_coord hc ON hc.coord_id = c.id
+            JOIN mm_highway h ON h.id = hc.highway_id
+            WHERE c.osm_id = ANY(%s)
+        ''', (list(touched),))
+        affected = set(row[0] for row in cur) | changed
+
+        print 'Changes:'
+        print '- changed highways:', len(changed)
+        print '- affected highways:', len(affected)
+
+        # Rebuild the affected highways, the unchanged ones are read
+        # back from the tables
+
+        cur.execute('''
+            SELECT h.osm_id, h.highway, h.name, h.oneway,
+                   array_agg(c.osm_id ORDER BY hc.index)
+            FROM mm_highway h
+            JOIN mm_highway_coord hc ON hc.highway_id = h.id
+            JOIN mm_coord c ON c.id = hc.coord_id
+            WHERE h.osm_id = ANY(%s)
+            GROUP BY h.osm_id
+        ''', (list(affected - changed),))
+
+        ways = []
+        for osm_id, highway, name, oneway, refs in cur:
+            tags = dict(highway=highway, oneway=csr.ONEWAY_TAGS[oneway])
+            if name is not None:
+                tags['name'] = name
+            ways.append((osm_id, tags, refs))
+        ways.extend((osm_id, tags, refs)
+                    for osm_id, (tags, refs) in change.ways.iteritems()
+                    if 'highway' in tags)
+
+        refs = set(ref for _, _, way_refs in ways for ref in way_refs)
+        stored = refs - set(change.nodes) - change.deleted_nodes
+
+        c = Collector()
+        c.collect_highways(ways)
+        c.collect_coords([(osm_id, lng, lat)
+                          for osm_id, (lng, lat) in change.nodes.iteritems()
+                          if osm_id in refs])
+        cur.execute('''
+            SELECT osm_id, ST_X(geometry), ST_Y(geometry)
+            FROM mm_coord
+            WHERE osm_id = ANY(%s)
+        ''', (list(stored),))
+        c.collect_coords(cur.fetchall())
+        c.clean()
+
+        # Coords also used by the highways left as they are
+        cur.execute('''
+            SELECT DISTINCT c.osm_id
+            FROM mm_coord c
+            JOIN mm_highway_coord hc ON hc.coord_id = c.id
+            JOIN mm_highway h ON h.id = hc.highway_id
+            WHERE c.osm_id = ANY(%s) AND NOT h.osm_id = ANY(%s)
+        ''', (c.coords.ids.tolist(), list(affected)))
+        c.split(np.array([row[0] for row in cur], dtype=np.int64))
+
+        c.coord_ids = known_ids(cur, 'mm_coord', c.coords.ids)
+        c.highway_ids = known_ids(cur, 'mm_highway', c.highway_refs.ids)
+        c.segment_ids = np.array(loader.next_ids(cur, 'mm_segment',
+                                                 len(c.segment_way)),
+                                 dtype=np.int64)
+
+        with instrument.span('Delete affected rows'):
+            cur.execute('''
+                DELETE FROM mm_segment_coord
+                WHERE segment_id IN (
+                    SELECT id FROM mm_segment WHERE osm_id = ANY(%s))
+            ''', (list(affected),))
+            cur.execute('DELETE FROM mm_segment WHERE osm_id = ANY(%s)',
+                        (list(affected),))
+            cur.execute('''
+                DELETE FROM mm_highway_coord
+                WHERE highway_id IN (
+                    SELECT id FROM mm_highway WHERE osm_id = ANY(%s))
+            ''', (list(affected),))
+            cur.execute('DELETE FROM mm_highway WHERE osm_id = ANY(%s)',
+                        (list(affected),))
+            cur.execute('DELETE FROM mm_coord WHERE osm_id = ANY(%s)',
+                        (c.coords.ids.tolist(),))
+
+        self.save(c)
+
+        # Coords left without highway
+        cur.execute('''
+            DELETE FROM mm_coord c
+            WHERE c.osm_id = ANY(%s)
+              AND NOT EXISTS (SELECT 1 FROM mm_highway_coord hc
+                              WHERE hc.coord_id = c.id)
+        ''', (list(touched),))
+        print '- unused coords:', cur.rowcount
+
+def write_snapshot(c, road, path):
+    """
+    Write the segments, their spatial index and the routing graph to a
+    snapshot file the matcher opens without the database.
+    """
+    from index import SegmentIndex
+    import snapshot
+
+    sizes = c.segment_end - c.segment_start + 1
+    refs = c.highway_refs.refs[waystore.ranges(c.segment_start, sizes)]
+    pos = c.coords.index(refs)
+    coords = c.coords.lookup(refs)
+
+    # Projected and measured by Collector.measure() already
+    osm_ids = c.highway_refs.ids[c.segment_way]
+    index = SegmentIndex.from_xy(c.segment_ids, osm_ids,
+                                 c.segment_vertex_offsets,
+                                 c.coord_x[pos], c.coord_y[pos],
+                                 c.segment_distance, c.segment_length)
+    highway = [c.highway_tags[osm_id].get('highway')
+               for osm_id in osm_ids.tolist()]
+
+    snapshot.write(path, index, coords[:, 0], coords[:, 1], highway,
+                   road['segment_oneway'], road)
+
+def known_ids(cur, table, osm_ids):
+    """
+    IDs of osm_ids in table, new IDs for the ones not there yet.
+    """
+    cur.execute('SELECT osm_id, id FROM %s WHERE osm_id = ANY(%%s)' % table,
+                (osm_ids.tolist(),))
+    found = dict(cur.fetchall())
+    ids = np.array([found.get(osm_id, 0) for osm_id in osm_ids.tolist()],
+                   dtype=np.int64)
+    missing = ids == 0
+    ids[missing] = loader.next_ids(cur, table, int(missing.sum()))
+    return ids
+
+def parse(c, path, two_pass=False, concurrency=4):
+    """
+    Collect the highways and coords of the OSM data file.
+
+    In two passes, the first pass only reads the ways and the second
+    one only keeps the coords used by the collected highways, instead
+    of every coord of the file until clean().
+    """
+    if not two_pass:
+        p = OSMParser(concurrency=concurrency,
+                      coords_callback=c.collect_coords,
+                      ways_callback=c.collect_highways,
+                      ways_tag_filter=c.filter_tags)
+        p.parse(path)
+        return
+
+    p = OSMParser(concurrency=concurrency,
+                  ways_callback=c.collect_highways,
+                  ways_tag_filter=c.filter_tags)
+    with instrument.span('Highways pass'):
+        p.parse(path)
+
+    c.restrict_coords()
+
+    p = OSMParser(concurrency=concurrency,
+                  coords_callback=c.collect_coords)
+    with instrument.span('Coords pass'):
+        p.parse(path)
+
+def collect_tile(path, out, highways, two_pass, concurrency):
+    """
+    Parse and clean one tile, and save the result to the directory out.
+    Run in its own process.
+    """
+    instrument.reset()
+    c = Collector(highways=highways)
+    parse(c, path, two_pass, concurrency)
+    c.clean()
+    c.coords.save(out)
+    c.highway_refs.save(out)
+    with open(os.path.join(out, 'tags.pickle'), 'wb') as f:
+        pickle.dump(c.highway_tags, f, pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(out, 'profile.pickle'), 'wb') as f:
+        pickle.dump(instrument.collect(), f, pickle.HIGHEST_PROTOCOL)
+
+def collect_tiles(c, paths, workers, two_pass=False):
+    """
+    Collect the tiles written by extract/tiles.py into c, parsing and
+    cleaning workers tiles at a time.
+
+    The tiles overlap, so ways crossing a tile border are collected
+    more than once. They are complete in every tile (osmconvert
+    --complete-ways), the duplicates are dropped by osm_id when the
+    stores are finalized.
+    """
+    tmp = tempfile.mkdtemp(prefix='mm-tiles-')
+    concurrency = max(1, multiprocessing.cpu_count() // workers)
+    try:
+        # The parser starts its own processes, so the tiles run in
+        # plain processes instead of a (daemonic) pool
+        outs = []
+        running = []
+        for idx, path in enumerate(paths):
+            while len(running) >= workers:
+                running = wait(running)
+            out = os.path.join(tmp, str(idx))
+            proc = multiprocessing.Process(
+                target=collect_tile,
+                args=(path, out, c.highways, two_pass, concurrency))
+            proc.start()
+            running.append((path, proc))
+            outs.append(out)
+        while running:
+            running = wait(running)
+
+        for out in outs:
+            coords = NodeStore()
+            coords.load(out, mmap_mode=None)
+            c.coords.extend(coords)
+            highway_refs = WayStore()
+            highway_refs.load(out)
+            c.highway_refs.extend(highway_refs)
+            with open(os.path.join(out, 'tags.pickle'), 'rb') as f:
+                c.highway_tags.update(pickle.load(f))
+            with open(os.path.join(out, 'profile.pickle'), 'rb') as f:
+                instrument.merge(pickle.load(f))
+    finally:
+        shutil.rmtree(tmp)
+
+def wait(running):
+    """
+    Wait until one of the (path, process) has exited, return the
+    others.
+    """
+    while True:
+        for path, proc in running:
+            if proc.is_alive():
+                continue
+            proc.join()
+            if proc.exitcode != 0:
+                raise RuntimeError('Failed to collect %s' % path)
+            return [item for item in running if item[1] is not proc]
+        time.sleep(0.1)
+
+def write_mm(c, args):
+    """
+    Create, fill and index the mm_* tables.
+    """
+    with instrument.span('Store to database'):
         db = DB()
         db.connect()
-        db.init()
-        db.save(c)
+        if args.workers > 1:
+            db.save_parallel(c, args.workers)
+        else:
+            db.init()
+            db.save(c)
+
+    with instrument.span('Build indexes'):
+        if args.workers > 1:
+            db.index(db.SUFFIX, args.workers)
+            db.swap()
+        else:
+            db.index()
         db.close()
 
+# Writer of every schema, called with the cleaned collector and the
+# options. The collector is split first when mm is written.
+WRITERS = dict(mm=write_mm, raw=raw.write)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', nargs='+',
+                        help='OSM data file, or the tiles written by '
+                             'extract/tiles.py')
+    parser.add_argument('--schema', choices=sorted(WRITERS),
+                        action='append',
+                        help='tables to write, repeat it to write both '
+                             'from a single parse: mm (segmented, the '
+                             'default) or raw (new_osm_*)')
+    parser.add_argument('--graph', metavar='DIR',
+                        help='also write the routing graph to DIR')
+    parser.add_argument('--highways', metavar='CLASSES',
+                        help='keep only these highway classes, comma '
+                             'separated (default: all of them)')
+    parser.add_argument('--tile-workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='parse and clean this many tiles at a time')
+    parser.add_argument('--two-pass', action='store_true',
+                        help='read the highways first, then only their '
+                             'coords: parses the input twice but holds '
+                             'much less in memory')
+    parser.add_argument('--spill', metavar='DIR',
+                        help='sort the node coordinates in runs on disk '
+                             'in DIR and keep them memory-mapped')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='load the tables with this many parallel '
+                             'connections, then swap them in at once')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='also write the segments, their index and the '
+                             'routing graph to FILE for offline matching')
+    parser.add_argument('--diff', action='store_true',
+                        help='input is an OSM change file (.osc) to apply '
+                             'to the tables of a previous import')
+    instrument.add_arguments(parser, default='table')
+    args = parser.parse_args(argv)
+
+    schemas = []
+    for schema in args.schema or ['mm']:
+        if schema not in schemas:
+            schemas.append(schema)
+
+    if args.diff:
+        if len(args.input) > 1:
+            parser.error('--diff applies a single change file')
+        if args.graph or args.snapshot:
+            parser.error('--graph and --snapshot need a full import')
+        if schemas != ['mm']:
+            parser.error('--diff only updates the mm schema')
+
+    instrument.setup(args)
+
+    if args.diff:
+        with instrument.span('Parsing changes'):
+            change = osc.parse(args.input[0])
+
+        with instrument.span('Apply changes'):
+            db = DB()
+            db.connect()
+            db.apply(change)
+            db.close()
+        return
+
+    highways = args.highways.split(',') if args.highways else None
+    c = Collector(args.spill, highways)
+    if len(args.input) > 1:
+        with instrument.span('Parsing tiles', tiles=len(args.input)):
+            collect_tiles(c, args.input, args.tile_workers, args.two_pass)
+    else:
+        with instrument.span('Parsing data'):
+            parse(c, args.input[0], args.two_pass)
+
+    with instrument.span('Cleaning data'):
+        c.clean()
+
+    if 'mm' in schemas or args.graph or args.snapshot:
+        with instrument.span('Split segment'):
+            c.split()
+
+    for schema in schemas:
+        WRITERS[schema](c, args)
+
+    if args.graph or args.snapshot:
+        with instrument.span('Build graph'):
+            road = csr.build(c)
+            if args.graph:
+                csr.save(road, args.graph)
+
+    if args.snapshot:
+        with instrument.span('Write snapshot'):
+            write_snapshot(c, road, args.snapshot)
+
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,125 @@
+"""
+Bulk loading with COPY FROM STDIN.
+
+Rows come from generators and are streamed to the server in the COPY
+text format, so no batch lists or SQL strings are built in memory.
+Geometries are written as hex EWKB, which PostGIS reads without parsing
+any text coordinates. IDs are assigned by the caller, so nothing has to
+be read back.
+"""
+
+import binascii
+import struct
+
+import instrument
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_SRID = 0x20000000
+
+SRID = 4326
+
+def ewkb_point(lng, lat, srid=SRID):
+    return binascii.hexlify(struct.pack('<BIIdd', 1, WKB_POINT | WKB_SRID,
+                                        srid, lng, lat))
+
+def ewkb_linestring(coords, srid=SRID):
+    """
+    coords is a sequence of (lng, lat), or an (n, 2) array.
+    """
+    size = len(coords)
+    header = struct.pack('<BIII', 1, WKB_LINESTRING | WKB_SRID, srid, size)
+    if hasattr(coords, 'tobytes'):
+        body = coords.astype('<f8').tobytes()
+    else:
+        body = struct.pack('<%dd' % (size * 2),
+                           *[v for coord in coords for v in coord])
+    return binascii.hexlify(header + body)
+
+def float_array(values, precision=3):
+    """
+    COPY text of a DOUBLE PRECISION[] of values.
+    """
+    return '{%s}' % ','.join('%.*f' % (precision, v) for v in values)
+
+def box2d(min_x, min_y, max_x, max_y, precision=3):
+    return 'BOX(%.*f %.*f,%.*f %.*f)' % (precision, min_x, precision, min_y,
+                                         precision, max_x, precision, max_y)
+
+def escape(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    return (value.replace('\\', '\\\\')
+                 .replace('\t', '\\t')
+                 .replace('\n', '\\n')
+                 .replace('\r', '\\r'))
+
+class RowFile(object):
+    """
+    Read-only file object over a row generator, in COPY text format.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+        self.size = 0
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            line = '\t'.join([escape(v) for v in row]) + '\n'
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+            self.size += len(line)
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+def copy(cur, table, columns, rows, size=1 << 16):
+    """
+    COPY the rows into table. Return the number of rows.
+
+    The rows and bytes are also added to the running instrument span.
+    """
+    f = RowFile(rows)
+    cur.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)),
+                    f, size)
+    instrument.add(rows=f.count, bytes=f.size)
+    return f.count
+
+def sync_sequence(cur, table, column='id'):
+    """
+    Move the serial sequence past the client assigned IDs.
+    """
+    cur.execute('''
+        SELECT setval(pg_get_serial_sequence(%%s, %%s),
+                      COALESCE((SELECT MAX(%s) FROM %s), 0) + 1,
+                      false)
+        ''' % (column, table), (table, column))
+
+def next_ids(cur, table, count, column='id'):
+    """
+    Take count new IDs from the serial sequence of table.
+    """
+    cur.execute('''
+        SELECT nextval(pg_get_serial_sequence(%s, %s))
+        FROM generate_series(1, %s)
+        ''', (table, column, count))
+    return [row[0] for row in cur]
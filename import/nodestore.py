@@ -0,0 +1,288 @@
+"""
+Compact storage of OSM node coordinates.
+
+A dict of osm_id -> (lng, lat) tuples costs well over 100 bytes per
+node. NodeStore keeps the nodes in three flat arrays (int64 ids,
+float64 lng and lat, 24 bytes per node), sorted by id once all nodes are
+collected, and looks nodes up with a vectorized binary search.
+"""
+
+import os
+
+import numpy as np
+
+class NodeStore(object):
+    """
+    Sorted arrays of node ids and coordinates.
+
+    Nodes are added in chunks with add() and become searchable after
+    finalize().
+
+    When a spill directory is given, the added nodes are buffered up to
+    SPILL nodes, then sorted and written there as a run. finalize()
+    merges the runs BLOCK nodes at a time into memory-mapped output
+    files, so the nodes are never all in memory at once, and keep()
+    filters them the same way into new files. A file is never written
+    again once it is mapped.
+
+    After restrict(), add() drops the nodes that are not members.
+    """
+
+    SPILL = 1 << 22
+    BLOCK = 1 << 22
+
+    def __init__(self, spill=None):
+        self.spill = spill
+        self.members = None
+        self.chunks = []
+        self.buffered = 0
+        # Sorted runs written to the spill directory and the files of
+        # the current arrays, when they are ours
+        self.runs = []
+        self.files = 0
+        self.owned = []
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.lng = np.zeros(0, dtype=np.float64)
+        self.lat = np.zeros(0, dtype=np.float64)
+        if spill and not os.path.exists(spill):
+            os.makedirs(spill)
+
+    def add(self, nodes):
+        """
+        Add a chunk of (osm_id, lng, lat).
+        """
+        size = len(nodes)
+        if size == 0:
+            return
+        ids = np.fromiter((node[0] for node in nodes), np.int64, size)
+        lng = np.fromiter((node[1] for node in nodes), np.float64, size)
+        lat = np.fromiter((node[2] for node in nodes), np.float64, size)
+        if self.members is not None:
+            mask = self.is_member(ids)
+            ids = ids[mask]
+            lng = lng[mask]
+            lat = lat[mask]
+        self.append(ids, lng, lat)
+
+    def extend(self, other):
+        """
+        Add the finalized nodes of another store as a chunk.
+        """
+        self.append(other.ids, other.lng, other.lat)
+
+    def append(self, ids, lng, lat):
+        self.chunks.append((ids, lng, lat))
+        self.buffered += len(ids)
+        if self.spill and self.buffered >= self.SPILL:
+            self.write_run()
+
+    def write_run(self):
+        """
+        Sort the buffered chunks and write them to the spill directory
+        as a run.
+        """
+        if not self.chunks:
+            return
+        ids, lng, lat = merge(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+
+        paths = self.paths()
+        for path, values in zip(paths, (ids, lng, lat)):
+            values.tofile(path)
+        self.runs.append(paths)
+
+    def paths(self):
+        """
+        New file names for the ids, lng and lat arrays.
+        """
+        self.files += 1
+        return [os.path.join(self.spill, 'node-%d-%s.bin' % (self.files,
+                                                            name))
+                for name in ('ids', 'lng', 'lat')]
+
+    def map(self, paths):
+        arrays = []
+        for path, dtype in zip(paths, (np.int64, np.float64, np.float64)):
+            if os.path.getsize(path):
+                arrays.append(np.memmap(path, dtype=dtype, mode='r'))
+            else:
+                arrays.append(np.zeros(0, dtype=dtype))
+        return tuple(arrays)
+
+    def remove(self, paths):
+        """
+        Delete spill files. Their mappings stay valid.
+        """
+        for path in paths:
+            os.remove(path)
+
+    def restrict(self, osm_ids):
+        """
+        Only add the nodes of osm_ids from now on.
+
+        The members are kept as a sorted array of unique ids, 8 bytes
+        per member, and tested with a binary search.
+        """
+        self.members = np.unique(np.asarray(osm_ids, dtype=np.int64))
+
+    def is_member(self, ids):
+        if len(self.members) == 0:
+            return np.zeros(len(ids), dtype=bool)
+        pos = np.searchsorted(self.members, ids)
+        pos[pos == len(self.members)] = 0
+        return self.members[pos] == ids
+
+    def finalize(self):
+        """
+        Merge the added chunks and sort them by id.
+        """
+        if not self.chunks and not self.runs:
+            return
+        if not self.spill:
+            chunks = [(self.ids, self.lng, self.lat)] + self.chunks
+            self.chunks = []
+            self.buffered = 0
+            self.ids, self.lng, self.lat = merge(chunks)
+            return
+
+        self.write_run()
+        chunks = [(self.ids, self.lng, self.lat)]
+        chunks.extend(self.map(paths) for paths in self.runs)
+
+        # Every run is sorted and unique, pull the next BLOCK nodes of
+        # all of them at a time, the nodes up to the smallest of their
+        # BLOCK / runs-th next ids
+        chunks = [chunk for chunk in chunks if len(chunk[0])]
+        step = max(self.BLOCK // max(len(chunks), 1), 1)
+        starts = [0] * len(chunks)
+        paths = self.paths()
+        with open(paths[0], 'wb') as ids_file, \
+                open(paths[1], 'wb') as lng_file, \
+                open(paths[2], 'wb') as lat_file:
+            while True:
+                current = [i for i, chunk in enumerate(chunks)
+                           if starts[i] < len(chunk[0])]
+                if not current:
+                    break
+                last = min(chunks[i][0][min(starts[i] + step,
+                                            len(chunks[i][0])) - 1]
+                           for i in current)
+                block = []
+                for i in current:
+                    ids = chunks[i][0]
+                    end = starts[i] + int(np.searchsorted(
+                        ids[starts[i]:starts[i] + step], last,
+                        side='right'))
+                    block.append(tuple(values[starts[i]:end]
+                                       for values in chunks[i]))
+                    starts[i] = end
+
+                ids, lng, lat = merge(block)
+                ids.tofile(ids_file)
+                lng.tofile(lng_file)
+                lat.tofile(lat_file)
+
+        self.remove(self.owned)
+        for run in self.runs:
+            self.remove(run)
+        self.runs = []
+        self.owned = paths
+        self.ids, self.lng, self.lat = self.map(paths)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('ids', 'lng', 'lat'):
+            np.save(os.path.join(path, 'node_%s.npy' % name),
+                    getattr(self, name))
+
+    def load(self, path, mmap_mode='r'):
+        self.owned = []
+        for name in ('ids', 'lng', 'lat'):
+            setattr(self, name,
+                    np.load(os.path.join(path, 'node_%s.npy' % name),
+                            mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, osm_ids):
+        """
+        Position of every osm_id in the store, -1 when missing.
+        """
+        osm_ids = np.asarray(osm_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.full(osm_ids.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(self.ids, osm_ids)
+        pos[pos == len(self.ids)] = 0
+        return np.where(self.ids[pos] == osm_ids, pos, -1)
+
+    def contains(self, osm_ids):
+        return self.index(osm_ids) >= 0
+
+    def used(self, osm_ids):
+        """
+        Mask of the stored nodes that are in osm_ids, a sorted array of
+        unique ids. The store is read BLOCK nodes at a time, so a spilled
+        store is not loaded into memory.
+        """
+        mask = np.zeros(len(self.ids), dtype=bool)
+        for start in range(0, len(self.ids), self.BLOCK):
+            ids = np.asarray(self.ids[start:start + self.BLOCK])
+            # Only the osm_ids in the range of the block
+            lo, hi = np.searchsorted(osm_ids, [ids[0], ids[-1]])
+            mask[start:start + len(ids)] = np.in1d(
+                ids, osm_ids[lo:hi + 1], assume_unique=True)
+        return mask
+
+    def lookup(self, osm_ids):
+        """
+        (n, 2) array of the lng, lat of osm_ids, which must all exist.
+        """
+        pos = self.index(osm_ids)
+        assert (pos >= 0).all(), 'Unknown node'
+        return np.column_stack((self.lng[pos], self.lat[pos]))
+
+    def keep(self, mask):
+        """
+        Keep only the nodes where mask is True.
+        """
+        if not self.spill:
+            self.ids = self.ids[mask]
+            self.lng = self.lng[mask]
+            self.lat = self.lat[mask]
+            return
+
+        old = (self.ids, self.lng, self.lat)
+        paths = self.paths()
+        files = [open(path, 'wb') for path in paths]
+        try:
+            for start in range(0, len(mask), self.BLOCK):
+                kept = mask[start:start + self.BLOCK]
+                for f, values in zip(files, old):
+                    values[start:start + self.BLOCK][kept].tofile(f)
+        finally:
+            for f in files:
+                f.close()
+
+        self.remove(self.owned)
+        self.owned = paths
+        self.ids, self.lng, self.lat = self.map(paths)
+
+def merge(chunks):
+    """
+    Concatenate chunks of (ids, lng, lat) and sort them by id, dropping
+    the duplicates: the node of the last chunk wins.
+    """
+    ids = np.concatenate([chunk[0] for chunk in chunks])
+    order = np.argsort(ids, kind='mergesort')
+    ids = ids[order]
+
+    last = np.ones(len(ids), dtype=bool)
+    last[:-1] = ids[1:] != ids[:-1]
+    order = order[last]
+
+    return (ids[last],
+            np.concatenate([chunk[1] for chunk in chunks])[order],
+            np.concatenate([chunk[2] for chunk in chunks])[order])
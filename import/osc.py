@@ -0,0 +1,83 @@
+"""
+Reader of OSM change files (.osc, .osc.gz).
+
+A change file lists the nodes and ways created, modified and deleted
+since a previous extract. Only the final state of every element is kept,
+a later action on the same element replaces an earlier one. Relations
+are ignored.
+"""
+
+import gzip
+from xml.etree.cElementTree import iterparse
+
+class Change(object):
+    """
+    Final state of the changed elements.
+
+    - nodes: osm_id -> (lng, lat) of the created or modified nodes
+    - ways: osm_id -> (tags, refs) of the created or modified ways
+    - deleted_nodes, deleted_ways: osm ids of the deleted elements
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.ways = {}
+        self.deleted_nodes = set()
+        self.deleted_ways = set()
+
+    def add_node(self, action, osm_id, lng, lat):
+        if action == 'delete':
+            self.nodes.pop(osm_id, None)
+            self.deleted_nodes.add(osm_id)
+        else:
+            self.nodes[osm_id] = (lng, lat)
+            self.deleted_nodes.discard(osm_id)
+
+    def add_way(self, action, osm_id, tags, refs):
+        if action == 'delete':
+            self.ways.pop(osm_id, None)
+            self.deleted_ways.add(osm_id)
+        else:
+            self.ways[osm_id] = (dict(tags), list(refs))
+            self.deleted_ways.discard(osm_id)
+
+def parse(path):
+    """
+    Read the change file at path into a Change.
+    """
+    change = Change()
+    f = gzip.open(path) if path.endswith('.gz') else open(path, 'rb')
+
+    action = None
+    tags = {}
+    refs = []
+    for event, elem in iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem.tag
+            elif elem.tag in ('node', 'way', 'relation'):
+                # The tags and refs read until the end of this element
+                # are its own
+                tags = {}
+                refs = []
+            continue
+
+        if elem.tag == 'tag':
+            tags[elem.get('k')] = elem.get('v')
+        elif elem.tag == 'nd':
+            refs.append(int(elem.get('ref')))
+        elif elem.tag == 'node':
+            lng = elem.get('lon')
+            lat = elem.get('lat')
+            change.add_node(action, int(elem.get('id')),
+                            float(lng) if lng else None,
+                            float(lat) if lat else None)
+            elem.clear()
+        elif elem.tag == 'way':
+            change.add_way(action, int(elem.get('id')), tags, refs)
+            elem.clear()
+        elif elem.tag == 'relation':
+            elem.clear()
+
+    f.close()
+    return change
@@ -0,0 +1,144 @@
+"""
+Writer of the raw schema: the new_osm_* tables.
+
+The nodes and ways are written as they are after cleaning, without
+splitting the ways. The rows are read from the same Collector as the
+mm_* tables, see import.py --schema.
+"""
+
+import instrument
+import loader
+
+DB_CONFIG = dict(host='localhost',
+                 user='angkot',
+                 password='angkot',
+                 dbname='angkot_osm_jakarta')
+
+class DB(object):
+    def connect(self):
+        self.conn = instrument.connect(**DB_CONFIG)
+
+    def close(self):
+        self.conn.commit()
+
+    def init(self):
+        cur = self.conn.cursor()
+
+        # Nodes
+
+        cur.execute('''
+            CREATE TABLE new_osm_node (
+                id       BIGSERIAL,
+                osm_id   BIGINT PRIMARY KEY,
+
+                created  TIMESTAMP DEFAULT NOW(),
+                updated  TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+
+        cur.execute('''
+            SELECT AddGeometryColumn('new_osm_node', 'coord', 4326, 'POINT', 2);
+        ''')
+
+        # Way
+
+        cur.execute('''
+            CREATE TABLE new_osm_way (
+                id       BIGSERIAL,
+                osm_id   BIGINT PRIMARY KEY,
+
+                name     VARCHAR(1024),
+                highway  VARCHAR(128),
+                oneway   BOOLEAN DEFAULT FALSE,
+
+                created  TIMESTAMP DEFAULT NOW(),
+                updated  TIMESTAMP DEFAULT NOW()
+            );
+        ''')
+
+        cur.execute('''
+            SELECT AddGeometryColumn('new_osm_way', 'path', 4326, 'LINESTRING', 2);
+        ''')
+
+        # Way nodes
+
+        cur.execute('''
+            CREATE TABLE new_osm_waynode (
+                id       BIGSERIAL,
+                way_id   BIGINT,
+                node_id  BIGINT,
+                index    INT,
+                size     INT
+            );
+        ''')
+
+        # TODO add index to osm_id
+
+    def save(self, c):
+        """
+        Bulk load the collected data with COPY.
+
+        The ID of a node or a way is its position in the collector plus
+        one.
+        """
+        cur = self.conn.cursor()
+
+        # Save nodes
+
+        with instrument.span('Save nodes'):
+            def rows():
+                ids = c.coords.ids.tolist()
+                lngs = c.coords.lng.tolist()
+                lats = c.coords.lat.tolist()
+                for idx, osm_id in enumerate(ids):
+                    yield (idx + 1, osm_id,
+                           loader.ewkb_point(lngs[idx], lats[idx]))
+
+            loader.copy(cur, 'new_osm_node', ('id', 'osm_id', 'coord'), rows())
+
+        # Save ways
+
+        with instrument.span('Save ways'):
+            def rows():
+                for idx, (osm_id, refs) in \
+                        enumerate(c.highway_refs.iteritems()):
+                    tags = c.highway_tags[osm_id]
+                    name = tags.get('name', None)
+                    highway = tags.get('highway', None)
+                    oneway = tags.get('oneway', '') == 'yes'
+
+                    path = loader.ewkb_linestring(c.coords.lookup(refs))
+
+                    yield idx + 1, osm_id, name, highway, oneway, path
+
+            loader.copy(cur, 'new_osm_way',
+                        ('id', 'osm_id', 'name', 'highway', 'oneway', 'path'),
+                        rows())
+
+        # Save way nodes
+
+        with instrument.span('Save way nodes'):
+            def rows():
+                for idx, (osm_id, refs) in \
+                        enumerate(c.highway_refs.iteritems()):
+                    size = len(refs)
+                    node_ids = (c.coords.index(refs) + 1).tolist()
+                    for index, node_id in enumerate(node_ids):
+                        yield idx + 1, node_id, index, size
+
+            loader.copy(cur, 'new_osm_waynode',
+                        ('way_id', 'node_id', 'index', 'size'), rows())
+
+        for table in ('new_osm_node', 'new_osm_way'):
+            loader.sync_sequence(cur, table)
+
+def write(c, args):
+    """
+    Create and fill the new_osm_* tables.
+    """
+    with instrument.span('Store raw tables'):
+        db = DB()
+        db.connect()
+        db.init()
+        db.save(c)
+        db.close()
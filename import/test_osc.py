@@ -0,0 +1,60 @@
+"""
+Tests of the change file reader, run with:
+
+    python -m unittest test_osc
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import osc
+
+CHANGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify>
+    <way id="10">
+      <nd ref="1"/>
+      <nd ref="2"/>
+      <tag k="highway" v="residential"/>
+    </way>
+    <relation id="20">
+      <member type="way" ref="10" role=""/>
+      <tag k="type" v="route"/>
+      <tag k="name" v="Koridor 1"/>
+    </relation>
+    <way id="11">
+      <nd ref="3"/>
+      <nd ref="4"/>
+      <tag k="building" v="yes"/>
+    </way>
+    <node id="5" lat="-6.2" lon="106.8">
+      <tag k="highway" v="traffic_signals"/>
+    </node>
+  </modify>
+</osmChange>
+"""
+
+class ParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'change.osc')
+        with open(self.path, 'wb') as f:
+            f.write(CHANGE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_relation_after_way(self):
+        change = osc.parse(self.path)
+        self.assertEqual(change.ways[10], ({'highway': 'residential'}, [1, 2]))
+
+    def test_node_after_way(self):
+        change = osc.parse(self.path)
+        self.assertEqual(change.ways[11], ({'building': 'yes'}, [3, 4]))
+        self.assertEqual(change.nodes[5], (106.8, -6.2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Compact storage of OSM way node references.
+
+All refs of all ways are kept in one flat int64 array. The refs of way i
+are refs[offsets[i]:offsets[i + 1]]. Ways are sorted by id once all of
+them are collected.
+"""
+
+from itertools import chain
+import os
+
+import numpy as np
+
+class WayStore(object):
+    """
+    Flat arrays of way ids, ref offsets and refs.
+
+    Ways are added in chunks with add() and become usable after
+    finalize().
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.refs = np.zeros(0, dtype=np.int64)
+
+    def add(self, ways):
+        """
+        Add a chunk of (osm_id, refs).
+        """
+        if not ways:
+            return
+        ids = np.fromiter((osm_id for osm_id, _ in ways), np.int64, len(ways))
+        sizes = np.fromiter((len(refs) for _, refs in ways), np.int64,
+                            len(ways))
+        refs = np.fromiter(chain.from_iterable(refs for _, refs in ways),
+                           np.int64, int(sizes.sum()))
+        self.chunks.append((ids, sizes, refs))
+
+    def extend(self, other):
+        """
+        Add the finalized ways of another store as a chunk.
+        """
+        self.chunks.append((other.ids, other.sizes(), other.refs))
+
+    def finalize(self):
+        """
+        Merge the added chunks and sort the ways by id.
+        """
+        if not self.chunks:
+            return
+        chunks = [(self.ids, self.sizes(), self.refs)] + self.chunks
+        self.chunks = []
+
+        ids = np.concatenate([chunk[0] for chunk in chunks])
+        sizes = np.concatenate([chunk[1] for chunk in chunks])
+        refs = np.concatenate([chunk[2] for chunk in chunks])
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+
+        order = np.argsort(ids, kind='mergesort')
+        ids = ids[order]
+
+        # Drop duplicates, the last added way wins
+        last = np.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        order = order[last]
+
+        self.ids = ids[last]
+        self.refs = refs[ranges(offsets[:-1][order], sizes[order])]
+        self.offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(sizes[order], out=self.offsets[1:])
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('ids', 'offsets', 'refs'):
+            np.save(os.path.join(path, 'way_%s.npy' % name),
+                    getattr(self, name))
+
+    def load(self, path, mmap_mode=None):
+        for name in ('ids', 'offsets', 'refs'):
+            setattr(self, name,
+                    np.load(os.path.join(path, 'way_%s.npy' % name),
+                            mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def way_index(self):
+        """
+        The way of every ref.
+        """
+        return np.repeat(np.arange(len(self.ids)), self.sizes())
+
+    def get(self, i):
+        return self.refs[self.offsets[i]:self.offsets[i + 1]]
+
+    def iteritems(self):
+        """
+        Iterate over (osm_id, refs).
+        """
+        offsets = self.offsets.tolist()
+        for i, osm_id in enumerate(self.ids.tolist()):
+            yield osm_id, self.refs[offsets[i]:offsets[i + 1]]
+
+    def keep(self, mask):
+        """
+        Keep only the ways where mask is True.
+        """
+        sizes = self.sizes()[mask]
+        self.refs = self.refs[np.repeat(mask, self.sizes())]
+        self.ids = self.ids[mask]
+        self.offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+
+def ranges(starts, sizes):
+    """
+    Concatenation of arange(start, start + size) for every pair.
+    """
+    first = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=first[1:])
+    return (np.arange(sizes.sum(), dtype=np.int64)
+            - np.repeat(first - starts, sizes))
+
+def clean(nodes, ways):
+    """
+    Remove the unused nodes and the incomplete ways.
+
+    A way is incomplete when it uses an unknown node or has less than
+    two nodes. Return the statistics and the ids of the removed ways.
+    """
+    refs = np.unique(ways.refs)
+    available = nodes.ids
+
+    valid = nodes.contains(refs)
+    used = nodes.used(refs)
+
+    missing = ~nodes.contains(ways.refs)
+    sizes = ways.sizes()
+    incomplete = np.bincount(ways.way_index()[missing],
+                             minlength=len(ways)) > 0
+    incomplete |= sizes <= 1
+
+    stats = dict(available=len(available),
+                 referenced=len(refs),
+                 invalid=int((~valid).sum()),
+                 valid=int(valid.sum()),
+                 unused=int((~used).sum()),
+                 incomplete=int(incomplete.sum()),
+                 refs=int(sizes.sum()))
+
+    removed = ways.ids[incomplete]
+    nodes.keep(used)
+    ways.keep(~incomplete)
+    return stats, removed
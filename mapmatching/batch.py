@@ -0,0 +1,216 @@
+"""
+Match many trace files at once.
+
+The road index is built (or loaded) once and saved as .npy files, or
+read from a snapshot written by import.py. Every worker process
+memory-maps the same files, so the index is shared through the page
+cache instead of being loaded once per worker.
+
+Results are written by the parent process to a sink: one file per trace
+in a directory, or JSON lines to a single file (or stdout).
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from downsample import DownSampler
+from graph import RoadGraph
+from hmm import HMM
+from index import SegmentIndex
+import instrument
+from snapshot import Snapshot
+import traces
+
+# Per worker process state, set up by init()
+worker = {}
+
+def init(index_path, graph_path, options):
+    instrument.reset()
+    if options['snapshot']:
+        snapshot = Snapshot(options['snapshot'])
+        worker['index'] = snapshot.index
+    else:
+        worker['index'] = SegmentIndex.load(index_path)
+    worker['hmm'] = None
+    if options['matcher'] == 'hmm':
+        if options['snapshot']:
+            road = snapshot.graph
+        else:
+            road = RoadGraph.load(graph_path) if graph_path else None
+        worker['hmm'] = HMM(graph=road)
+    worker['options'] = options
+
+def match_file(path):
+    """
+    Return the path, the number of points, the rows, the time spent
+    matching and the profile of the worker (instrument.collect()).
+    """
+    start = time.time()
+    options = worker['options']
+    coords = traces.read_trace(path)
+    ds = DownSampler(options['min_distance'], options['max_interval'],
+                     options['min_turn'])
+    points = traces.downsample(coords, ds)
+
+    hmm = worker['hmm']
+    k = options['k'] if hmm is not None else 1
+    cand, matched = traces.match(points, worker['index'].candidates, k,
+                                 hmm)
+    rows = traces.rows(points, cand, matched)
+    return (path, len(coords), rows, time.time() - start,
+            instrument.collect())
+
+def list_traces(source):
+    """
+    A directory of trace files or a manifest with one path per line.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name)
+                      for name in os.listdir(source)
+                      if not name.startswith('.'))
+
+    base = os.path.dirname(source)
+    paths = []
+    for line in open(source):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            paths.append(os.path.join(base, line))
+    return paths
+
+def common_root(paths):
+    """
+    Deepest directory containing all paths.
+    """
+    parts = [os.path.dirname(os.path.abspath(path)).split(os.sep)
+             for path in paths]
+    return os.sep.join(os.path.commonprefix(parts)) or os.sep
+
+class DirectorySink(object):
+    """
+    One tab separated file per trace:
+    lng, lat, segment_id, osm_id, matched lng, matched lat
+
+    The files keep the paths of the traces relative to root, so traces
+    with the same name in different directories do not overwrite each
+    other.
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def write(self, trace, rows):
+        name = os.path.relpath(os.path.abspath(trace), self.root)
+        output = os.path.join(self.path, name)
+        if not os.path.exists(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        with open(output, 'w') as f:
+            for row in rows:
+                f.write('\t'.join('' if v is None else str(v)
+                                  for v in row) + '\n')
+
+    def close(self):
+        pass
+
+class JSONLinesSink(object):
+    """
+    One JSON object per trace.
+    """
+
+    def __init__(self, path):
+        self.f = sys.stdout if path == '-' else open(path, 'w')
+
+    def write(self, trace, rows):
+        self.f.write(json.dumps(dict(trace=trace, points=rows)) + '\n')
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('traces',
+                        help='directory of trace files or manifest file '
+                             'with one trace path per line')
+    parser.add_argument('output',
+                        help='output directory, or a .jsonl file '
+                             '(- for stdout)')
+    parser.add_argument('--index', metavar='DIR',
+                        help='saved road index; built from the database '
+                             '(and saved here when given) when missing')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    traces.add_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.lookup == 'db':
+        parser.error('batch matching only supports --lookup=index')
+
+    paths = list_traces(args.traces)
+
+    index_path = args.index
+    cleanup = None
+    if args.snapshot is None and (index_path is None
+                                  or not os.path.exists(index_path)):
+        with instrument.span('Load index'):
+            conn = instrument.connect(**traces.DB_CONFIG)
+            index = SegmentIndex.from_db(conn.cursor())
+            conn.close()
+        if index_path is None:
+            index_path = cleanup = tempfile.mkdtemp(prefix='mm-index-')
+        index.save(index_path)
+        del index
+
+    if args.output == '-' or args.output.endswith('.jsonl'):
+        sink = JSONLinesSink(args.output)
+    else:
+        sink = DirectorySink(args.output, common_root(paths))
+
+    options = dict(matcher=args.matcher, k=args.k, snapshot=args.snapshot,
+                   min_distance=args.min_distance,
+                   max_interval=args.max_interval,
+                   min_turn=args.min_turn)
+
+    start = time.time()
+    total_points = 0
+    total_kept = 0
+    pool = multiprocessing.Pool(args.workers, init,
+                                (index_path, args.graph, options))
+    try:
+        for idx, (trace, points, rows, elapsed, totals) in enumerate(
+                pool.imap_unordered(match_file, paths)):
+            # Timed in the worker, the workers do not report themselves
+            instrument.merge(totals)
+            traces.observe(elapsed, len(rows))
+            sink.write(trace, rows)
+            total_points += points
+            total_kept += len(rows)
+            print >>sys.stderr, idx + 1, '/', len(paths), '=>', trace
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        sink.close()
+        if cleanup:
+            shutil.rmtree(cleanup)
+
+    elapsed = time.time() - start
+    print >>sys.stderr, 'Traces:', len(paths)
+    print >>sys.stderr, 'Points:', total_points, \
+        '(%.1f points/sec)' % (total_points / elapsed if elapsed else 0)
+    print >>sys.stderr, 'Downsampled points:', total_kept, \
+        '(%.1f points/sec)' % (total_kept / elapsed if elapsed else 0)
+    print >>sys.stderr, 'Time: %.2fs' % elapsed
+
+if __name__ == '__main__':
+    main()
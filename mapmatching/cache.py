@@ -0,0 +1,56 @@
+"""
+Segment geometry cache.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+import geometry
+
+class SegmentCache(object):
+    """
+    Size bounded LRU cache of segment geometries.
+
+    Geometries are fetched in bulk as WKB and kept as (n, 2) arrays of
+    lng, lat.
+    """
+
+    SIZE = 10000
+
+    def __init__(self, c, size=SIZE):
+        self.c = c
+        self.size = size
+        self.items = OrderedDict()
+
+    def prefetch(self, segment_ids):
+        """
+        Load the missing geometries of segment_ids with one query.
+        """
+        missing = sorted(set(int(segment_id) for segment_id in segment_ids
+                             if segment_id not in self.items))
+        if not missing:
+            return
+
+        self.c.execute('''
+            SELECT id, ST_AsBinary(geometry)
+            FROM mm_segment
+            WHERE id = ANY(%s)
+            ''', (missing,))
+        for segment_id, wkb in self.c:
+            # Copy, the WKB buffer is not ours to keep
+            self.put(segment_id, np.array(geometry.decode_linestring(wkb)))
+
+    def put(self, segment_id, coords):
+        self.items.pop(segment_id, None)
+        self.items[segment_id] = coords
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def get(self, segment_id):
+        coords = self.items.pop(segment_id, None)
+        if coords is None:
+            self.prefetch([segment_id])
+            coords = self.items.pop(segment_id)
+        self.items[segment_id] = coords
+        return coords
@@ -0,0 +1,96 @@
+"""
+Candidate road segments straight from the database.
+
+All points of a trace are sent in one statement. Every point is joined
+LATERAL with its k closest segments using the KNN operator (<->), so a
+whole trace costs a single round trip.
+
+The points are transformed once to UTM 48S and compared with
+mm_segment.geometry_utm, so the distances and the positions along the
+segments are planar, in meters, instead of geography computations for
+every candidate. The closest points come back projected and are
+unprojected here all at once.
+
+A long-running process can prepare() the statement once per connection
+and fetch(..., prepared=True), so it is planned only once.
+"""
+
+import numpy as np
+
+import geometry
+from index import Candidates
+
+SQL = '''
+    SELECT t.idx, s.id, s.osm_id,
+           ST_Distance(s.geometry_utm, t.geom) AS distance,
+           ST_X(s.closest), ST_Y(s.closest),
+           ST_LineLocatePoint(s.geometry_utm, t.geom)
+    FROM (
+        SELECT idx,
+               ST_Transform(ST_SetSRID(ST_MakePoint(lng, lat), 4326),
+                            %(srid)s) AS geom
+        FROM unnest(%(lng)s::float8[], %(lat)s::float8[])
+             WITH ORDINALITY AS p(lng, lat, idx)
+    ) t
+    CROSS JOIN LATERAL (
+        SELECT id, osm_id, geometry_utm,
+               ST_ClosestPoint(geometry_utm, t.geom) AS closest
+        FROM mm_segment
+        ORDER BY geometry_utm <-> t.geom
+        LIMIT %(k)s
+    ) s
+    ORDER BY t.idx, distance
+'''
+
+PREPARED = 'mm_candidates'
+
+def prepare(c):
+    """
+    Prepare the candidates statement on the connection of cursor c.
+    """
+    c.execute('PREPARE %s (float8[], float8[], int, int) AS %s'
+              % (PREPARED, SQL % dict(lng='$1', lat='$2', k='$3',
+                                      srid='$4')))
+
+def fetch(c, lngs, lats, k=4, prepared=False):
+    """
+    Fetch the k closest segments of every point in one query.
+
+    With prepared, run the statement of prepare() instead of sending
+    it.
+    """
+    n = len(lngs)
+    segment_id = np.full((n, k), -1, dtype=np.int64)
+    osm_id = np.full((n, k), -1, dtype=np.int64)
+    distance = np.full((n, k), np.inf)
+    cx = np.full((n, k), np.nan)
+    cy = np.full((n, k), np.nan)
+    fraction = np.full((n, k), np.nan)
+
+    if n == 0:
+        return Candidates(segment_id, osm_id, distance, cx, cy, fraction)
+
+    sql = SQL
+    if prepared:
+        sql = ('EXECUTE %s (%%(lng)s, %%(lat)s, %%(k)s, %%(srid)s)'
+               % PREPARED)
+    c.execute(sql, dict(lng=[float(v) for v in lngs],
+                        lat=[float(v) for v in lats],
+                        k=k, srid=geometry.UTM_SRID))
+
+    last = None
+    j = 0
+    for idx, sid, oid, d, x, y, f in c:
+        i = idx - 1
+        j = j + 1 if i == last else 0
+        last = i
+
+        segment_id[i, j] = sid
+        osm_id[i, j] = oid
+        distance[i, j] = d
+        cx[i, j] = x
+        cy[i, j] = y
+        fraction[i, j] = f
+
+    clng, clat = geometry.from_utm(cx, cy)
+    return Candidates(segment_id, osm_id, distance, clng, clat, fraction)
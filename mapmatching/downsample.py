@@ -0,0 +1,211 @@
+"""
+GPS data down sampler.
+"""
+
+import math
+
+import numpy as np
+
+R = 6371 # KM
+
+class DownSampler(object):
+    """
+    GPS data down sampler.
+
+    This will reduce the density of the GPS data. The resulting
+    GPS data points will have distance distance at least 100 meter
+    for every two consecutive points.
+
+    Optionally a point is also kept when at least max_interval seconds
+    passed since the last kept point, or when the heading turns by at
+    least min_turn degrees (and the point is at least TURN_DISTANCE
+    meters away, to ignore GPS jitter).
+
+    The state is kept between calls, so a trace can be fed point by
+    point (is_next), in chunks (sample) or as a stream (filter).
+    """
+
+    MIN_DISTANCE = 100 # M
+    TURN_DISTANCE = 25 # M
+    WINDOW = 16
+    # Below this many points between kept points on average, the points
+    # are checked one by one
+    SCALAR_GAP = 8
+
+    def __init__(self, min_distance=MIN_DISTANCE, max_interval=None,
+                 min_turn=None):
+        self.min_distance = min_distance
+        self.max_interval = max_interval
+        self.min_turn = min_turn
+
+        self.lng = None
+        self.lat = None
+        self.time = None
+        self.angle = None
+
+        # Points from one kept point to the next, see sample()
+        self.gap = float(self.WINDOW)
+        self.skipped = 0
+
+    def is_next(self, lng, lat, time=None):
+        if None in [self.lng, self.lat]:
+            self.keep(lng, lat, time, None)
+            return True
+
+        x, y = self.get_offset(lng, lat)
+        distance = math.sqrt(x*x + y*y) * 1000 # M
+        angle = math.degrees(math.atan2(x, y))
+
+        if distance >= self.min_distance \
+                or self.is_late(time) \
+                or self.is_turn(angle, distance):
+            self.keep(lng, lat, time, angle)
+            return True
+
+        return False
+
+    def keep(self, lng, lat, time, angle):
+        self.lng = lng
+        self.lat = lat
+        self.time = time
+        if angle is not None:
+            self.angle = angle
+
+    def is_late(self, time):
+        return self.max_interval is not None and time is not None \
+            and self.time is not None \
+            and time - self.time >= self.max_interval
+
+    def is_turn(self, angle, distance):
+        if self.min_turn is None or self.angle is None:
+            return False
+        turn = abs((angle - self.angle + 180) % 360 - 180)
+        return turn >= self.min_turn and distance >= self.TURN_DISTANCE
+
+    def get_offset(self, lng, lat):
+        # From http://www.movable-type.co.uk/scripts/latlong.html
+
+        lat1, lng1, lat2, lng2 = map(math.radians,
+                                     (self.lat, self.lng, lat, lng))
+        x = (lng2-lng1) * math.cos((lat1+lat2)/2.0)
+        y = lat2-lat1
+        return x * R, y * R # KM
+
+    def get_distance(self, lng, lat):
+        x, y = self.get_offset(lng, lat)
+        return math.sqrt(x*x + y*y) * 1000 # M
+
+    def sample(self, lngs, lats, times=None):
+        """
+        Return the indices of the kept points of a whole trace (or the
+        next chunk of it).
+
+        When points are usually skipped, distances from the last kept
+        point are computed for a window of following points at once and
+        the first point over a threshold is kept, so there is only one
+        Python step per kept point. The window follows the number of
+        points between kept ones, and when most points are kept they go
+        through is_next() one by one, cheaper than an array step each.
+        """
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        rlngs = np.radians(lngs)
+        rlats = np.radians(lats)
+        if times is not None:
+            times = np.asarray(times, dtype=np.float64)
+        n = len(lngs)
+
+        kept = []
+        start = 0
+        if None in [self.lng, self.lat] and n > 0:
+            self.keep(float(lngs[0]), float(lats[0]),
+                      None if times is None else float(times[0]), None)
+            kept.append(0)
+            start = 1
+
+        points = None
+        window = max(int(2 * self.gap), self.WINDOW)
+        while start < n:
+            if self.gap < self.SCALAR_GAP:
+                if points is None:
+                    points = list(zip(lngs.tolist(), lats.tolist(),
+                                      [None] * n if times is None
+                                      else times.tolist()))
+                # One by one until SCALAR_GAP points in a row are skipped
+                misses = 0
+                for j in range(start, n):
+                    if self.is_next(*points[j]):
+                        kept.append(j)
+                        misses = 0
+                    else:
+                        misses += 1
+                        if misses >= self.SCALAR_GAP:
+                            break
+                start = j + 1
+                self.gap = float(misses)
+                self.skipped = misses
+                window = max(int(2 * self.gap), self.WINDOW)
+                continue
+
+            end = min(start + window, n)
+            lat1 = math.radians(self.lat)
+            lng1 = math.radians(self.lng)
+            lat2 = rlats[start:end]
+            x = (rlngs[start:end] - lng1) * np.cos((lat1 + lat2) / 2.0) * R
+            y = (lat2 - lat1) * R
+            distance = np.sqrt(x*x + y*y) * 1000 # M
+
+            mask = distance >= self.min_distance
+            if self.max_interval is not None and times is not None \
+                    and self.time is not None:
+                mask |= times[start:end] - self.time >= self.max_interval
+            if self.min_turn is not None and self.angle is not None:
+                angle = np.degrees(np.arctan2(x, y))
+                turn = np.abs((angle - self.angle + 180) % 360 - 180)
+                mask |= (turn >= self.min_turn) \
+                    & (distance >= self.TURN_DISTANCE)
+
+            if not mask.any():
+                self.skipped += end - start
+                start = end
+                window *= 2
+                continue
+
+            i = int(np.argmax(mask))
+            j = start + i
+            self.keep(float(lngs[j]), float(lats[j]),
+                      None if times is None else float(times[j]),
+                      float(np.degrees(math.atan2(x[i], y[i]))))
+            kept.append(j)
+            self.observe_gap(self.skipped + i + 1)
+            start = j + 1
+            window = max(int(2 * self.gap), self.WINDOW)
+
+        return np.array(kept, dtype=np.int64)
+
+    def observe_gap(self, gap):
+        # Moving average of the points from one kept point to the next
+        self.gap += (gap - self.gap) / 4.0
+        self.skipped = 0
+
+    def filter(self, points, chunk=4096):
+        """
+        Down sample an iterable of (lng, lat) or (lng, lat, time) points,
+        possibly unbounded. The kept points are yielded as they are.
+        """
+        buf = []
+        for point in points:
+            buf.append(point)
+            if len(buf) >= chunk:
+                for item in self.filter_chunk(buf):
+                    yield item
+                buf = []
+        for item in self.filter_chunk(buf):
+            yield item
+
+    def filter_chunk(self, points):
+        if not points:
+            return []
+        data = np.array([point[:3] for point in points], dtype=np.float64)
+        times = data[:, 2] if data.shape[1] > 2 else None
+        return [points[i] for i in self.sample(data[:, 0], data[:, 1], times)]
@@ -0,0 +1,195 @@
+"""
+Geometry helpers shared by the matcher and the importer.
+
+Coordinates are kept as longitude/latitude in the database. The matcher
+works on planar coordinates in meters so that distances can be computed
+with plain arithmetic on NumPy arrays: either a local equirectangular
+approximation (the one used by DownSampler) or UTM zone 48S
+(EPSG:32748), the projection of the metric geometries written by the
+importer.
+"""
+
+import struct
+
+import numpy as np
+
+R = 6371000.0 # M
+
+WKB_LINESTRING = 2
+
+# UTM zone 48S on WGS 84
+UTM_SRID = 32748
+UTM_LNG0 = 105.0 # Central meridian
+UTM_K0 = 0.9996
+UTM_E0 = 500000.0 # M
+UTM_N0 = 10000000.0 # M
+
+# Kruger series of the transverse Mercator projection, to the third
+# order in the third flattening n (sub-millimeter within a zone)
+_A = 6378137.0
+_F = 1 / 298.257223563
+_N = _F / (2 - _F)
+_RECT = _A / (1 + _N) * (1 + _N ** 2 / 4 + _N ** 4 / 64)
+_ALPHA = (_N / 2 - 2 * _N ** 2 / 3 + 5 * _N ** 3 / 16,
+          13 * _N ** 2 / 48 - 3 * _N ** 3 / 5,
+          61 * _N ** 3 / 240)
+_BETA = (_N / 2 - 2 * _N ** 2 / 3 + 37 * _N ** 3 / 96,
+         _N ** 2 / 48 + _N ** 3 / 15,
+         17 * _N ** 3 / 480)
+_DELTA = (2 * _N - 2 * _N ** 2 / 3 - 2 * _N ** 3,
+          7 * _N ** 2 / 3 - 8 * _N ** 3 / 5,
+          56 * _N ** 3 / 15)
+_E = 2 * np.sqrt(_N) / (1 + _N)
+
+def project(lng, lat, lat0):
+    """
+    Project longitude/latitude (degrees) to x/y (meters) around lat0.
+    """
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    k = R * np.pi / 180.0
+    return lng * k * np.cos(np.radians(lat0)), lat * k
+
+def unproject(x, y, lat0):
+    """
+    Inverse of project().
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    k = R * np.pi / 180.0
+    return x / (k * np.cos(np.radians(lat0))), y / k
+
+def utm(lng, lat):
+    """
+    Project longitude/latitude (degrees) to UTM 48S easting/northing
+    (meters).
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    dlng = np.radians(np.asarray(lng, dtype=np.float64) - UTM_LNG0)
+    sin = np.sin(lat)
+    t = np.sinh(np.arctanh(sin) - _E * np.arctanh(_E * sin))
+    xi = np.arctan2(t, np.cos(dlng))
+    eta = np.arctanh(np.sin(dlng) / np.sqrt(1 + t * t))
+    x = eta.copy()
+    y = xi.copy()
+    for j, alpha in enumerate(_ALPHA, 1):
+        x += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        y += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    return UTM_E0 + UTM_K0 * _RECT * x, UTM_N0 + UTM_K0 * _RECT * y
+
+def from_utm(x, y):
+    """
+    Inverse of utm().
+    """
+    xi = (np.asarray(y, dtype=np.float64) - UTM_N0) / (UTM_K0 * _RECT)
+    eta = (np.asarray(x, dtype=np.float64) - UTM_E0) / (UTM_K0 * _RECT)
+    xi1 = xi.copy()
+    eta1 = eta.copy()
+    for j, beta in enumerate(_BETA, 1):
+        xi1 -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta1 -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+    chi = np.arcsin(np.sin(xi1) / np.cosh(eta1))
+    lat = chi.copy()
+    for j, delta in enumerate(_DELTA, 1):
+        lat += delta * np.sin(2 * j * chi)
+    lng = UTM_LNG0 + np.degrees(np.arctan2(np.sinh(eta1), np.cos(xi1)))
+    return lng, np.degrees(lat)
+
+class Polynomial(object):
+    """
+    A smooth mapping, like utm() or from_utm(), approximated over a
+    region by a polynomial of both coordinates.
+
+    The polynomial is fitted once to a grid of exact samples, from the
+    third degree up until all the samples are within tolerance (in the
+    units of the output). Over a city sized region a cubic is within a
+    centimeter of UTM. Evaluating it is a few multiply-adds per point
+    instead of the trigonometric series. Points outside of the region
+    go through the function itself.
+    """
+
+    SAMPLES = 32
+    MAX_DEGREE = 8
+
+    def __init__(self, function, min_u, min_v, max_u, max_v, tolerance):
+        self.function = function
+        # Fitted on coordinates scaled to -1..1
+        self.center = ((min_u + max_u) / 2.0, (min_v + max_v) / 2.0)
+        self.scale = (max((max_u - min_u) / 2.0, 1e-9),
+                      max((max_v - min_v) / 2.0, 1e-9))
+        grid = np.linspace(-1, 1, self.SAMPLES)
+        u, v = [value.ravel() for value in np.meshgrid(grid, grid)]
+        a, b = function(self.center[0] + u * self.scale[0],
+                        self.center[1] + v * self.scale[1])
+        exact = np.column_stack((a, b))
+
+        for degree in range(3, self.MAX_DEGREE + 1):
+            self.terms = [(i, j) for i in range(degree + 1)
+                          for j in range(degree + 1 - i)]
+            powers = np.column_stack([u ** i * v ** j for i, j in self.terms])
+            # Both outputs at once, (terms, 2)
+            self.coefficients = np.linalg.lstsq(powers, exact, rcond=None)[0]
+            error = np.abs(powers.dot(self.coefficients) - exact).max()
+            if error <= tolerance:
+                break
+        self.degree = degree
+
+        # Per output, coefficients[i][j] of u ** i * v ** j for Horner
+        self.tables = []
+        for column in self.coefficients.T.tolist():
+            table = [[0.0] * (degree + 1 - i) for i in range(degree + 1)]
+            for (i, j), c in zip(self.terms, column):
+                table[i][j] = c
+            self.tables.append(table)
+
+    def __call__(self, u, v):
+        u = np.asarray(u, dtype=np.float64)
+        v = np.asarray(v, dtype=np.float64)
+        su = (u - self.center[0]) / self.scale[0]
+        sv = (v - self.center[1]) / self.scale[1]
+        outputs = []
+        for table in self.tables:
+            result = None
+            for row in reversed(table):
+                inner = row[-1]
+                for c in reversed(row[:-1]):
+                    inner = inner * sv + c
+                result = inner if result is None else result * su + inner
+            outputs.append(result)
+
+        outside = (np.abs(su) > 1) | (np.abs(sv) > 1)
+        if outside.any():
+            if outside.ndim == 0:
+                return self.function(u, v)
+            a, b = self.function(u[outside], v[outside])
+            outputs[0][outside] = a
+            outputs[1][outside] = b
+        return outputs[0], outputs[1]
+
+def decode_linestring(wkb):
+    """
+    Decode a WKB LINESTRING into an (n, 2) array of lng, lat.
+    """
+    header = bytes(wkb[:9])
+    order = '<' if header[0:1] == b'\x01' else '>'
+    kind, size = struct.unpack(order + 'II', header[1:9])
+    assert kind == WKB_LINESTRING, 'Not a LINESTRING: %d' % kind
+    return np.frombuffer(wkb, dtype=order + 'f8', count=size * 2,
+                         offset=9).reshape(size, 2)
+
+def closest_on_edges(px, py, ax, ay, bx, by):
+    """
+    Find the closest points from (px, py) to the edges a -> b.
+
+    Return the distances, the closest points and the position of the
+    closest points along each edge as a 0..1 ratio.
+    """
+    dx = bx - ax
+    dy = by - ay
+    length2 = dx * dx + dy * dy
+    t = (px - ax) * dx + (py - ay) * dy
+    t = np.divide(t, length2, out=np.zeros_like(t), where=length2 > 0)
+    t = np.clip(t, 0.0, 1.0)
+    cx = ax + t * dx
+    cy = ay + t * dy
+    return np.hypot(px - cx, py - cy), cx, cy, t
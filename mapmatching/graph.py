@@ -0,0 +1,205 @@
+"""
+Road network distances over the routing graph written by the importer
+(import.py --graph DIR).
+
+The arrays are memory-mapped, so opening the graph is cheap and several
+processes share the same pages.
+"""
+
+import heapq
+import os
+import threading
+
+import numpy as np
+
+NAMES = ['node_osm_id', 'segment_id', 'segment_osm_id', 'segment_index',
+         'segment_source', 'segment_target', 'segment_length',
+         'segment_oneway', 'offsets', 'targets', 'edge_segment',
+         'edge_forward']
+
+class RoadGraph(object):
+    """
+    CSR routing graph of the road segments.
+    """
+
+    CACHE_NODES = 1 << 16
+    CACHE_SEARCHES = 1 << 12
+
+    def __init__(self, arrays):
+        for name in NAMES:
+            setattr(self, name, arrays[name])
+        self.segment_order = np.argsort(self.segment_id, kind='mergesort')
+        # node -> [(target, length)], see edges()
+        self.adjacency = {}
+        # node -> (settled, heap), see search(). Resumed by one thread at
+        # a time.
+        self.searches = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(dict((name, np.load(os.path.join(path, '%s.npy' % name),
+                                       mmap_mode=mmap_mode))
+                        for name in NAMES))
+
+    def segments(self, segment_ids):
+        """
+        Map mm_segment ids to graph segments, -1 for unknown ids.
+        """
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        if len(self.segment_id) == 0:
+            return np.full(segment_ids.shape, -1, dtype=np.int64)
+        sorted_ids = self.segment_id[self.segment_order]
+        pos = np.clip(np.searchsorted(sorted_ids, segment_ids),
+                      0, len(sorted_ids) - 1)
+        found = sorted_ids[pos] == segment_ids
+        return np.where(found, self.segment_order[pos], -1)
+
+    def edges(self, node):
+        """
+        [(target, length)] of the edges of a node, cached.
+        """
+        edges = self.adjacency.get(node)
+        if edges is None:
+            if len(self.adjacency) >= self.CACHE_NODES:
+                self.adjacency.clear()
+            start = self.offsets[node]
+            end = self.offsets[node + 1]
+            edges = list(zip(
+                self.targets[start:end].tolist(),
+                self.segment_length[self.edge_segment[start:end]].tolist()))
+            self.adjacency[node] = edges
+        return edges
+
+    def search(self, node):
+        """
+        The Dijkstra search from a node, shared by the candidates, the
+        steps and the traces leaving from it, see shortest().
+        """
+        search = self.searches.get(node)
+        if search is None:
+            if len(self.searches) >= self.CACHE_SEARCHES:
+                self.searches.clear()
+            search = self.searches[node] = ({}, [(0.0, node)])
+        return search
+
+    def shortest(self, search, goals, limit):
+        """
+        Run a Dijkstra search from one node until every goal node is
+        settled or the distance exceeds limit.
+
+        search is a (settled, heap) pair, {node: distance} of the settled
+        nodes and the heap of the next ones, started with
+        ({}, [(0.0, node)]). The search can be resumed with other goals
+        or a larger limit, so a node is searched from once however many
+        candidates start from it.
+
+        Return the settled nodes.
+        """
+        settled, heap = search
+        pending = set(node for node in goals if node not in settled)
+        adjacency = self.adjacency
+        pop = heapq.heappop
+        push = heapq.heappush
+
+        while heap and pending and heap[0][0] <= limit:
+            d, node = pop(heap)
+            if node in settled:
+                continue
+            settled[node] = d
+            pending.discard(node)
+            edges = adjacency.get(node)
+            if edges is None:
+                edges = self.edges(node)
+            for target, length in edges:
+                if target not in settled:
+                    push(heap, (d + length, target))
+
+        return settled
+
+    def route_distance(self, cand, limit):
+        """
+        Network distance from every candidate of step t to every candidate
+        of step t + 1, as a (n - 1, k, k) array. Unreachable pairs, or
+        pairs further than limit[t], are infinite.
+
+        A candidate is left by the end of its segment in the allowed
+        directions, and entered by the start. The end points are shared
+        by the neighbour candidates, the next steps and the other traces
+        on the same roads, so there is one search per end point, resumed
+        when a goal is not settled yet. Only the distances between the
+        end points are looked up step by step, the rest is done on whole
+        arrays.
+        """
+        n, k = cand.segment_id.shape
+        result = np.full((max(n - 1, 0), k, k), np.inf)
+        if n < 2:
+            return result
+
+        segments = self.segments(cand.segment_id)
+        valid = (segments >= 0) & (cand.segment_id >= 0)
+        segments = np.where(valid, segments, 0)
+        f = np.nan_to_num(cand.fraction)
+        length = self.segment_length[segments].astype(np.float64)
+        oneway = self.segment_oneway[segments]
+        source = self.segment_source[segments]
+        target = self.segment_target[segments]
+        forward = valid & (oneway >= 0)
+        backward = valid & (oneway <= 0)
+
+        # (n, 2k): the forward then the backward way of every candidate
+        exit_node = np.concatenate([target, source], axis=1)
+        exit_cost = np.concatenate([np.where(forward, (1 - f) * length,
+                                             np.inf),
+                                    np.where(backward, f * length, np.inf)],
+                                   axis=1)
+        entry_node = np.concatenate([source, target], axis=1)
+        entry_cost = np.concatenate([np.where(forward, f * length, np.inf),
+                                     np.where(backward, (1 - f) * length,
+                                              np.inf)], axis=1)
+
+        exits = np.where(np.isfinite(exit_cost), exit_node, -1).tolist()
+        entries = np.where(np.isfinite(entry_cost), entry_node, -1).tolist()
+        costs = exit_cost.tolist()
+        bounds = np.asarray(limit, dtype=np.float64).tolist()
+
+        # Distance from every exit of step t to every entry of step t + 1
+        between = []
+        unreachable = [np.inf] * (2 * k)
+        with self.lock:
+            for t in range(n - 1):
+                goals = set(entries[t + 1])
+                goals.discard(-1)
+                # Exit node -> distances to the entries, the farthest
+                # limit first as exits of the same node share the row
+                rows = {-1: unreachable}
+                for cost, node in sorted(zip(costs[t], exits[t])):
+                    if node not in rows and goals:
+                        settled = self.shortest(self.search(node), goals,
+                                                bounds[t] - cost)
+                        rows[node] = [settled.get(goal, np.inf)
+                                      for goal in entries[t + 1]]
+                between.extend(rows.get(node, unreachable)
+                               for node in exits[t])
+
+        # [t, a, i, b, j]: leave candidate i of step t in way a, enter
+        # candidate j of step t + 1 in way b
+        between = np.array(between).reshape(n - 1, 2, k, 2, k)
+        total = (exit_cost[:-1].reshape(n - 1, 2, k)[:, :, :, None, None]
+                 + between
+                 + entry_cost[1:].reshape(n - 1, 2, k)[:, None, None, :, :])
+        network = total.min(axis=(1, 3))
+
+        # Along the same segment
+        same = (valid[:-1, :, None] & valid[1:, None, :]
+                & (segments[:-1, :, None] == segments[1:, None, :]))
+        fi = f[:-1, :, None]
+        fj = f[1:, None, :]
+        way = oneway[:-1, :, None]
+        along = np.where((fj >= fi) & (way >= 0),
+                         (fj - fi) * length[:-1, :, None],
+                         np.where((fj < fi) & (way <= 0),
+                                  (fi - fj) * length[:-1, :, None], np.inf))
+        result = np.where(same, np.minimum(along, network), network)
+        result[result > np.asarray(bounds)[:, None, None]] = np.inf
+        return result
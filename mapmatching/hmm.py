@@ -0,0 +1,132 @@
+"""
+Hidden Markov Model map matching.
+
+Every downsampled GPS point is an observation and its candidate road
+segments are the hidden states. A candidate is more likely when it is
+close to the observation (emission), and a move between two candidates
+is more likely when the distance travelled between them is close to the
+distance between the two observations (transition). Viterbi then picks
+the most likely sequence of segments instead of snapping every point on
+its own.
+
+Scores are log probabilities kept in (points x k) and (steps x k x k)
+arrays, so every Viterbi step is a handful of NumPy operations.
+"""
+
+import numpy as np
+
+import geometry
+
+class HMM(object):
+    """
+    Viterbi matcher over a Candidates matrix.
+    """
+
+    SIGMA = 20.0 # M, GPS noise
+    BETA = 50.0 # M, tolerated detour between two observations
+    DETOUR = 10 # x BETA, give up routing beyond this detour
+
+    def __init__(self, sigma=SIGMA, beta=BETA, graph=None):
+        self.sigma = sigma
+        self.beta = beta
+        self.graph = graph
+
+    def emission(self, cand):
+        """
+        Log probability of every candidate given its observation.
+        """
+        d = cand.distance / self.sigma
+        score = -0.5 * d * d
+        score[cand.segment_id < 0] = -np.inf
+        return score
+
+    def route_distance(self, cand, observed):
+        """
+        Distance travelled from every candidate of step t to every
+        candidate of step t + 1, as a (n - 1, k, k) array.
+
+        This is the network distance when a routing graph is available,
+        and the straight distance between the closest points otherwise.
+        """
+        if self.graph is not None:
+            return self.graph.route_distance(
+                cand, observed + self.DETOUR * self.beta)
+
+        lat0 = np.nanmean(cand.lat) if np.isfinite(cand.lat).any() else 0.0
+        x, y = geometry.project(cand.lng, cand.lat, lat0)
+        dx = x[1:, None, :] - x[:-1, :, None]
+        dy = y[1:, None, :] - y[:-1, :, None]
+        return np.hypot(dx, dy)
+
+    def transition(self, cand, lngs, lats):
+        """
+        Log probability of moving between candidates of two consecutive
+        observations.
+        """
+        lat0 = np.mean(lats) if len(lats) else 0.0
+        x, y = geometry.project(lngs, lats, lat0)
+        observed = np.hypot(np.diff(x), np.diff(y))
+
+        route = self.route_distance(cand, observed)
+        score = -np.abs(route - observed[:, None, None]) / self.beta
+        score[np.isnan(score)] = -np.inf
+        return score
+
+    def step(self, scores, transition, emission):
+        """
+        One Viterbi step. Return the scores of the new candidates and
+        the best previous candidate of each of them.
+
+        When no candidate can be reached from the previous step the chain
+        is broken: the new scores are the emissions alone and there is no
+        previous candidate (-1).
+        """
+        s = scores[:, None] + transition
+        best = np.argmax(s, axis=0)
+        current = s[best, np.arange(len(emission))] + emission
+        if np.isfinite(current).any():
+            return current, best
+
+        # Break, start a new chain
+        return emission.copy(), np.full(len(emission), -1, dtype=np.int64)
+
+    def viterbi(self, emission, transition):
+        """
+        Return the index of the most likely candidate of every
+        observation, -1 for observations without any candidate.
+
+        When no candidate of a step can be reached from the previous
+        step the chain is broken and restarted at that step.
+        """
+        n, k = emission.shape
+        path = np.full(n, -1, dtype=np.int64)
+        if n == 0:
+            return path
+
+        back = np.full((n, k), -1, dtype=np.int64)
+        scores = np.empty((n, k))
+        scores[0] = emission[0]
+
+        for t in range(1, n):
+            scores[t], back[t] = self.step(scores[t - 1], transition[t - 1],
+                                           emission[t])
+
+        # Backtrack
+        j = -1
+        for t in range(n - 1, -1, -1):
+            if j < 0:
+                j = int(np.argmax(scores[t]))
+                if not np.isfinite(scores[t, j]):
+                    j = -1
+                    continue
+            path[t] = j
+            j = int(back[t, j])
+
+        return path
+
+    def match(self, cand, lngs, lats):
+        """
+        Return the index of the matched candidate of every observation.
+        """
+        return self.viterbi(self.emission(cand),
+                            self.transition(cand, lngs, lats))
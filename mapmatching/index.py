@@ -0,0 +1,500 @@
+"""
+In-memory spatial index over the road segments.
+
+The segments are loaded once from mm_segment and broken down into their
+edges (two consecutive vertices). Every edge is registered in a uniform
+grid, so a nearest segment lookup only has to look at the edges around
+the query point instead of scanning the whole table.
+
+Vertices are in UTM 48S, the projection of mm_segment.geometry_utm,
+or with srid=0 in a local equirectangular approximation around the
+middle latitude (the projection of indexes saved before the UTM one).
+The query points are projected, and the closest points unprojected,
+with polynomials fitted to UTM over the extent of the index.
+
+A lookup always finds the closest segments, however far they are, unless
+it is given a max_distance.
+"""
+
+from collections import namedtuple
+import json
+import os
+
+import numpy as np
+
+import geometry
+
+# Every field is an (n, k) array. Missing candidates have segment_id -1
+# and an infinite distance.
+Candidates = namedtuple('Candidates',
+                        'segment_id osm_id distance lng lat fraction')
+
+class SegmentIndex(object):
+    """
+    Uniform grid index of road segment edges.
+    """
+
+    CELL_SIZE = 250 # M
+    # Around the grid, where the query points are projected with the
+    # polynomials
+    MARGIN = 2000 # M
+    SRID = geometry.UTM_SRID
+
+    # Saved as .npy files, scalars go to index.json
+    ARRAYS = ['segment_ids', 'osm_ids', 'offsets', 'x', 'y', 'edge_start',
+              'edge_segment', 'vertex_distance', 'segment_length',
+              'cell_edges', 'cell_offsets']
+    SCALARS = ['lat0', 'cell_size', 'x0', 'y0', 'nx', 'ny', 'srid']
+
+    def __init__(self, segment_ids, osm_ids, offsets, lng, lat,
+                 cell_size=CELL_SIZE, srid=SRID):
+        lng = np.asarray(lng, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lat0 = float((lat.min() + lat.max()) / 2.0) if len(lat) else 0.0
+        if srid == geometry.UTM_SRID:
+            x, y = geometry.utm(lng, lat)
+        else:
+            x, y = geometry.project(lng, lat, lat0)
+        self.setup(segment_ids, osm_ids, offsets, x, y, cell_size, srid,
+                   lat0)
+        self.build()
+
+    @classmethod
+    def from_xy(cls, segment_ids, osm_ids, offsets, x, y,
+                vertex_distance=None, segment_length=None,
+                cell_size=CELL_SIZE):
+        """
+        Create an index from vertices already in UTM 48S, and their
+        distances along the segments and the segment lengths when they
+        are measured already.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        lat0 = 0.0
+        if len(y):
+            _, lat = geometry.from_utm([x.mean()] * 2, [y.min(), y.max()])
+            lat0 = float(lat.mean())
+
+        index = cls.__new__(cls)
+        index.setup(segment_ids, osm_ids, offsets, x, y, cell_size,
+                    geometry.UTM_SRID, lat0)
+        index.build(vertex_distance, segment_length)
+        return index
+
+    def setup(self, segment_ids, osm_ids, offsets, x, y, cell_size, srid,
+              lat0):
+        self.segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        self.osm_ids = np.asarray(osm_ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.x = x
+        self.y = y
+        self.cell_size = float(cell_size)
+        self.srid = srid
+        self.lat0 = lat0
+
+    def project(self, lng, lat):
+        """
+        Project longitude/latitude to the x/y of the index.
+        """
+        if self.srid == geometry.UTM_SRID:
+            return self.polynomials()[0](lng, lat)
+        return geometry.project(lng, lat, self.lat0)
+
+    def unproject(self, x, y):
+        if self.srid == geometry.UTM_SRID:
+            return self.polynomials()[1](x, y)
+        return geometry.unproject(x, y, self.lat0)
+
+    def polynomials(self):
+        """
+        UTM 48S and its inverse as polynomials over the grid, plus
+        MARGIN around it, fitted on first use.
+        """
+        polynomials = getattr(self, '_polynomials', None)
+        if polynomials is not None:
+            return polynomials
+
+        margin = self.MARGIN
+        min_x = self.x0 - margin
+        min_y = self.y0 - margin
+        max_x = self.x0 + self.nx * self.cell_size + margin
+        max_y = self.y0 + self.ny * self.cell_size + margin
+        inverse = geometry.Polynomial(geometry.from_utm,
+                                      min_x, min_y, max_x, max_y,
+                                      1e-7) # Degrees, about a centimeter
+
+        # Longitude/latitude box of the sides of the grid
+        sides = np.linspace(0, 1, 9)
+        xs = np.concatenate([min_x + sides * (max_x - min_x),
+                             min_x + sides * (max_x - min_x),
+                             np.full(9, min_x), np.full(9, max_x)])
+        ys = np.concatenate([np.full(9, min_y), np.full(9, max_y),
+                             min_y + sides * (max_y - min_y),
+                             min_y + sides * (max_y - min_y)])
+        lng, lat = geometry.from_utm(xs, ys)
+        forward = geometry.Polynomial(geometry.utm,
+                                      lng.min(), lat.min(),
+                                      lng.max(), lat.max(),
+                                      0.01) # M
+
+        self._polynomials = (forward, inverse)
+        return self._polynomials
+
+    @classmethod
+    def from_db(cls, c, **kwargs):
+        """
+        Load all segments from mm_segment, with the UTM geometries and
+        the measures written by the importer.
+        """
+        c.execute('''
+            SELECT id, osm_id, ST_AsBinary(geometry_utm), distances, length
+            FROM mm_segment
+            ORDER BY id
+            ''')
+
+        segment_ids = []
+        osm_ids = []
+        coords = []
+        distances = []
+        lengths = []
+        for segment_id, osm_id, wkb, vertex_distance, length in c:
+            segment_ids.append(segment_id)
+            osm_ids.append(osm_id)
+            coords.append(geometry.decode_linestring(wkb))
+            distances.extend(vertex_distance)
+            lengths.append(length)
+
+        sizes = [len(item) for item in coords]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        coords = np.concatenate(coords) if coords else np.zeros((0, 2))
+
+        return cls.from_xy(segment_ids, osm_ids, offsets,
+                           coords[:, 0], coords[:, 1],
+                           np.array(distances, dtype=np.float64),
+                           np.array(lengths, dtype=np.float64), **kwargs)
+
+    def save(self, path):
+        """
+        Save the built index to a directory, to be loaded with load().
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, '%s.npy' % name), getattr(self, name))
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(dict((name, float(getattr(self, name)))
+                           for name in self.SCALARS), f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a saved index. The arrays are memory-mapped by default, so
+        processes loading the same index share its pages.
+        """
+        arrays = dict((name, np.load(os.path.join(path, '%s.npy' % name),
+                                     mmap_mode=mmap_mode))
+                      for name in cls.ARRAYS)
+        with open(os.path.join(path, 'index.json')) as f:
+            scalars = json.load(f)
+        return cls.from_arrays(arrays, scalars)
+
+    @classmethod
+    def from_arrays(cls, arrays, scalars):
+        """
+        Create an index from already built ARRAYS and SCALARS.
+        """
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        for name in cls.SCALARS:
+            setattr(index, name, scalars.get(name))
+        index.nx = int(index.nx)
+        index.ny = int(index.ny)
+        # Saved before the UTM projection
+        index.srid = int(index.srid or 0)
+        return index
+
+    def build(self, vertex_distance=None, segment_length=None):
+        """
+        Build the edges and the grid, and measure the segments unless
+        vertex_distance and segment_length are given.
+        """
+        # Edges: vertex v -> v + 1, except for the last vertex of each
+        # segment.
+        sizes = np.diff(self.offsets)
+        last = np.zeros(len(self.x), dtype=bool)
+        last[self.offsets[1:][sizes > 0] - 1] = True
+        self.edge_start = np.flatnonzero(~last)
+        self.edge_segment = np.repeat(np.arange(len(sizes)),
+                                      np.maximum(sizes - 1, 0))
+
+        ax = self.x[self.edge_start]
+        ay = self.y[self.edge_start]
+        bx = self.x[self.edge_start + 1]
+        by = self.y[self.edge_start + 1]
+
+        if vertex_distance is not None and segment_length is not None:
+            self.vertex_distance = np.asarray(vertex_distance,
+                                              dtype=np.float64)
+            self.segment_length = np.asarray(segment_length,
+                                             dtype=np.float64)
+        else:
+            self.measure(sizes, np.hypot(bx - ax, by - ay))
+
+        # Grid
+        if len(self.x):
+            self.x0 = self.x.min()
+            self.y0 = self.y.min()
+            self.nx = int((self.x.max() - self.x0) // self.cell_size) + 1
+            self.ny = int((self.y.max() - self.y0) // self.cell_size) + 1
+        else:
+            self.x0 = self.y0 = 0.0
+            self.nx = self.ny = 1
+
+        cx0, cy0 = self.cell(np.minimum(ax, bx), np.minimum(ay, by))
+        cx1, cy1 = self.cell(np.maximum(ax, bx), np.maximum(ay, by))
+
+        # Register every edge to every cell covered by its bounding box
+        w = cx1 - cx0 + 1
+        counts = w * (cy1 - cy0 + 1)
+        edges = np.repeat(np.arange(len(counts)), counts)
+        first = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=first[1:])
+        pos = np.arange(len(edges)) - np.repeat(first, counts)
+        cells = ((np.repeat(cy0, counts) + pos // np.repeat(w, counts))
+                 * self.nx
+                 + np.repeat(cx0, counts) + pos % np.repeat(w, counts))
+
+        order = np.argsort(cells, kind='mergesort')
+        self.cell_edges = edges[order]
+        self.cell_offsets = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self.nx * self.ny),
+                  out=self.cell_offsets[1:])
+
+    def measure(self, sizes, edge_length):
+        # Cumulative distance of every vertex along its segment
+        self.vertex_distance = np.zeros(len(self.x))
+        self.vertex_distance[self.edge_start + 1] = edge_length
+        np.cumsum(self.vertex_distance, out=self.vertex_distance)
+        base = np.repeat(self.vertex_distance[self.offsets[:-1][sizes > 0]],
+                         sizes[sizes > 0])
+        self.vertex_distance -= base
+        self.segment_length = np.zeros(len(sizes))
+        self.segment_length[sizes > 0] = \
+            self.vertex_distance[self.offsets[1:][sizes > 0] - 1]
+
+    def cell(self, x, y):
+        cx = ((x - self.x0) // self.cell_size).astype(np.int64)
+        cy = ((y - self.y0) // self.cell_size).astype(np.int64)
+        return np.clip(cx, 0, self.nx - 1), np.clip(cy, 0, self.ny - 1)
+
+    def rings(self, cx, cy, r):
+        """
+        Return the edges registered in the cells at Chebyshev distance r
+        from the cells (cx, cy) of several points, as (point, edge)
+        pairs, the point being a position in cx and cy.
+        """
+        if r == 0:
+            dx = dy = np.zeros(1, dtype=np.int64)
+        else:
+            side = np.arange(-r, r + 1)
+            dx = np.concatenate([side, side, np.full(2 * r - 1, -r),
+                                 np.full(2 * r - 1, r)])
+            dy = np.concatenate([np.full(2 * r + 1, -r),
+                                 np.full(2 * r + 1, r),
+                                 side[1:-1], side[1:-1]])
+        gx = cx[:, None] + dx
+        gy = cy[:, None] + dy
+        valid = (gx >= 0) & (gx < self.nx) & (gy >= 0) & (gy < self.ny)
+        point = np.nonzero(valid)[0]
+        cells = gy[valid] * self.nx + gx[valid]
+
+        start = self.cell_offsets[cells]
+        counts = self.cell_offsets[cells + 1] - start
+        first = np.zeros(len(counts), dtype=np.int64)
+        np.cumsum(counts[:-1], out=first[1:])
+        pos = np.arange(counts.sum()) - np.repeat(first, counts)
+        return (np.repeat(point, counts),
+                self.cell_edges[np.repeat(start, counts) + pos])
+
+    def query(self, lng, lat, k=1, max_distance=None):
+        """
+        Find the k closest segments to a point, within max_distance
+        meters when given.
+
+        Return the segment positions in this index, their distances, the
+        closest points (x, y) and the position of the closest points along
+        the segments as a 0..1 ratio, ordered by distance.
+        """
+        px, py = self.project(lng, lat)
+        return self.query_xy(px, py, k, max_distance)
+
+    def query_xy(self, px, py, k=1, max_distance=None):
+        """
+        Same as query(), for a point already projected.
+        """
+        result = self.search(np.array([px], dtype=np.float64),
+                             np.array([py], dtype=np.float64),
+                             k, max_distance)
+        found = result[0][0] >= 0
+        return tuple(item[0][found] for item in result)
+
+    def search(self, px, py, k=1, max_distance=None):
+        """
+        Find the k closest segments of all the projected points at once.
+
+        Return (n, k) arrays of the segment positions in this index (-1
+        when missing), the distances (infinite), the closest points x, y
+        and their position along the segments (NaN), by distance.
+
+        The cells around the points are searched in rings of growing
+        radius, for all the points still looking at once, until their
+        k-th closest segment is closer than any edge not seen yet. With
+        max_distance the search stops at that distance, otherwise the
+        rings grow until they cover the grid.
+        """
+        n = len(px)
+        segments = np.full((n, k), -1, dtype=np.int64)
+        distance = np.full((n, k), np.inf)
+        x = np.full((n, k), np.nan)
+        y = np.full((n, k), np.nan)
+        fraction = np.full((n, k), np.nan)
+        if n == 0 or k == 0:
+            return segments, distance, x, y, fraction
+
+        size = self.cell_size
+        cx, cy = self.cell(px, py)
+        # Points outside of the grid are clipped to the closest cell
+        outside = np.hypot(
+            np.maximum(np.maximum(self.x0 + cx * size - px,
+                                  px - self.x0 - (cx + 1) * size), 0.0),
+            np.maximum(np.maximum(self.y0 + cy * size - py,
+                                  py - self.y0 - (cy + 1) * size), 0.0))
+        if max_distance is None:
+            max_r = max(self.nx, self.ny)
+        else:
+            max_r = int(max_distance // size) + 1
+
+        # Every edge seen by the points still looking: point, edge and
+        # distance, closest point and position along the edge
+        seen = [np.zeros(0, dtype=np.int64)] * 2 + [np.zeros(0)] * 4
+        pending = np.arange(n)
+        done = np.zeros(n, dtype=bool)
+        r = 0
+        while len(pending):
+            pos, edges = self.rings(cx[pending], cy[pending], r)
+            point = pending[pos]
+            start = self.edge_start[edges]
+            d, ex, ey, t = geometry.closest_on_edges(
+                px[point], py[point],
+                self.x[start], self.y[start],
+                self.x[start + 1], self.y[start + 1])
+            seen = [np.concatenate(item)
+                    for item in zip(seen, (point, edges, d, ex, ey, t))]
+            point, edges, d = seen[:3]
+
+            # Every edge that has not been seen is at least r cells away,
+            # a point is done when k segments are closer than that
+            last = r >= max_r
+            if last:
+                within = np.arange(len(d))
+            else:
+                within = np.flatnonzero(d <= r * size - outside[point])
+            r += 1
+            if len(within) == 0:
+                if last:
+                    break
+                continue
+
+            # Closest edge of every point and segment, by distance
+            edge_segment = self.edge_segment[edges[within]]
+            key = point[within] * len(self.segment_ids) + edge_segment
+            order = np.lexsort((d[within], key))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = key[order][1:] != key[order][:-1]
+            best = order[first]
+            best = best[np.lexsort((d[within][best], point[within][best]))]
+
+            best_point = point[within][best]
+            starts = np.flatnonzero(np.concatenate(
+                [[True], best_point[1:] != best_point[:-1]]))
+            counts = np.diff(np.append(starts, len(best)))
+            rank = np.arange(len(best)) - np.repeat(starts, counts)
+            if last:
+                done[best_point] = True
+            else:
+                done[best_point[starts[counts >= k]]] = True
+
+            top = (rank < k) & done[best_point]
+            rows = best_point[top]
+            columns = rank[top]
+            top = within[best[top]]
+            segments[rows, columns] = self.edge_segment[edges[top]]
+            distance[rows, columns] = d[top]
+            x[rows, columns] = seen[3][top]
+            y[rows, columns] = seen[4][top]
+            fraction[rows, columns] = self.fraction(edges[top], seen[5][top])
+
+            if last:
+                break
+            keep = ~done[point]
+            seen = [item[keep] for item in seen]
+            pending = pending[~done[pending]]
+
+        if max_distance is not None:
+            far = distance > max_distance
+            segments[far] = -1
+            distance[far] = np.inf
+            x[far] = y[far] = fraction[far] = np.nan
+        return segments, distance, x, y, fraction
+
+    def fraction(self, edges, t):
+        """
+        Position along their segments, as a 0..1 ratio, of the points at
+        t along edges.
+        """
+        start = self.edge_start[edges]
+        length = self.segment_length[self.edge_segment[edges]]
+        along = (self.vertex_distance[start] + t
+                 * (self.vertex_distance[start + 1]
+                    - self.vertex_distance[start]))
+        return np.divide(along, length, out=np.zeros_like(along),
+                         where=length > 0)
+
+    def nearest(self, lng, lat, max_distance=None):
+        """
+        Return the closest segment id, its osm id, the distance in meters
+        and the closest point on it, or None when the index is empty or,
+        with max_distance, there is no segment within max_distance.
+        """
+        segments, distance, x, y, _ = self.query(lng, lat, 1, max_distance)
+        if len(segments) == 0:
+            return None
+
+        clng, clat = self.unproject(x[0], y[0])
+        return (int(self.segment_ids[segments[0]]),
+                int(self.osm_ids[segments[0]]),
+                float(distance[0]), float(clng), float(clat))
+
+    def candidates(self, lngs, lats, k=4, max_distance=None):
+        """
+        Find the k closest segments of every point, within max_distance
+        meters when given.
+
+        The points are projected, looked up (see search()) and the closest
+        points unprojected, all at once.
+        """
+        pxs, pys = self.project(np.asarray(lngs, dtype=np.float64),
+                                np.asarray(lats, dtype=np.float64))
+        segments, distance, x, y, fraction = self.search(pxs, pys, k,
+                                                         max_distance)
+
+        found = segments >= 0
+        segment_id = np.full(segments.shape, -1, dtype=np.int64)
+        osm_id = np.full(segments.shape, -1, dtype=np.int64)
+        segment_id[found] = self.segment_ids[segments[found]]
+        osm_id[found] = self.osm_ids[segments[found]]
+
+        clng, clat = self.unproject(x, y)
+        return Candidates(segment_id, osm_id, distance, clng, clat, fraction)
@@ -0,0 +1,352 @@
+"""
+Timing and counters shared by the importers and the matchers.
+
+- span(name): nested timed blocks, with wall and CPU time, the peak RSS
+  and the counters added with add() (rows, bytes, ...) while they run
+- observe(name, value, count): histograms of latencies in seconds,
+  with log2 buckets, where a value can stand for count samples
+- connect(): a psycopg2 connection whose cursors count and time every
+  round trip to the database
+
+Worker processes start with reset() and send what they recorded to the
+parent with collect() and merge(), it would be lost when they exit
+otherwise.
+
+Nothing is recorded until configure() picks an output:
+
+- json: one JSON line per closed span, then the histograms and the
+  database statistics at exit
+- table: a summary table at exit, spans merged by their path
+
+When disabled, span() returns a shared no-op object and add() and
+observe() return right away, so the calls can stay in hot paths.
+"""
+
+import atexit
+import json
+import math
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MODES = ['json', 'table']
+ENV = 'MM_PROFILE'
+
+_mode = None
+_output = None
+_stack = []
+_spans = {}
+_histograms = {}
+
+def max_rss():
+    """
+    Peak resident set size of the process in MB.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+class Span(object):
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        _stack.append(self)
+        self.path = '/'.join(span.name for span in _stack)
+        if _mode == 'table' and self.path not in _spans:
+            # Keeps the table in the order the spans first started
+            _spans[self.path] = dict(order=len(_spans),
+                                     depth=len(_stack) - 1,
+                                     count=0, wall=0.0, cpu=0.0)
+        self.cpu = cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.time() - self.start
+        self.cpu = cpu_time() - self.cpu
+        _stack.pop()
+        if _mode is None:
+            return
+
+        if _mode == 'json':
+            record = dict(type='span', name=self.name, path=self.path,
+                          depth=len(_stack), wall=self.wall, cpu=self.cpu,
+                          max_rss_mb=max_rss(), pid=os.getpid())
+            record.update(self.attrs)
+            record.update(self.counters)
+            write(record)
+        else:
+            total = _spans[self.path]
+            total['count'] += 1
+            total['wall'] += self.wall
+            total['cpu'] += self.cpu
+            for key, value in self.counters.items():
+                total[key] = total.get(key, 0) + value
+
+class NullSpan(object):
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_null = NullSpan()
+
+def span(name, **attrs):
+    if _mode is None:
+        return _null
+    return Span(name, attrs)
+
+def add(**counters):
+    """
+    Add to the counters of the innermost running span.
+    """
+    if _mode is None or not _stack:
+        return
+    _stack[-1].add(**counters)
+
+class Histogram(object):
+    """
+    Count, sum, min and max, plus counts per log2 bucket of microseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value, count=1):
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = int(math.log(value * 1e6, 2)) if value > 1e-6 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile, capped by
+        the maximum.
+        """
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2.0 ** (bucket + 1) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return dict(count=self.count, total=self.total, min=self.min,
+                    max=self.max, mean=self.total / self.count,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+def observe(name, value, count=1):
+    """
+    Add a value, in seconds, to the histogram name, as count samples
+    of that value.
+    """
+    if _mode is None:
+        return
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = Histogram()
+    histogram.add(value, count)
+
+def reset():
+    """
+    Forget the spans and histograms of the parent process, in a worker
+    process just forked from it.
+    """
+    global _spans, _histograms
+    del _stack[:]
+    _spans = {}
+    _histograms = {}
+
+def collect():
+    """
+    Take what this process recorded and is only written at exit: the
+    span totals (table) and the histograms. Called by a worker process
+    at the end of every task, the result goes to merge() in the parent.
+    """
+    global _spans, _histograms
+    if _mode is None:
+        return None
+    totals = (_spans, _histograms)
+    _spans = {}
+    _histograms = {}
+    return totals
+
+def merge(totals):
+    """
+    Add the totals of collect() in a worker process, its spans under the
+    innermost running span.
+    """
+    if _mode is None or totals is None:
+        return
+    spans, histograms = totals
+
+    prefix = ''.join('%s/' % span.name for span in _stack)
+    for path, total in sorted(spans.items(),
+                              key=lambda item: item[1]['order']):
+        mine = _spans.get(prefix + path)
+        if mine is None:
+            mine = _spans[prefix + path] = dict(
+                order=len(_spans), depth=total['depth'] + len(_stack),
+                count=0, wall=0.0, cpu=0.0)
+        for key, value in total.items():
+            if key not in ('order', 'depth'):
+                mine[key] = mine.get(key, 0) + value
+
+    for name, histogram in histograms.items():
+        if name in _histograms:
+            _histograms[name].merge(histogram)
+        else:
+            _histograms[name] = histogram
+
+def connect(**config):
+    """
+    psycopg2.connect() whose cursors time every execute() and copy as
+    a db.<method> histogram when enabled.
+    """
+    import psycopg2
+    if _mode is None:
+        return psycopg2.connect(**config)
+    return psycopg2.connect(cursor_factory=cursor_class(), **config)
+
+_cursor = None
+
+def cursor_class():
+    global _cursor
+    if _cursor is not None:
+        return _cursor
+
+    import psycopg2.extensions
+
+    def timed(method):
+        name = 'db.%s' % method.__name__
+
+        def wrapper(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                observe(name, time.time() - start)
+        wrapper.__name__ = method.__name__
+        return wrapper
+
+    base = psycopg2.extensions.cursor
+    _cursor = type('TimedCursor', (base,),
+                   dict((name, timed(getattr(base, name)))
+                        for name in ('execute', 'executemany',
+                                     'copy_expert', 'copy_from',
+                                     'copy_to', 'callproc')))
+    return _cursor
+
+def write(record):
+    _output.write(json.dumps(record, sort_keys=True) + '\n')
+    _output.flush()
+
+def configure(mode, path=None):
+    """
+    Enable the output mode (json or table) to path, stderr by default.
+    None disables everything.
+    """
+    global _mode, _output
+    assert mode in MODES or mode is None, 'Unknown mode: %s' % mode
+    _mode = mode
+    if mode is None:
+        return
+    _output = open(path, 'a') if path else sys.stderr
+    atexit.register(report)
+
+def add_arguments(parser, default=None):
+    """
+    --profile and --profile-output options. The default comes from the
+    MM_PROFILE environment variable.
+    """
+    parser.add_argument('--profile', choices=MODES,
+                        default=os.environ.get(ENV, default),
+                        help='record timings and counters as json lines '
+                             'or a summary table (default: %(default)s)')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='append the profile to FILE instead of stderr')
+
+def setup(args):
+    configure(args.profile, args.profile_output)
+
+def report():
+    """
+    Write what is not written as it happens: the span totals (table),
+    the histograms and the peak RSS.
+    """
+    if _mode is None:
+        return
+
+    if _mode == 'json':
+        for name, histogram in sorted(_histograms.items()):
+            record = dict(type='histogram', name=name, pid=os.getpid())
+            record.update(histogram.summary())
+            write(record)
+        write(dict(type='process', max_rss_mb=max_rss(), pid=os.getpid()))
+        return
+
+    out = _output
+    if _spans:
+        out.write('%-48s %6s %10s %10s %12s %12s\n'
+                  % ('span', 'count', 'wall', 'cpu', 'rows', 'rows/s'))
+        for path, total in sorted(_spans.items(),
+                                  key=lambda item: item[1]['order']):
+            name = '  ' * total['depth'] + path.rsplit('/', 1)[-1]
+            rows = total.get('rows')
+            out.write('%-48s %6d %9.3fs %9.3fs %12s %12s\n'
+                      % (name[:48], total['count'], total['wall'],
+                         total['cpu'], '' if rows is None else rows,
+                         '' if rows is None or not total['wall']
+                         else '%.0f' % (rows / total['wall'])))
+    if _histograms:
+        out.write('%-32s %8s %10s %10s %10s %10s\n'
+                  % ('histogram', 'count', 'mean', 'p50', 'p99', 'max'))
+        for name, histogram in sorted(_histograms.items()):
+            s = histogram.summary()
+            out.write('%-32s %8d %9.2fms %9.2fms %9.2fms %9.2fms\n'
+                      % (name, s['count'], s['mean'] * 1e3, s['p50'] * 1e3,
+                         s['p99'] * 1e3, s['max'] * 1e3))
+    rss = max_rss()
+    if rss is not None:
+        out.write('Peak RSS: %.1f MB\n' % rss)
+    out.flush()
@@ -1,24 +1,29 @@
-import sys
-import re
-import math
+import argparse
+import time
 
-import psycopg2
+import numpy as np
 
-DB_CONFIG = dict(dbname='mm',
-                 user='angkot',
-                 host='localhost',
-                 password='angkot')
 import plot
+from cache import SegmentCache
+from downsample import DownSampler
+from index import SegmentIndex
+import candidates
+from hmm import HMM
+from graph import RoadGraph
+import instrument
+from snapshot import Snapshot
+import traces
+from traces import DB_CONFIG
 
 class Lines(object):
     """
     Store the closest road segments and also plot them
     """
-    items_unique = set()
-    items = []
 
-    def __init__(self, c):
-        self.c = c
+    def __init__(self, cache):
+        self.cache = cache
+        self.items_unique = set()
+        self.items = []
 
     def append(self, item):
         segment_id, osm_id = item
@@ -29,117 +34,98 @@ class Lines(object):
             self.draw(segment_id)
 
     def draw(self, segment_id):
-        self.c.execute('''
-            SELECT ST_AsText(geometry)
-            FROM mm_segment
-            WHERE id=%s
-            ''', (segment_id,))
-        g = self.c.fetchone()[0]
-        coords = map(lambda x: map(float, x.split()),
-                     re.sub(r'^.+\((.+)\).*$', r'\1', g).split(','))
+        coords = self.cache.get(segment_id).tolist()
 
         plot.drawLine(coords, dict(color='red'))
         plot.drawPoints(coords, dict(color='green', radius=2))
 
-class DownSampler(object):
-    """
-    GPS data down sampler.
-
-    This will reduce the density of the GPS data. The resulting
-    GPS data points will have distance distance at least 100 meter
-    for every two consecutive points.
-    """
-
-    MIN_DISTANCE = 100 # M
-
-    def __init__(self):
-        self.lng = None
-        self.lat = None
-        self.angle = None
-
-    def is_next(self, lng, lat):
-        if None in [self.lng, self.lat]:
-            self.lng = lng
-            self.lat = lat
-            return True
-
-        distance = self.get_distance(lng, lat)
-        if distance >= self.MIN_DISTANCE:
-            self.lng = lng
-            self.lat = lat
-            return True
-
-        return False
-
-    def get_distance(self, lng, lat):
-        # From http://www.movable-type.co.uk/scripts/latlong.html
-
-        R = 6371 # KM
-
-        lat1, lng1, lat2, lng2 = map(math.radians,
-                                     (self.lat, self.lng, lat, lng))
-        x = (lng2-lng1) * math.cos((lat1+lat2)/2.0)
-        y = lat2-lat1
-        d = math.sqrt(x*x + y*y) * R
-        return d * 1000 # M
-
 def main():
-    conn = psycopg2.connect(**DB_CONFIG)
-    c = conn.cursor()
-
-    coords = []
-    # Input is a file containing lines of longitude, latitude number pairs
-    for line in open(sys.argv[1]):
-        coords.append(map(float, line.split()))
-
-    ds = DownSampler()
-
-    lines = Lines(c)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace',
+                        help='file containing lines of longitude, '
+                             'latitude number pairs, optionally followed '
+                             'by a timestamp in seconds')
+    traces.add_arguments(parser)
+    parser.add_argument('--no-plot', action='store_true',
+                        help='do not send anything to the visualization '
+                             'tool')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.no_plot:
+        plot.use(plot.NullBackend())
+
+    if args.snapshot:
+        if args.lookup == 'db':
+            parser.error('--lookup=db needs the database')
+        snapshot = Snapshot(args.snapshot)
+    else:
+        conn = instrument.connect(**DB_CONFIG)
+        c = conn.cursor()
+
+    with instrument.span('Read trace'):
+        coords = traces.read_trace(args.trace)
+        instrument.add(rows=len(coords))
+
+    with instrument.span('Downsample'):
+        ds = DownSampler(args.min_distance, args.max_interval, args.min_turn)
+        points = traces.downsample(coords, ds)
+        instrument.add(rows=len(coords))
+
+    if args.snapshot:
+        lookup = snapshot.index.candidates
+    elif args.lookup == 'db':
+        lookup = lambda lngs, lats, k: candidates.fetch(c, lngs, lats, k)
+    else:
+        with instrument.span('Load index'):
+            lookup = SegmentIndex.from_db(c).candidates
+
+    hmm = None
+    if args.matcher == 'hmm':
+        if args.snapshot:
+            road = snapshot.graph
+        else:
+            road = RoadGraph.load(args.graph) if args.graph else None
+        hmm = HMM(graph=road)
+
+    k = args.k if hmm is not None else 1
+    start = time.time()
+    cand, path = traces.match(points, lookup, k, hmm)
+    traces.observe(time.time() - start, len(points))
+
+    cache = snapshot if args.snapshot else SegmentCache(c)
+    cache.prefetch(cand.segment_id[np.arange(len(path)), path][path >= 0])
+
+    lines = Lines(cache)
     total = len(coords)
     idx = 0
 
-    for lng, lat in coords:
-        if not ds.is_next(lng, lat):
-            continue
-
+    for i, (lng, lat) in enumerate(points):
         plot.drawPoint((lng, lat),
                        dict(radius=7, color='blue', weight=1,
                             fillOpacity=0.4))
 
-        # Get the closest road segment
-        c.execute('''
-            SELECT id, osm_id, ST_Distance(geometry, ST_GeomFromText('POINT(%s %s)', 4326)) AS distance
-            FROM mm_segment
-            ORDER BY distance ASC
-            LIMIT 1
-            ''', (lng, lat))
-        segment_id, osm_id = c.fetchone()[0:2]
+        j = path[i]
+        if j < 0:
+            continue
+        segment_id = int(cand.segment_id[i, j])
+        osm_id = int(cand.osm_id[i, j])
         lines.append((segment_id, osm_id))
 
         # Plot the segment
-        c.execute('''
-            SELECT ST_AsText(
-                     ST_ClosestPoint(
-                        geometry,
-                        ST_GeomFromText('POINT(%s %s)', 4326)))
-            FROM mm_segment
-            WHERE id=%s
-            ''', (lng, lat, segment_id))
-        p = c.fetchone()[0]
-        clng, clat = map(float, re.sub(r'^.+\((.+)\).*$', r'\1', p).split())
+        clng = float(cand.lng[i, j])
+        clat = float(cand.lat[i, j])
         plot.drawLine([[lng, lat], [clng, clat]],
                       dict(weight=5, color='blue'))
 
         idx += 1
         print idx, '/', total, '=>', lng, lat, '=>', osm_id
 
-    c.execute('''
-        SELECT id, osm_id, ST_AsText(geometry)
-        FROM mm_segment
-        WHERE id IN ( %s )
-        ''' % ', '.join([str(segment_id) for segment_id, _ in lines.items]))
-    for row in c:
-        print row
+    for segment_id, osm_id in lines.items:
+        print segment_id, osm_id, cache.get(segment_id).tolist()
+
+    plot.flush()
 
 if __name__ == '__main__':
     main()
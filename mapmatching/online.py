@@ -0,0 +1,223 @@
+"""
+Online fixed-lag map matching of live GPS streams.
+
+Points are pushed one at a time per vehicle. Every vehicle keeps its own
+DownSampler (so the same points are admitted as in batch matching) and a
+bounded Viterbi lattice: the candidates and back pointers of the last
+few admitted points only.
+
+A point is finalized, and emitted, as soon as all the surviving paths
+agree on it (convergence), or at the latest when it is `lag` points
+behind the newest point. Memory per vehicle is O(lag).
+"""
+
+from collections import deque, namedtuple
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from downsample import DownSampler
+from graph import RoadGraph
+from hmm import HMM
+from index import Candidates, SegmentIndex
+import instrument
+from snapshot import Snapshot
+
+MatchedPoint = namedtuple('MatchedPoint',
+                          'vehicle seq lng lat segment_id osm_id '
+                          'matched_lng matched_lat')
+
+class Vehicle(object):
+    """
+    Matching state of a single vehicle.
+    """
+
+    __slots__ = ('ds', 'seq', 'window', 'scores', 'last')
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.seq = 0
+        # (seq, lng, lat, candidates, back pointers) of the unfinalized
+        # points, oldest first
+        self.window = deque()
+        self.scores = None
+        # (lng, lat, candidates) of the last admitted point
+        self.last = None
+
+class OnlineMatcher(object):
+    """
+    Incremental HMM matcher for many vehicles at once.
+    """
+
+    LAG = 10
+
+    def __init__(self, index, hmm=None, k=4, lag=LAG,
+                 downsampler=DownSampler):
+        self.index = index
+        self.hmm = hmm if hmm is not None else HMM()
+        self.k = k
+        self.lag = lag
+        self.downsampler = downsampler
+        self.vehicles = {}
+
+    def push(self, vehicle, lng, lat, time=None):
+        """
+        Add a point of a vehicle. Return the newly finalized points.
+        """
+        v = self.vehicles.get(vehicle)
+        if v is None:
+            v = self.vehicles[vehicle] = Vehicle(self.downsampler())
+
+        seq = v.seq
+        v.seq += 1
+        if not v.ds.is_next(lng, lat, time):
+            return []
+
+        cand = self.index.candidates([lng], [lat], self.k)
+        emission = self.hmm.emission(cand)[0]
+
+        result = []
+        if v.last is None:
+            scores = emission
+            back = np.full(self.k, -1, dtype=np.int64)
+        else:
+            plng, plat, prev = v.last
+            pair = Candidates(*[np.concatenate([a, b])
+                                for a, b in zip(prev, cand)])
+            transition = self.hmm.transition(pair, [plng, lng],
+                                             [plat, lat])[0]
+            scores, back = self.hmm.step(v.scores, transition, emission)
+            if (back < 0).all():
+                # Break, nothing before this point can change anymore
+                result = self.finalize(vehicle, v, len(v.window))
+
+        v.scores = scores
+        v.last = (lng, lat, cand)
+        v.window.append((seq, lng, lat, cand, back))
+
+        converged = self.converged(v)
+        if converged > 0:
+            result += self.finalize(vehicle, v, converged)
+        if len(v.window) > self.lag:
+            result += self.finalize(vehicle, v, len(v.window) - self.lag)
+
+        return result
+
+    def flush(self, vehicle):
+        """
+        Finalize all points of a vehicle and forget it.
+        """
+        v = self.vehicles.pop(vehicle, None)
+        if v is None:
+            return []
+        return self.finalize(vehicle, v, len(v.window))
+
+    def converged(self, v):
+        """
+        Return how many of the oldest points are shared by all the
+        surviving paths.
+        """
+        states = np.flatnonzero(np.isfinite(v.scores))
+        for t in range(len(v.window) - 1, -1, -1):
+            if len(states) <= 1:
+                return t + 1
+            back = v.window[t][4]
+            if (back < 0).all():
+                return t
+            states = np.unique(back[states])
+        return 0
+
+    def backtrack(self, v):
+        """
+        Return the best candidate of every point in the window.
+        """
+        path = [-1] * len(v.window)
+        j = int(np.argmax(v.scores)) if np.isfinite(v.scores).any() else -1
+        for t in range(len(v.window) - 1, -1, -1):
+            path[t] = j
+            if j >= 0:
+                j = int(v.window[t][4][j])
+        return path
+
+    def finalize(self, vehicle, v, count):
+        """
+        Emit and drop the count oldest points of the window.
+        """
+        path = self.backtrack(v)
+        result = []
+        for j in path[:count]:
+            seq, lng, lat, cand, _ = v.window.popleft()
+            if j < 0:
+                result.append(MatchedPoint(vehicle, seq, lng, lat,
+                                           None, None, None, None))
+                continue
+            result.append(MatchedPoint(vehicle, seq, lng, lat,
+                                       int(cand.segment_id[0, j]),
+                                       int(cand.osm_id[0, j]),
+                                       float(cand.lng[0, j]),
+                                       float(cand.lat[0, j])))
+
+        # The oldest remaining point has no predecessor anymore
+        if v.window:
+            v.window[0][4][:] = -1
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Read "vehicle lng lat [time]" lines from stdin and '
+                    'print the finalized matched points')
+    parser.add_argument('--index', metavar='DIR',
+                        help='saved road index, built from the database '
+                             'when missing')
+    parser.add_argument('--graph', metavar='DIR',
+                        help='routing graph written by import.py')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='road network snapshot written by import.py, '
+                             'used instead of --index and --graph')
+    parser.add_argument('-k', type=int, default=4)
+    parser.add_argument('--lag', type=int, default=OnlineMatcher.LAG)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.snapshot:
+        snapshot = Snapshot(args.snapshot)
+        index = snapshot.index
+    elif args.index:
+        index = SegmentIndex.load(args.index)
+    else:
+        from traces import DB_CONFIG
+        conn = instrument.connect(**DB_CONFIG)
+        index = SegmentIndex.from_db(conn.cursor())
+        conn.close()
+
+    if args.snapshot:
+        road = snapshot.graph
+    else:
+        road = RoadGraph.load(args.graph) if args.graph else None
+    matcher = OnlineMatcher(index, HMM(graph=road), args.k, args.lag)
+
+    def emit(points):
+        for point in points:
+            sys.stdout.write('\t'.join('' if v is None else str(v)
+                                       for v in point) + '\n')
+        sys.stdout.flush()
+
+    for line in iter(sys.stdin.readline, ''):
+        values = line.split()
+        if len(values) < 3:
+            continue
+        stamp = float(values[3]) if len(values) > 3 else None
+        start = time.time()
+        points = matcher.push(values[0], float(values[1]), float(values[2]),
+                              stamp)
+        instrument.observe('match.push', time.time() - start)
+        emit(points)
+
+    for vehicle in list(matcher.vehicles):
+        emit(matcher.flush(vehicle))
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,164 @@
+import atexit
+import httplib
 import json
+import sys
+import threading
 import urllib
-import urllib2
+import urlparse
+from Queue import Queue
 
 ADDRESS = 'http://localhost:8000/update'
 
+BATCH = 256
+
+class NullBackend(object):
+    """
+    Drop everything. Used when visualization is off.
+    """
+    active = False
+
+    def send(self, cmd, param):
+        pass
+
+    def flush(self):
+        pass
+
+class HTTPBackend(object):
+    """
+    Send draw commands to the visualization server.
+
+    Commands are buffered and sent by a background thread over a single
+    keep-alive connection, so drawing never blocks the caller.
+    Consecutive drawPoint commands with the same options are merged into
+    one drawPoints command.
+    """
+    active = True
+
+    def __init__(self, address=ADDRESS, threaded=True):
+        url = urlparse.urlparse(address)
+        self.host = url.netloc
+        self.path = url.path or '/'
+        self.conn = None
+        self.threaded = threaded
+        self.buffer = []
+
+        self.queue = Queue()
+        self.thread = None
+
+    def send(self, cmd, param):
+        if self.threaded:
+            # Started lazily, also after a fork
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.queue.put((cmd, param))
+            return
+
+        self.buffer.append((cmd, param))
+        if len(self.buffer) >= BATCH:
+            self.flush()
+
+    def flush(self):
+        """
+        Block until every buffered command has been sent.
+        """
+        if self.threaded:
+            self.queue.join()
+            return
+
+        buffer, self.buffer = self.buffer, []
+        self.post_all(buffer)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH and not self.queue.empty():
+                batch.append(self.queue.get())
+            try:
+                self.post_all(batch)
+            except Exception, e:
+                print >>sys.stderr, '[plot] %s' % e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def post_all(self, commands):
+        for cmd, param in merge(commands):
+            self.post(cmd, param)
+
+    def post(self, cmd, param):
+        body = urllib.urlencode(dict(cmd=cmd, param=json.dumps(param)))
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'Connection': 'keep-alive'}
+        for retry in (True, False):
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection(self.host)
+            try:
+                self.conn.request('POST', self.path, body, headers)
+                self.conn.getresponse().read()
+                return
+            except (httplib.HTTPException, IOError):
+                # The server closed the connection, reconnect once
+                self.conn.close()
+                self.conn = None
+                if not retry:
+                    raise
+
+def merge(commands):
+    """
+    Merge consecutive drawPoint commands with the same options.
+    """
+    result = []
+    for cmd, param in commands:
+        if cmd == 'drawPoint' and result:
+            last_cmd, last_param = result[-1]
+            if last_cmd in ('drawPoint', 'drawPoints') \
+                    and last_param[1] == param[1]:
+                if last_cmd == 'drawPoint':
+                    last_param = [[last_param[0]], last_param[1]]
+                last_param[0].append(param[0])
+                result[-1] = ('drawPoints', last_param)
+                continue
+        result.append((cmd, param))
+    return result
+
+backend = HTTPBackend()
+
+def use(new_backend):
+    """
+    Switch the backend, e.g. use(NullBackend()) to turn plotting off.
+    """
+    global backend
+    backend.flush()
+    backend = new_backend
+
+def flush():
+    backend.flush()
+
+atexit.register(flush)
+
 def call(cmd, param):
-    q = dict(cmd=cmd, param=json.dumps(param))
-    p = urllib2.urlopen(ADDRESS, urllib.urlencode(q))
-    p.read()
+    backend.send(cmd, param)
 
 def drawLine(coords, opts=None):
+    if not backend.active:
+        return
     if opts is None:
         opts = {}
     call('drawLine', [[(lat, lng) for lng, lat in coords], opts])
 
 def drawPoint(coord, opts=None):
+    if not backend.active:
+        return
     if opts is None:
         opts = {}
     lng, lat = coord
     call('drawPoint', [[lat, lng], opts])
 
 def drawPoints(coords, opts=None):
+    if not backend.active:
+        return
     if opts is None:
         opts = {}
     call('drawPoints', [[(lat, lng) for lng, lat in coords], opts])
-
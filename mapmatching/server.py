@@ -0,0 +1,429 @@
+"""
+Map matching HTTP service.
+
+A long-running asyncio process (Python 3.5+) that matches the traces
+POSTed to it, so the road index, the routing graph and the database
+connections are set up once for many small traces:
+
+    python3 server.py --snapshot jakarta.snap --matcher hmm
+
+    POST /match  {"points": [[lng, lat], [lng, lat, time], ...]}
+    => {"points": [[lng, lat, segment_id, osm_id, matched lng,
+                    matched lat], ...]}
+
+    GET /status  => pending traces and batch counters
+
+The points of the concurrent traces are batched: the traces that come
+in while the lookups are busy wait for the next one, and their candidates
+are looked up together, up to --batch-points, with the in-memory index
+or with one KNN query. The lookups run in a thread pool, one per
+database connection with --lookup=db, where every connection has the
+candidates statement prepared.
+
+Backpressure: at most --max-pending traces are matched at a time, the
+next ones are answered right away with 503 and a Retry-After header, and
+bodies larger than --max-body are refused with 413.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import queue
+import signal
+import sys
+import time
+
+import candidates
+from downsample import DownSampler
+from graph import RoadGraph
+from hmm import HMM
+from index import Candidates, SegmentIndex
+import instrument
+from snapshot import Snapshot
+import traces
+from traces import DB_CONFIG
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or REASONS[status])
+        self.status = status
+
+class ConnectionPool(object):
+    """
+    Database connections with the candidates statement prepared, shared
+    by the lookup threads.
+
+    A connection that failed (the server restarted or went away) is
+    closed and replaced, and the lookup is tried once more on the new
+    one. When the database cannot be reached, the closed connection
+    goes back to the pool and the next lookup reconnects.
+    """
+
+    def __init__(self, size, **config):
+        import psycopg2
+        self.errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+        self.config = config
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(self.open())
+
+    def open(self):
+        conn = instrument.connect(**self.config)
+        conn.autocommit = True
+        candidates.prepare(conn.cursor())
+        return conn
+
+    def fetch(self, lngs, lats, k):
+        conn = self.connections.get()
+        try:
+            for attempt in range(2):
+                try:
+                    if conn.closed:
+                        conn = self.open()
+                    return candidates.fetch(conn.cursor(), lngs, lats, k,
+                                            prepared=True)
+                except self.errors:
+                    conn.close()
+                    if attempt:
+                        raise
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+class Batcher(object):
+    """
+    Group the candidate lookups of concurrent traces.
+
+    lookup(lngs, lats, k) runs in executor with the points of all the
+    traces queued with the same k, at most workers lookups at a time,
+    and every trace gets its rows of the Candidates back. The points
+    only wait while the lookups are busy: the traces that come in
+    meanwhile are looked up together in one call of at most
+    batch_points points (or one trace), which the index does on whole
+    arrays, see SegmentIndex.search().
+    """
+
+    BATCH_POINTS = 512
+
+    def __init__(self, lookup, executor, workers=1,
+                 batch_points=BATCH_POINTS):
+        self.lookup = lookup
+        self.executor = executor
+        self.workers = workers
+        self.batch_points = batch_points
+        # k -> [(lngs, lats, future)], queued points
+        self.queued = {}
+        self.running = 0
+        self.scheduled = False
+        self.batches = 0
+        self.batched = 0
+
+    async def candidates(self, lngs, lats, k):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.queued.setdefault(k, []).append((lngs, lats, future))
+        self.schedule()
+        return await future
+
+    def schedule(self):
+        # Once the traces of this loop iteration are queued
+        if not self.scheduled and self.running < self.workers:
+            self.scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        while self.queued and self.running < self.workers:
+            k = next(iter(self.queued))
+            queued = self.queued[k]
+            points = len(queued[0][0])
+            count = 1
+            while count < len(queued) \
+                    and points + len(queued[count][0]) <= self.batch_points:
+                points += len(queued[count][0])
+                count += 1
+            items = queued[:count]
+            if count < len(queued):
+                self.queued[k] = queued[count:]
+            else:
+                del self.queued[k]
+            self.running += 1
+            asyncio.ensure_future(self.run(k, items))
+
+    async def run(self, k, items):
+        lngs = [lng for item in items for lng in item[0]]
+        lats = [lat for item in items for lat in item[1]]
+        self.batches += 1
+        self.batched += len(items)
+
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        try:
+            cand = await loop.run_in_executor(self.executor, self.lookup,
+                                              lngs, lats, k)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.running -= 1
+            if self.queued:
+                self.schedule()
+        instrument.observe('server.lookup', time.time() - start)
+
+        offset = 0
+        for item_lngs, _, future in items:
+            end = offset + len(item_lngs)
+            if not future.done():
+                future.set_result(Candidates(*[value[offset:end]
+                                               for value in cand]))
+            offset = end
+
+class Service(object):
+    """
+    Match the traces of the requests.
+    """
+
+    def __init__(self, batcher, hmm=None, k=4, max_pending=256,
+                 downsampler=DownSampler):
+        self.batcher = batcher
+        self.hmm = hmm
+        self.k = k if hmm is not None else 1
+        self.max_pending = max_pending
+        self.downsampler = downsampler
+        self.pending = 0
+        self.traces = 0
+        self.rejected = 0
+
+    async def match(self, trace):
+        """
+        Return the rows of the kept points of a trace, see traces.rows().
+        """
+        start = time.time()
+        try:
+            points = traces.downsample(trace['points'], self.downsampler())
+        except (KeyError, TypeError, ValueError, IndexError):
+            raise HTTPError(400, 'Expected {"points": [[lng, lat], ...]}')
+        if not points:
+            return []
+
+        lngs = [lng for lng, _ in points]
+        lats = [lat for _, lat in points]
+        cand = await self.batcher.candidates(lngs, lats, self.k)
+        if self.hmm is None:
+            path = traces.select(cand, lngs, lats)
+        else:
+            # Off the event loop, the Viterbi pass is the costly part
+            path = await asyncio.get_event_loop().run_in_executor(
+                None, traces.select, cand, lngs, lats, self.hmm)
+
+        rows = traces.rows(points, cand, path)
+        traces.observe(time.time() - start, len(rows))
+        return rows
+
+    async def handle(self, method, path, body):
+        """
+        Return the status and the JSON response of a request.
+        """
+        if path == '/status':
+            return 200, dict(pending=self.pending, traces=self.traces,
+                             rejected=self.rejected,
+                             batches=self.batcher.batches,
+                             batched=self.batcher.batched)
+        if path != '/match':
+            raise HTTPError(404)
+        if method != 'POST':
+            raise HTTPError(405)
+
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPError(503, 'Too many pending traces')
+        self.pending += 1
+        try:
+            try:
+                trace = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise HTTPError(400, 'Invalid JSON')
+            rows = await self.match(trace)
+        finally:
+            self.pending -= 1
+        self.traces += 1
+        return 200, dict(points=rows)
+
+class Server(object):
+    """
+    Minimal HTTP/1.1 front of a Service, with keep-alive.
+    """
+
+    MAX_BODY = 1 << 20
+    MAX_HEADER = 8192
+
+    def __init__(self, service, max_body=MAX_BODY):
+        self.service = service
+        self.max_body = max_body
+
+    async def client(self, reader, writer):
+        try:
+            while True:
+                keep_alive = await self.request(reader, writer)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def request(self, reader, writer):
+        """
+        Answer one request, return whether the connection stays open.
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            return False
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return False
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, version = lines[0].split(' ', 2)
+        except ValueError:
+            await self.respond(writer, 400, dict(error='Bad request line'),
+                               False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' \
+            and version == 'HTTP/1.1'
+
+        try:
+            size = int(headers.get('content-length', 0))
+        except ValueError:
+            size = -1
+        if size < 0 or size > self.max_body:
+            # The body is not read, the connection cannot be reused
+            status = 400 if size < 0 else 413
+            await self.respond(writer, status, dict(error=REASONS[status]),
+                               False)
+            return False
+        body = await reader.readexactly(size)
+
+        extra = {}
+        try:
+            status, result = await self.service.handle(
+                method, path.split('?', 1)[0], body)
+        except HTTPError as e:
+            status, result = e.status, dict(error=str(e))
+            if status == 503:
+                extra['Retry-After'] = '1'
+        except Exception as e:
+            status, result = 500, dict(error=str(e))
+        await self.respond(writer, status, result, keep_alive, extra)
+        return keep_alive
+
+    async def respond(self, writer, status, result, keep_alive, extra=None):
+        body = json.dumps(result).encode('utf-8')
+        head = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+                'Content-Type: application/json',
+                'Content-Length: %d' % len(body),
+                'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        if extra:
+            head.extend('%s: %s' % item for item in sorted(extra.items()))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+                     + body)
+        await writer.drain()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    traces.add_arguments(parser)
+    parser.add_argument('--index', metavar='DIR',
+                        help='saved road index, built from the database '
+                             'when missing')
+    parser.add_argument('--pool', type=int, default=4,
+                        help='database connections (and lookup threads) '
+                             'with --lookup=db')
+    parser.add_argument('--batch-points', type=int,
+                        default=Batcher.BATCH_POINTS,
+                        help='most points looked up at once')
+    parser.add_argument('--max-pending', type=int, default=256,
+                        help='traces matched at a time, the next ones are '
+                             'refused with 503')
+    parser.add_argument('--max-body', type=int, default=Server.MAX_BODY,
+                        help='largest accepted request in bytes')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.snapshot and args.lookup == 'db':
+        parser.error('--lookup=db needs the database')
+    instrument.setup(args)
+
+    pool = None
+    if args.lookup == 'db':
+        pool = ConnectionPool(args.pool, **DB_CONFIG)
+        lookup = pool.fetch
+        workers = args.pool
+    else:
+        if args.snapshot:
+            snapshot = Snapshot(args.snapshot)
+            index = snapshot.index
+        elif args.index:
+            index = SegmentIndex.load(args.index)
+        else:
+            with instrument.span('Load index'):
+                conn = instrument.connect(**DB_CONFIG)
+                index = SegmentIndex.from_db(conn.cursor())
+                conn.close()
+        lookup = index.candidates
+        # The index lookups hold the GIL most of the time, more threads
+        # would only interleave them
+        workers = 1
+
+    hmm = None
+    if args.matcher == 'hmm':
+        if args.snapshot:
+            road = snapshot.graph
+        else:
+            road = RoadGraph.load(args.graph) if args.graph else None
+        hmm = HMM(graph=road)
+
+    downsampler = lambda: DownSampler(args.min_distance, args.max_interval,
+                                      args.min_turn)
+    executor = ThreadPoolExecutor(workers)
+    batcher = Batcher(lookup, executor, workers, args.batch_points)
+    service = Service(batcher, hmm, args.k, args.max_pending, downsampler)
+    server = Server(service, args.max_body)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(asyncio.start_server(
+        server.client, args.host, args.port, limit=Server.MAX_HEADER))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    sys.stderr.write('Listening on %s:%d\n' % (args.host, args.port))
+    try:
+        loop.run_forever()
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        executor.shutdown()
+        if pool is not None:
+            pool.close()
+
+if __name__ == '__main__':
+    main()
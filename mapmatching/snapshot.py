@@ -0,0 +1,150 @@
+"""
+Self-contained road network snapshot for matching without a database.
+
+Everything the matcher reads is written to a single file: the segment
+coordinates and metadata, the spatial index and the routing graph. The
+file is a small JSON header followed by raw little-endian arrays aligned
+to 64 bytes, so opening it is one mmap and every array is a view on the
+mapped pages. Nothing is parsed or copied, and processes opening the
+same file share its pages.
+
+Layout:
+
+- magic (8 bytes) and header size (uint64)
+- JSON header: name -> dtype, shape and offset of every array, plus the
+  scalars of the index and the highway names
+- the arrays
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from graph import NAMES, RoadGraph
+from index import SegmentIndex
+
+MAGIC = b'MMSNAP01'
+ALIGN = 64
+
+def write(path, index, lng, lat, highway, oneway, graph):
+    """
+    Write a snapshot.
+
+    index is a SegmentIndex, lng and lat are the coordinates of its
+    vertices, highway is the highway tag and oneway is 1 (forward only),
+    -1 (backward only) or 0 of every segment. graph holds the arrays of
+    the routing graph (graph.NAMES).
+    """
+    names = sorted(set(highway))
+    codes = dict((name, code) for code, name in enumerate(names))
+
+    arrays = [('index_%s' % name, getattr(index, name))
+              for name in SegmentIndex.ARRAYS]
+    arrays.append(('lng', lng))
+    arrays.append(('lat', lat))
+    arrays.append(('highway', [codes[value] for value in highway]))
+    arrays.append(('oneway', oneway))
+    arrays.extend(('graph_%s' % name, value)
+                  for name, value in sorted(graph.items()))
+
+    header = dict(arrays={}, highways=names,
+                  scalars=dict((name, float(getattr(index, name)))
+                               for name in SegmentIndex.SCALARS))
+    offset = 0
+    data = []
+    for name, value in arrays:
+        value = np.asarray(value)
+        if name == 'highway':
+            value = value.astype(np.int16)
+        elif name == 'oneway':
+            value = value.astype(np.int8)
+        value = np.ascontiguousarray(value,
+                                     dtype=value.dtype.newbyteorder('<'))
+        offset += -offset % ALIGN
+        header['arrays'][name] = dict(dtype=value.dtype.str,
+                                      shape=list(value.shape),
+                                      offset=offset)
+        data.append((offset, value))
+        offset += value.nbytes
+
+    raw = json.dumps(header, sort_keys=True).encode('utf-8')
+    start = len(MAGIC) + 8 + len(raw)
+    start += -start % ALIGN
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', start - len(MAGIC) - 8))
+        f.write(raw.ljust(start - len(MAGIC) - 8, b' '))
+        for offset, value in data:
+            f.seek(start + offset)
+            f.write(value.tobytes())
+
+class Snapshot(object):
+    """
+    A memory-mapped snapshot.
+
+    Provides the SegmentIndex (index), the RoadGraph (graph) and the
+    geometry of the segments. get() and prefetch() follow SegmentCache,
+    so a snapshot can stand in for it.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            assert magic == MAGIC, 'Not a snapshot: %s' % path
+            size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(size).decode('utf-8'))
+        start = len(MAGIC) + 8 + size
+
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(str(spec['dtype']))
+            shape = tuple(spec['shape'])
+            count = int(np.prod(shape)) if shape else 1
+            self.arrays[name] = np.frombuffer(
+                self.data, dtype=dtype, count=count,
+                offset=start + spec['offset']).reshape(shape)
+
+        self.highways = header['highways']
+        self.index = SegmentIndex.from_arrays(
+            dict((name, self.arrays['index_%s' % name])
+                 for name in SegmentIndex.ARRAYS),
+            header['scalars'])
+        self.lng = self.arrays['lng']
+        self.lat = self.arrays['lat']
+        self.oneway = self.arrays['oneway']
+
+        self.graph = RoadGraph(dict((name, self.arrays['graph_%s' % name])
+                                    for name in NAMES))
+
+    def position(self, segment_id):
+        """
+        Position of a segment in the index, -1 when unknown.
+        """
+        segment_ids = self.index.segment_ids
+        pos = int(np.searchsorted(segment_ids, segment_id))
+        if pos < len(segment_ids) and segment_ids[pos] == segment_id:
+            return pos
+        return -1
+
+    def highway(self, segment_id):
+        pos = self.position(segment_id)
+        if pos < 0:
+            return None
+        return self.highways[self.arrays['highway'][pos]]
+
+    def prefetch(self, segment_ids):
+        pass
+
+    def get(self, segment_id):
+        """
+        The (n, 2) array of lng, lat of a segment, None when unknown.
+        """
+        pos = self.position(segment_id)
+        if pos < 0:
+            return None
+        start = self.index.offsets[pos]
+        end = self.index.offsets[pos + 1]
+        return np.column_stack((self.lng[start:end], self.lat[start:end]))
@@ -0,0 +1,123 @@
+"""
+Matching of a whole trace, shared by the command line tools (match.py,
+batch.py) and the HTTP service (server.py).
+
+Like the other matcher modules, this runs under Python 2 and Python 3.
+"""
+
+import numpy as np
+
+from downsample import DownSampler
+import instrument
+
+DB_CONFIG = dict(dbname='mm',
+                 user='angkot',
+                 host='localhost',
+                 password='angkot')
+
+def add_arguments(parser):
+    """
+    Matching options shared by the command line tools.
+    """
+    parser.add_argument('--lookup', choices=['index', 'db'], default='index',
+                        help='find the closest segments with the in-memory '
+                             'index or with one KNN query per trace')
+    parser.add_argument('--matcher', choices=['nearest', 'hmm'],
+                        default='nearest',
+                        help='snap every point to its closest segment or '
+                             'pick the most likely sequence of segments')
+    parser.add_argument('-k', type=int, default=4,
+                        help='number of candidate segments per point for '
+                             'the hmm matcher')
+    parser.add_argument('--graph', metavar='DIR',
+                        help='routing graph written by import.py, used by '
+                             'the hmm matcher for network distances')
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help='road network snapshot written by import.py, '
+                             'used instead of the database and --graph')
+    parser.add_argument('--min-distance', type=float,
+                        default=DownSampler.MIN_DISTANCE,
+                        help='keep points at least this many meters apart')
+    parser.add_argument('--max-interval', type=float,
+                        help='also keep a point when this many seconds '
+                             'passed since the last kept point')
+    parser.add_argument('--min-turn', type=float,
+                        help='also keep a point when the heading turns by '
+                             'this many degrees')
+
+def read_trace(path):
+    # Input is a file containing lines of longitude, latitude number pairs
+    coords = []
+    for line in open(path):
+        coords.append([float(value) for value in line.split()])
+    return coords
+
+def downsample(coords, ds):
+    """
+    Return the (lng, lat) of the kept points.
+    """
+    if len(coords) == 0:
+        return []
+    data = np.array([coord[:3] for coord in coords], dtype=np.float64)
+    times = data[:, 2] if data.shape[1] > 2 else None
+    kept = ds.sample(data[:, 0], data[:, 1], times)
+    return [tuple(coords[i][:2]) for i in kept]
+
+def select(cand, lngs, lats, hmm=None):
+    """
+    Return the index of the matched candidate of every point (-1 when
+    there is none): the most likely sequence with hmm, the closest
+    candidate otherwise.
+    """
+    if hmm is not None:
+        return hmm.match(cand, lngs, lats)
+    return np.where(cand.segment_id[:, 0] >= 0, 0, -1)
+
+def match(points, lookup, k=1, hmm=None):
+    """
+    Match the downsampled points.
+
+    lookup(lngs, lats, k) returns the Candidates of the points. Return
+    the Candidates and the index of the matched candidate of every point
+    (-1 when there is none).
+    """
+    lngs = [lng for lng, _ in points]
+    lats = [lat for _, lat in points]
+
+    # Get the closest road segments
+    with instrument.span('Lookup', k=k):
+        cand = lookup(lngs, lats, k)
+        instrument.add(rows=len(points))
+
+    with instrument.span('Match'):
+        path = select(cand, lngs, lats, hmm)
+        instrument.add(rows=len(points))
+
+    return cand, path
+
+def rows(points, cand, path):
+    """
+    lng, lat, segment_id, osm_id, matched lng, matched lat of every
+    point, the last four None when it is not matched.
+    """
+    result = []
+    for i, (lng, lat) in enumerate(points):
+        j = path[i]
+        if j < 0:
+            result.append((lng, lat, None, None, None, None))
+            continue
+        result.append((lng, lat,
+                       int(cand.segment_id[i, j]), int(cand.osm_id[i, j]),
+                       float(cand.lng[i, j]), float(cand.lat[i, j])))
+    return result
+
+def observe(elapsed, points):
+    """
+    Record the time taken to match a trace of points: match.trace per
+    trace, and match.trace_per_point the mean time per point of every
+    trace, counted once per point. The points are not timed one by one,
+    the percentiles are the ones of the traces.
+    """
+    instrument.observe('match.trace', elapsed)
+    if points:
+        instrument.observe('match.trace_per_point', elapsed / points, points)